@@ -0,0 +1,584 @@
+# benchmarks for the expression language
+#
+# usage: python bench.py [name ...]     (no names runs every benchmark)
+
+import sys
+import tempfile
+import tracemalloc
+from pathlib import Path
+from time import perf_counter
+
+from contextlib import redirect_stdout, redirect_stderr
+with redirect_stdout(None), redirect_stderr(None):
+    import interp
+    import parse_run
+import compiler
+import optimize
+from interp import Seq, Lit, Add, Lt
+from resolve import resolve
+from parse_cache import ParseCache
+
+
+def gen_script(n:int) -> str:
+    '''Generates a ;-sequenced script with n statements'''
+    stmts = [f"x{i % 50} := (x{i % 7} + {i}) * 2 - y / 3 < z || ! w && v == u" for i in range(n)]
+    return "; ".join(stmts)
+
+def gen_eval_script(n:int) -> str:
+    '''Generates a ;-sequenced script with n statements that evaluates cleanly'''
+    return "; ".join(f"{i} * 2 + {i} / 3 - 1 < {i} + 7" for i in range(n))
+
+def peak_memory(f) -> int:
+    '''Peak bytes allocated by Python during a call to f'''
+    tracemalloc.start()
+    try:
+        f()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def timeit(f, repeat:int = 3) -> float:
+    '''Best wall-clock time of repeat calls to f, in seconds'''
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        f()
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def bench_parse():
+    '''Parse throughput (statements per second) for the LALR and Earley modes'''
+    parsers = {mode: parse_run.make_parser(mode) for mode in parse_run.PARSER_MODES}
+    for n in (50, 200, 2000):
+        s = gen_script(n)
+        for mode, p in parsers.items():
+            if mode == "earley" and n > 200:    # Earley is superlinear here; skip the big run
+                continue
+            t = timeit(lambda: parse_run.parse(s, p), repeat=1 if mode == "earley" else 3)
+            print(f"parse  {mode:>6}  {n:>6} stmts  {t*1000:9.1f} ms  {n/t:12.0f} stmts/s")
+
+
+def bench_startup():
+    '''Parser construction time with a cold and a warm table cache'''
+    cache_dir, parsers = parse_run.CACHE_DIR, dict(parse_run._parsers)
+    with tempfile.TemporaryDirectory() as d:
+        parse_run.CACHE_DIR = Path(d)
+        try:
+            cold = timeit(lambda: parse_run.make_parser("lalr"), repeat=1)
+            warm = timeit(lambda: parse_run.make_parser("lalr"))
+        finally:
+            # later benchmarks must not write into (and so recreate) the deleted directory
+            parse_run.CACHE_DIR = cache_dir
+            parse_run._parsers.clear()
+            parse_run._parsers.update(parsers)
+    print(f"startup  cold {cold*1000:8.1f} ms  warm {warm*1000:8.1f} ms  ({cold/warm:.0f}x)")
+
+
+def bench_ast():
+    '''Two-pass (parse tree + ToExpr) vs one-pass (inline ToExpr) AST construction'''
+    lalr = parse_run.get_parser("lalr")
+    paths = {
+        "2-pass": lambda s: parse_run.just_parse(s, lalr),
+        "1-pass": parse_run.parse_ast,
+    }
+    for n in (100, 1000):
+        s = gen_script(n)
+        for name, f in paths.items():
+            t = timeit(lambda: f(s))
+            mem = peak_memory(lambda: f(s))
+            print(f"ast  {name}  {n:>6} stmts  {t*1000:9.1f} ms  peak {mem/2**20:7.2f} MiB")
+
+
+def bench_parse_cache():
+    '''just_parse on a miss (full parse + store) vs a hit (load from disk)'''
+    with tempfile.TemporaryDirectory() as d:
+        parse_run._parse_cache = ParseCache(Path(d), parse_run.ast_version())
+        for n in (100, 1000):
+            s = gen_script(n)
+            miss = timeit(lambda: parse_run.just_parse(s), repeat=1)
+            hit = timeit(lambda: parse_run.just_parse(s))
+            print(f"parse cache  {n:>6} stmts  miss {miss*1000:8.1f} ms  hit {hit*1000:8.1f} ms  ({miss/hit:.0f}x)")
+        parse_run._parse_cache = None
+
+
+def bench_stream():
+    '''Streaming statement-by-statement evaluation: time to first result,
+    total time and peak memory against script length'''
+    with tempfile.TemporaryDirectory() as d:
+        for n in (300, 3000, 30000):
+            path = Path(d) / f"script{n}.txt"
+            path.write_text(gen_eval_script(n))
+            def first():
+                with open(path) as f:
+                    next(parse_run.stream_eval(parse_run.read_chunks(f, 4096)))
+            def total():
+                with open(path) as f:
+                    for _ in parse_run.stream_eval(parse_run.read_chunks(f, 4096)):
+                        pass
+            t1, t = timeit(first), timeit(total, repeat=1)
+            mem = peak_memory(total)
+            print(f"stream  {n:>6} stmts  first {t1*1000:7.2f} ms  total {t*1000:9.1f} ms  peak {mem/2**10:8.1f} KiB")
+    s = gen_eval_script(3000)
+    t = timeit(lambda: interp.eval(parse_run.parse_ast(s)))
+    print(f"whole     3000 stmts  first {t*1000:7.2f} ms  (parse + eval the whole script)")
+
+
+def bench_seq():
+    '''Building and evaluating a flat Seq of n statements'''
+    for n in (1000, 10000, 100000):
+        stmts = [Lt(Add(Lit(i), Lit(1)), Lit(i)) for i in range(n)]
+        build = timeit(lambda: parse_run.ToExpr().seqexp(stmts))
+        e = Seq(*stmts)
+        ev = timeit(lambda: interp.eval(e), repeat=1)
+        print(f"seq  {n:>7} stmts  build {build*1000:8.1f} ms  eval {ev*1000:9.1f} ms")
+
+
+FIB = "letfun fib(n) = ifnz n < 2 then n else fib(n - 1) + fib(n - 2) in fib({}) end"
+SUM = "letfun sum(n) = ifnz n == 0 then 0 else n + sum(n - 1) in sum({}) end"
+LOOP = "letfun loop(n) = ifnz n then loop(n - 1) else 0 in loop({}) end"
+# factorial through a Y combinator, as in test3.py's TestEval.test_11
+YFAC = """letfun y(f) = letfun g(x) = letfun h(v) = x(x)(v) in f(h) end in g(g) end in
+          letfun fac(r) = letfun g(x) = ifnz x == 0 then 1 else x * r(x - 1) in g end in
+          y(fac)({}) end end"""
+
+def bench_backends(backends=interp.BACKENDS):
+    '''Evaluation time of recursive letfun programs on each backend'''
+    for prog, n in ((FIB, 20), (SUM, 150), (YFAC, 100), (LOOP, 100000)):
+        e = parse_run.just_parse(prog.format(n))
+        name = prog.split("(")[0].split()[1]
+        times = {b: timeit(lambda: interp.evaluate(e, b)) for b in backends}
+        base = times["tree"]
+        print(f"{name}({n})  " + "  ".join(f"{b} {t*1000:8.1f} ms ({base/t:4.1f}x)" for b, t in times.items()))
+
+
+def nested_lets(n:int) -> str:
+    return "".join(f"let x{i} = {i} in " for i in range(n)) + f"x0 + x{n-1}" + " end" * n
+
+def prepared(e, backend:str):
+    '''A thunk that runs e on backend, with any compilation already done'''
+    if backend == "closure":
+        c = compiler.compile_expr(e)
+        return lambda: c(interp.empty_env)
+    elif backend == "frames":
+        r, size = resolve(e)
+        c = compiler.compile_expr(r)
+        return lambda: c([None] * size)
+    return lambda: interp.evaluate(e, backend)
+
+def bench_scaling(backends=interp.BACKENDS):
+    '''How run time (compilation excluded) grows with scope depth and recursion depth'''
+    sys.setrecursionlimit(100000)
+    for label, prog, sizes in (("lets", nested_lets, (500, 1000, 2000)),
+                               ("sum", SUM.format, (250, 500, 1000))):
+        for n in sizes:
+            e = parse_run.just_parse(prog(n))
+            times = "  ".join(f"{b} {timeit(prepared(e, b))*1000:8.2f} ms" for b in backends)
+            print(f"{label}({n:>5})  {times}")
+
+def bench_tailcalls(backends=interp.BACKENDS):
+    '''Tail-recursive loops: time and peak memory should stay linear/flat in depth'''
+    for n in (10**4, 10**5, 10**6):
+        e = parse_run.just_parse(LOOP.format(n))
+        for b in backends:
+            if b == "tree" and n > 10**5:    # ~20 us per iteration; skip the slow run
+                continue
+            t = timeit(lambda: interp.evaluate(e, b), repeat=1)
+            mem = peak_memory(lambda: interp.evaluate(e, b))
+            print(f"loop({n:>7})  {b:>7}  {t*1000:9.1f} ms  peak {mem/2**10:7.1f} KiB")
+
+# fib with its constants behind let bindings and arithmetic, as a generated
+# or macro-expanded program would have them
+CFIB = """let one = 1 in let two = one + one in let limit = two * 3 - 4 in
+          letfun fib(n) = ifnz n < limit && !(1 == 2) then n else fib(n - one) + fib(n - (two * 1)) in
+          fib({}) end end end end"""
+
+def bench_fold(backends=interp.BACKENDS):
+    '''Evaluation time with and without constant folding (folding time included)'''
+    sys.setrecursionlimit(100000)
+    for label, prog, n in (("fib", CFIB.format, 20), ("lets", nested_lets, 1000)):
+        e = parse_run.just_parse(prog(n))
+        fold_time = timeit(lambda: optimize.fold(e))
+        print(f"{label}({n})  fold {fold_time*1000:.2f} ms")
+        for b in backends:
+            plain = timeit(lambda: interp.evaluate(e, b))
+            folded = timeit(lambda: interp.evaluate(e, b, optimize=True))
+            print(f"  {b:<8} {plain*1000:8.2f} ms -> {folded*1000:8.2f} ms ({plain/folded:4.1f}x)")
+
+def bench_nodes():
+    '''Memory held by a parsed script's AST, and the cost of comparing two parses'''
+    import gc
+    for n in (1000, 5000):
+        s = gen_script(n)
+        parse_run.parse_ast(s)
+        gc.collect()
+        interp.sweep()      # so the warm-up parse's nodes are not reused
+        tracemalloc.start()
+        e = parse_run.parse_ast(s)
+        gc.collect()
+        held = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        e2 = parse_run.parse_ast(s)
+        eq = timeit(lambda: e == e2)
+        tree = sum(1 for _ in walk(e))
+        distinct = len({id(x) for x in walk(e)})
+        print(f"nodes  {n:>5} stmts  {tree:>7} tree nodes  {distinct:>6} distinct  "
+              f"{held / tree:6.1f} bytes/tree node  eq {eq * 1e6:6.2f} us")
+
+def walk(e):
+    todo = [e]
+    while todo:
+        x = todo.pop()
+        yield x
+        todo.extend(optimize.children(x))
+
+def bench_lazy():
+    '''Deferred image ops with fusion against computing each op straight away'''
+    from PIL import Image, ImageEnhance, ImageOps
+    import imageops
+    from interp import Lit, Rotate, Invert, Lighten, Darken
+    img = Image.open("Image/image1.jpg")
+    img.load()
+    square = img.crop((0, 0, 3024, 3024))
+    brighten = lambda i, f: ImageEnhance.Brightness(i).enhance(f)
+    cases = [
+        ("rotate(rotate(square))", Rotate(Rotate(Lit(square))), lambda: square.rotate(90).rotate(90)),
+        ("rotate(rotate(image1))", Rotate(Rotate(Lit(img))), lambda: img.rotate(90).rotate(90)),
+        ("invert(invert(image1))", Invert(Invert(Lit(img))), lambda: ImageOps.invert(ImageOps.invert(img))),
+        ("lighten(darken(image1))", Lighten(Darken(Lit(img))), lambda: brighten(brighten(img, 0.5), 1.5)),
+    ]
+    for label, e, eager in cases:
+        before = imageops.passes
+        interp.evaluate(e)
+        passes = imageops.passes - before
+        t_eager, t_lazy = timeit(eager), timeit(lambda: interp.evaluate(e))
+        print(f"{label:<26} eager {t_eager*1000:7.1f} ms  lazy {t_lazy*1000:7.1f} ms "
+              f"({t_eager/t_lazy:5.1f}x, {passes} pass{"" if passes == 1 else "es"})")
+
+def bench_points():
+    '''Point-op chains: one op at a time against one fused lookup-table pass'''
+    from PIL import Image, ImageEnhance, ImageOps
+    import imageops
+    eager = {"invert": ImageOps.invert,
+             "lighten": lambda i: ImageEnhance.Brightness(i).enhance(1.5),
+             "darken": lambda i: ImageEnhance.Brightness(i).enhance(0.5)}
+    lazy = {"invert": interp.invert, "lighten": interp.lighten, "darken": interp.darken}
+    img = Image.open("Image/image1.jpg")
+    img.load()
+    wide = Image.new("RGB", (img.width * 2, img.height))
+    wide.paste(img, (0, 0))
+    wide.paste(img, (img.width, 0))
+    chains = [["darken", "lighten", "invert"], ["lighten"] * 4, ["darken", "invert", "lighten", "invert", "darken"]]
+    for source in (img, wide):
+        mp = source.width * source.height / 1e6
+        for chain in chains:
+            def run_eager():
+                v = source
+                for op in chain:
+                    v = eager[op](v)
+                return v
+            def run_fused():
+                v = source
+                for op in chain:
+                    v = lazy[op](v)
+                return imageops.force(v)
+            before = imageops.passes
+            run_fused()
+            passes = imageops.passes - before
+            t_eager, t_fused = timeit(run_eager), timeit(run_fused)
+            mb = source.width * source.height * 3 / 2**20
+            label = "x"
+            for op in chain:
+                label = f"{op}({label})"
+            print(f"{mp:4.0f} MP  {label:<46} "
+                  f"eager {len(chain)} passes {len(chain) * mb:6.0f} MiB {t_eager*1000:7.1f} ms   "
+                  f"fused {passes} pass {passes * mb:4.0f} MiB {t_fused*1000:7.1f} ms  ({t_eager/t_fused:4.1f}x)")
+
+def bench_rotate():
+    '''n quarter turns: rotate(90) n times (the old path) against the transpose engine'''
+    from PIL import Image
+    import imageops
+    img = Image.open("Image/image1.jpg")
+    img.load()
+    for n in (1, 2, 3, 4, 7):
+        def old():
+            v = img
+            for _ in range(n):
+                v = v.rotate(90)
+            return v
+        def new():
+            v = img
+            for _ in range(n):
+                v = interp.rotate(v)
+            return imageops.force(v)
+        before = imageops.passes
+        size = new().size
+        passes = imageops.passes - before
+        t_old, t_new = timeit(old), timeit(new)
+        print(f"rotate x{n}  old {t_old*1000:7.1f} ms {str(old().size):<13}  "
+              f"transpose {t_new*1000:6.1f} ms {str(size):<13} {passes} cop{"y" if passes == 1 else "ies"}  ({t_old/t_new:5.1f}x)")
+
+def bench_combine():
+    '''A strip of n images built by nested combines: a canvas per level against one n-way combine'''
+    from PIL import Image
+    import imageops
+    img = Image.open("Image/image1.jpg")
+    img.load()
+    tile = img.resize((img.width // 4, img.height // 4))
+    for n in (2, 4, 8, 16):
+        def pairwise():
+            strip = tile
+            for _ in range(n - 1):
+                out = Image.new("RGB", (strip.width + tile.width, tile.height))
+                out.paste(strip, (0, 0))
+                out.paste(tile, (strip.width, 0))
+                strip = out
+            return strip
+        def nary():
+            v = tile
+            for _ in range(n - 1):
+                v = interp.combine(v, tile)
+            return imageops.force(v)
+        copied = sum(range(2, n + 1)) * tile.width * tile.height * 3 / 2**20
+        t_old, t_new = timeit(pairwise), timeit(nary)
+        print(f"{n:3} images  pairwise {t_old*1000:7.1f} ms {copied:5.0f} MiB copied   "
+              f"n-way {t_new*1000:6.1f} ms {n * tile.width * tile.height * 3 / 2**20:4.0f} MiB  ({t_old/t_new:4.1f}x)")
+
+def bench_parallel():
+    '''Independent image branches computed on 1, 2, 4 and 8 threads'''
+    import os
+    from PIL import Image
+    from interp import Lit, Blur, Invert, Lighten, Rotate, Combine
+    img = Image.open("Image/image1.jpg")
+    img.load()
+    square = img.crop((0, 0, 3024, 3024))
+    branches = [Blur(Lit(square)), Lighten(Blur(Rotate(Lit(square)))), Blur(Invert(Lit(square))), Blur(Blur(Lit(square)))]
+    e = branches[0]
+    for b in branches[1:]:
+        e = Combine(e, b)
+    t_one = timeit(lambda: interp.evaluate(e), repeat=2)
+    print(f"{len(branches)} branches, {os.cpu_count()} cpus   1 thread  {t_one*1000:7.1f} ms")
+    for workers in (2, 4, 8):
+        t = timeit(lambda: interp.evaluate(e, workers=workers), repeat=2)
+        print(f"{"":<22}{workers} threads {t*1000:7.1f} ms  ({t_one/t:4.1f}x)")
+
+def bench_strips():
+    '''One blur, and one point op, on a 49 MP image: a single call against strips on 2, 4 and 8 threads'''
+    import os
+    from PIL import Image
+    import imageops
+    img = Image.open("Image/image1.jpg")
+    img.load()
+    big = img.resize((img.width * 2, img.height * 2))
+    print(f"{big.width * big.height / 1e6:.0f} MP, {os.cpu_count()} cpus")
+    for label, op in (("blur", interp.blur), ("invert", interp.invert)):
+        t_one = timeit(lambda: imageops.force(op(big)), repeat=2)
+        want = imageops.force(op(big)).tobytes()
+        print(f"  {label:<7} 1 thread  {t_one*1000:7.1f} ms")
+        for workers in (2, 4, 8):
+            with imageops.parallel(workers):
+                t = timeit(lambda: imageops.force(op(big)), repeat=2)
+                exact = imageops.force(op(big)).tobytes() == want
+            print(f"  {"":<7} {workers} threads {t*1000:7.1f} ms  ({t_one/t:4.1f}x, {"exact" if exact else "DIFFERS"})")
+
+def bench_stream_images():
+    '''Peak memory of a chain over a 37 MP PPM panorama combined with itself (73 MP out): whole against streamed'''
+    import subprocess
+    from PIL import Image
+    img = Image.open("Image/image1.jpg")
+    img.load()
+    with tempfile.TemporaryDirectory() as d:
+        pano = Image.new("RGB", (img.width * 3, img.height))
+        for i in range(3):
+            pano.paste(img, (img.width * i, 0))
+        pano.save(f"{d}/pano.ppm")
+        del pano
+        chain = "v = interp.invert(interp.lighten(interp.blur(interp.combine(imageops.file(src), imageops.file(src)))))"
+        whole = "imageops.force(v).save(dst)"
+        streamed = "stream.stream(v, dst, 128)"
+        for label, run in (("whole", whole), ("streamed", streamed)):
+            code = (f"import resource, time, interp, imageops, stream\nsrc, dst = {f"{d}/pano.ppm"!r}, {f"{d}/{label}.ppm"!r}\n"
+                    f"start = time.perf_counter()\n{chain}\n{run}\n"
+                    f"print(time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)")
+            t, rss = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout.split()
+            print(f"{label:<9} peak RSS {int(rss) / 1024:7.0f} MiB  {float(t) * 1000:7.0f} ms")
+        with open(f"{d}/whole.ppm", "rb") as a, open(f"{d}/streamed.ppm", "rb") as b:
+            print("identical output" if a.read() == b.read() else "OUTPUTS DIFFER")
+
+def bench_result_cache():
+    '''A program run repeatedly: no cache, then one ResultCache shared by every run'''
+    from PIL import Image
+    from result_cache import ResultCache
+    from interp import Lit, Let, Name, Blur, Lighten, Invert, Combine
+    img = Image.open("Image/image1.jpg")
+    img.load()
+    e = Let("x", Blur(Lighten(Lit(img))), Combine(Name("x"), Combine(Invert(Blur(Lighten(Lit(img)))), Name("x"))))
+    t_plain = timeit(lambda: interp.evaluate(e), repeat=2)
+    cache = ResultCache()
+    start = perf_counter()
+    interp.evaluate(e, cache=cache)
+    t_cold = perf_counter() - start
+    t_warm = timeit(lambda: interp.evaluate(e, cache=cache), repeat=5)
+    print(f"no cache {t_plain*1000:7.1f} ms   cold {t_cold*1000:7.1f} ms   "
+          f"warm {t_warm*1000:6.1f} ms ({t_plain/t_warm:5.0f}x)   {cache.stats()}")
+
+def bench_disk_cache():
+    '''blur(lighten(image1)) in fresh processes: no cache, a cold disk cache, then a warm one'''
+    import os
+    import subprocess
+    code = ("import time\nstart = time.perf_counter()\nimport imageops, interp\n"
+            "imageops.force(interp.blur(interp.lighten(imageops.file('Image/image1.jpg'))))\n"
+            "print(time.perf_counter() - start, imageops.passes)")
+    with tempfile.TemporaryDirectory() as d:
+        for label, cached in (("no cache", "0"), ("cold", "1"), ("warm", "1"), ("warm", "1")):
+            env = dict(os.environ, EXPR_IMAGE_CACHE=cached, EXPR_CACHE_DIR=d)
+            t, passes = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True,
+                                       text=True, check=True).stdout.split()
+            print(f"{label:<9} {float(t) * 1000:7.1f} ms  {passes} passes")
+
+def bench_registry():
+    '''A script naming image1 n times: a fresh Image.open per reference against registry handles'''
+    from PIL import Image
+    import imageops
+    import registry
+    from interp import Lit
+    for n in (1, 2, 4):
+        src = "invert(image1)"
+        for _ in range(n - 1):
+            src = f"combine({src}, invert(image1))"
+        e = parse_run.just_parse(src)
+        def per_reference(x):
+            # the old ToExpr.id: every mention its own Image.open, so its own decode
+            match x:
+                case imageops.LazyImage(op="file"):
+                    return Lit(Image.open(x.arg))
+                case interp.Combine(a, b):
+                    return interp.Combine(per_reference(a), per_reference(b))
+                case interp.Invert(a):
+                    return interp.Invert(per_reference(a))
+            return x
+        def handles():
+            registry.open("image1").image = None    # as in a new process
+            return interp.evaluate(e)
+        t_old = timeit(lambda: interp.evaluate(per_reference(e)), repeat=2)
+        t_new = timeit(handles, repeat=2)
+        print(f"image1 x{n}  Image.open each {t_old*1000:7.1f} ms ({n} decode{"s" if n > 1 else ""})   "
+              f"registry {t_new*1000:7.1f} ms (1 decode)  ({t_old/t_new:4.1f}x)")
+
+def bench_resize():
+    '''resize(lighten(image1), w, h): decode whole, then resize, against the target pushed to the decoder'''
+    from PIL import Image, ImageEnhance
+    import imageops
+    import registry
+    path = registry.open("image1").arg
+    with Image.open(path) as img:
+        full = img.size
+    def decode_then_resize(size):
+        with Image.open(path) as img:
+            return ImageEnhance.Brightness(img).enhance(1.5).resize(size)
+    for divisor in (2, 4, 8, 10):
+        size = (full[0] // divisor, full[1] // divisor)
+        v = lambda: interp.resize(interp.lighten(imageops.file(path)), *size)
+        drafts = [x for x in imageops.postorder(imageops.rewrite(v())) if x.op == "draft"]
+        t_old, t_new = timeit(lambda: decode_then_resize(size)), timeit(lambda: imageops.force(v()))
+        print(f"to {str(size):<12} decode+resize {t_old*1000:7.1f} ms   "
+              f"draft 1/{drafts[0].arg[1] if drafts else 1} {t_new*1000:6.1f} ms  ({t_old/t_new:4.1f}x)")
+
+def bench_crop():
+    '''Windows of lighten(blur(combine(panorama, image2))), a 37 MP PPM panorama: whole then cut, against the box pushed down'''
+    import subprocess
+    from PIL import Image
+    img = Image.open("Image/image1.jpg")
+    img.load()
+    with tempfile.TemporaryDirectory() as d:
+        pano = Image.new("RGB", (img.width * 3, img.height))
+        for i in range(3):
+            pano.paste(img, (img.width * i, 0))
+        pano.save(f"{d}/pano.ppm")
+        del pano
+        left = img.width * 3 - 128     # across the seam of the panorama and image2
+        for side in (256, 1024, 4096):
+            box = (left, 1000, left + side, 1000 + side)
+            for label, run in (("whole", f"imageops.force(v).crop({box})"), ("cropped", f"imageops.force(imageops.crop(v, {box}))")):
+                code = (f"import resource, time, interp, imageops, registry\n"
+                        f"start = time.perf_counter()\n"
+                        f"v = interp.lighten(interp.blur(interp.combine(imageops.file({f"{d}/pano.ppm"!r}), registry.open('image2'))))\n"
+                        f"{run}\n"
+                        f"print(time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)")
+                t, rss = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout.split()
+                print(f"{side:>4}x{side:<4} {label:<8} peak RSS {int(rss) / 1024:7.0f} MiB  {float(t) * 1000:7.0f} ms")
+
+def bench_dominant_color():
+    '''dom_color: getcolors(maxcolors=1000000) and max, against binned counts, whole and sampled'''
+    import tracemalloc
+    from PIL import Image
+    import dominant
+
+    def getcolors(img):
+        found = img.getcolors(maxcolors=1000000)
+        return max(found, key=lambda x: x[0])[1] if found else None
+
+    def share(img, color):
+        # the part of img in color's bin of 5-bit bands
+        top = [v >> 3 for v in range(256)] * 3
+        return dict((c, n) for n, c in img.point(top).getcolors(1 << 15)).get(tuple(v >> 3 for v in color), 0) / (img.width * img.height)
+
+    photos = {}
+    for name in ("image1", "image2"):
+        photos[name] = Image.open(f"Image/{name}.jpg")
+        photos[name].load()
+    # every pixel a different color (R and G count x and y, B which 256 block) but one 64x64 patch
+    w, h = 2048, 1024
+    bands = [bytes(range(256)) * (w // 256) * h,
+             b"".join(bytes([y % 256]) * w for y in range(h)),
+             b"".join(bytes([x + 8 * (y // 256)]) * 256 for y in range(h) for x in range(w // 256))]
+    distinct = Image.merge("RGB", [Image.frombytes("L", (w, h), b) for b in bands])
+    distinct.paste((10, 20, 30), (100, 100, 164, 164))
+    photos["2 MP, all distinct"] = distinct
+    methods = {"getcolors": getcolors, "binned": dominant.dominant_color,
+               "sampled 1%": lambda img: dominant.dominant_color(img, error=0.01),
+               "sampled 2%": lambda img: dominant.dominant_color(img, error=0.02)}
+    for name, img in photos.items():
+        best = share(img, dominant.dominant_color(img))
+        print(name)
+        for label, f in methods.items():
+            tracemalloc.start()
+            color = f(img)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            t = timeit(lambda: f(img))
+            held = f"{share(img, color) * 100:5.2f}% (fullest {best * 100:5.2f}%)" if color else "no answer"
+            print(f"  {label:<11} {t * 1000:7.1f} ms  Python heap peak {peak / 2**20:6.1f} MiB  "
+                  f"{str(color):<16} bin holds {held}")
+
+
+BENCHMARKS = {
+    "parse": bench_parse,
+    "startup": bench_startup,
+    "ast": bench_ast,
+    "parse_cache": bench_parse_cache,
+    "stream": bench_stream,
+    "seq": bench_seq,
+    "backends": bench_backends,
+    "scaling": bench_scaling,
+    "tailcalls": bench_tailcalls,
+    "fold": bench_fold,
+    "nodes": bench_nodes,
+    "lazy": bench_lazy,
+    "points": bench_points,
+    "rotate": bench_rotate,
+    "combine": bench_combine,
+    "parallel": bench_parallel,
+    "strips": bench_strips,
+    "stream_images": bench_stream_images,
+    "result_cache": bench_result_cache,
+    "disk_cache": bench_disk_cache,
+    "registry": bench_registry,
+    "resize": bench_resize,
+    "crop": bench_crop,
+    "dominant_color": bench_dominant_color,
+}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
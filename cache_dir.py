@@ -0,0 +1,47 @@
+'''A directory of cache entries, one file each, shared between processes.
+
+write() puts an entry in place atomically: it is written to a temporary file
+in the same directory and renamed over the entry, so a reader in another
+process sees a whole entry or none, and two writers of the same entry just
+replace one with the other. evict() keeps the entries matching a pattern
+under a size by deleting the least recently used ones first, by mtime (which
+a cache refreshes on a hit). parse_cache.py and disk_cache.py both keep
+their entries this way.'''
+
+import os
+import tempfile
+from pathlib import Path
+
+
+def write(path:Path, *chunks:bytes) -> None:
+    '''Writes chunks to path atomically; the temporary file is removed on failure'''
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def evict(directory:Path, pattern:str, max_bytes:int) -> None:
+    '''Deletes the least recently used entries matching pattern in directory
+    until those left fit in max_bytes'''
+    entries = []
+    for p in directory.glob(pattern):
+        try:
+            st = p.stat()
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, p))
+    total = sum(size for _, size, _ in entries)
+    for _, size, p in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            p.unlink()
+        except OSError:
+            pass
+        total -= size
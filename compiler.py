@@ -0,0 +1,377 @@
+'''Closure compilation backend.
+
+compile_expr turns an Expr into a tree of Python closures once; running the
+program is then just calling the root closure with an environment, with no
+per-node match dispatch. The semantics (including every error) are the same
+as interp.evalInEnv, and environments are the same tuples of locations.
+
+Programs rewritten by resolve.resolve compile to closures over array-backed
+frames instead (eval_frames): variables are read and written by their
+(depth, slot) address, with no environment copying or name lookup.'''
+
+from typing import Callable
+from PIL import Image
+from interp import Expr, Value, Env, Closure, evalError, empty_env, \
+    Seq, Read, Show, Assign, Blur, Invert, Neg, Add, Sub, Mul, Div, Rotate, Combine, Resize, Crop, \
+    Name, Let, Lit, Or, And, Not, Eq, Lt, If, Darken, Lighten, Ifnz, Letfun, App, dom_color, \
+    newLoc, getLoc, setLoc, extendEnv, lookupEnv, evalInEnv, \
+    show, blur, invert, rotate, combine, resize, crop, darken, lighten, dominant_color, is_image, force, LazyImage
+from resolve import resolve, unresolved, Local, AssignLocal, LetLocal, LetfunLocal
+
+type Code = Callable[[Env[Value]], Value]
+
+
+def compile_expr(e: Expr, tail: bool = False) -> Code:
+    '''tail=True compiles e for a tail position of a function body: a call
+    there returns a TailCall for the caller's trampoline instead of recursing'''
+    match e:
+        case Seq(exprs):
+            init = [compile_expr(x) for x in exprs[:-1]]
+            last = compile_expr(exprs[-1], tail)
+            def seq(env):
+                for c in init:
+                    c(env)
+                return last(env)
+            return seq
+
+        case Read(prompt):
+            def read(env):
+                try:
+                    return int(input(prompt))
+                except ValueError:
+                    raise evalError("Invalid input: expected an integer")
+            return read
+
+        case Show(image):
+            return unary(show, compile_expr(image))
+        case Blur(image):
+            return unary(blur, compile_expr(image))
+        case Invert(image):
+            return unary(invert, compile_expr(image))
+        case Rotate(image):
+            return unary(rotate, compile_expr(image))
+        case Darken(image):
+            return unary(darken, compile_expr(image))
+        case Lighten(image):
+            return unary(lighten, compile_expr(image))
+
+        case Combine(image1, image2):
+            c1, c2 = compile_expr(image1), compile_expr(image2)
+            def comb(env):
+                img1 = c1(env)
+                return combine(img1, c2(env))
+            return comb
+
+        case Resize(image, width, height):
+            ci, cw, ch = compile_expr(image), compile_expr(width), compile_expr(height)
+            def resize_(env):
+                img = ci(env)
+                w = cw(env)
+                return resize(img, w, ch(env))
+            return resize_
+
+        case Crop(image, left, top, width, height):
+            ci, cl, ct, cw, ch = (compile_expr(x) for x in (image, left, top, width, height))
+            def crop_(env):
+                img = ci(env)
+                l = cl(env)
+                t = ct(env)
+                w = cw(env)
+                return crop(img, l, t, w, ch(env))
+            return crop_
+
+        case Assign(name, value):
+            cv = compile_expr(value)
+            def assign(env):
+                v = cv(env)
+                loc = lookupEnv(name, env)
+                if loc is None:
+                    raise evalError(f"Name {name} not found")
+                if isinstance(getLoc(loc), Closure):
+                    raise evalError(f"Cannot assign to function {name}")
+                setLoc(loc, v)
+                return v
+            return assign
+
+        case Neg(value):
+            cv = compile_expr(value)
+            def neg(env):
+                v = cv(env)
+                if type(v) == int:
+                    return -v
+                raise evalError("Negation requires an integer literal")
+            return neg
+
+        case Add(left, right):
+            cl, cr = compile_expr(left), compile_expr(right)
+            def add(env):
+                l = cl(env)
+                r = cr(env)
+                if type(l) == int and type(r) == int:
+                    return l + r
+                if is_image(l) and is_image(r):
+                    return Combine(l, r)
+                raise evalError("Addition requires two integers literals")
+            return add
+
+        case Sub(left, right):
+            cl, cr = compile_expr(left), compile_expr(right)
+            def sub(env):
+                l = cl(env)
+                r = cr(env)
+                if type(l) == int and type(r) == int:
+                    return l - r
+                raise evalError("Subtraction requires two integer literals")
+            return sub
+
+        case Mul(left, right):
+            cl, cr = compile_expr(left), compile_expr(right)
+            def mul(env):
+                l = cl(env)
+                r = cr(env)
+                if type(l) == int and type(r) == int:
+                    return l * r
+                raise evalError("Multiplication requires two integer literals")
+            return mul
+
+        case Div(left, right):
+            cl, cr = compile_expr(left), compile_expr(right)
+            def div(env):
+                l = cl(env)
+                r = cr(env)
+                if type(l) == int and type(r) == int:
+                    if r == 0:
+                        raise evalError("You cannot divide by Zero")
+                    return l // r
+                raise evalError("Division requires two integer literals")
+            return div
+
+        case Name(name):
+            def name_(env):
+                loc = lookupEnv(name, env)
+                if loc is None:
+                    raise evalError(f"Name {name} not found")
+                return getLoc(loc)
+            return name_
+
+        case Let(name, value, body):
+            cv, cb = compile_expr(value), compile_expr(body, tail)
+            def let(env):
+                return cb(extendEnv(env, name, newLoc(cv(env))))
+            return let
+
+        case Lit(lit):
+            if isinstance(lit, int) or is_image(lit):    # bool is an int
+                return lambda env: lit
+            def bad_lit(env):
+                raise evalError(f"Unknown literal: {lit}")
+            return bad_lit
+
+        case Or(left, right):
+            cl, cr = compile_expr(left), compile_expr(right)
+            def or_(env):
+                l = cl(env)
+                if isinstance(l, bool):
+                    if l:
+                        return True
+                    r = cr(env)
+                    if isinstance(r, bool):
+                        return r
+                raise evalError("Or requires two boolean literals")
+            return or_
+
+        case And(left, right):
+            cl, cr = compile_expr(left), compile_expr(right)
+            def and_(env):
+                l = cl(env)
+                if isinstance(l, bool):
+                    if not l:
+                        return False
+                    r = cr(env)
+                    if isinstance(r, bool):
+                        return r
+                raise evalError("And requires two boolean literals")
+            return and_
+
+        case Not(value):
+            cv = compile_expr(value)
+            def not_(env):
+                v = cv(env)
+                if isinstance(v, bool):
+                    return not v
+                raise evalError("Not requires a boolean literal")
+            return not_
+
+        case Eq(left, right):
+            cl, cr = compile_expr(left), compile_expr(right)
+            def eq(env):
+                l = cl(env)
+                r = cr(env)
+                if type(l) == bool:
+                    if type(r) == bool:
+                        return l == r
+                    raise evalError("Eq requires a Boolean")
+                elif type(l) == int and type(r) == int:
+                    return l == r
+                elif is_image(l) and is_image(r):
+                    return force(l).tobytes()
+                return None
+            return eq
+
+        case Lt(left, right):
+            cl, cr = compile_expr(left), compile_expr(right)
+            def lt(env):
+                l = cl(env)
+                r = cr(env)
+                if type(l) == int and type(r) == int:
+                    return l < r
+                raise evalError("Lt requires a Boolean")
+            return lt
+
+        case If(condition, then_branch, else_branch):
+            cc, ct, ce = compile_expr(condition), compile_expr(then_branch, tail), compile_expr(else_branch, tail)
+            def if_(env):
+                c = cc(env)
+                if isinstance(c, bool):
+                    return ct(env) if c else ce(env)
+                raise evalError("If condition must be a boolean")
+            return if_
+
+        case Ifnz(cond, thenexpr, elseexpr):
+            cc, ct, ce = compile_expr(cond), compile_expr(thenexpr, tail), compile_expr(elseexpr, tail)
+            def ifnz(env):
+                return ce(env) if cc(env) == 0 else ct(env)
+            return ifnz
+
+        case Letfun(name, params, bodyexpr, inexpr):
+            enter, ci = enter_env(params, compile_expr(bodyexpr, True)), compile_expr(inexpr, tail)
+            def letfun(env):
+                c = Closure(params, bodyexpr, env, enter)
+                newEnv = extendEnv(env, name, newLoc(c))
+                c.env = newEnv
+                return ci(newEnv)
+            return letfun
+
+        case App(f, arg):
+            cf, ca = compile_expr(f), compile_expr(arg)
+            def app(env):
+                fun = cf(env)
+                a = ca(env)
+                if isinstance(fun, Closure):
+                    return call(fun, a)
+                raise evalError("not a function")
+            def tail_app(env):
+                fun = cf(env)
+                a = ca(env)
+                if isinstance(fun, Closure):
+                    return TailCall(fun, a)
+                raise evalError("not a function")
+            return tail_app if tail else app
+
+        # resolved variables (see resolve.py): env is a frame here
+
+        case Local(depth, slot, name):
+            return local(depth, slot, name)
+
+        case AssignLocal(depth, slot, name, value):
+            cv = compile_expr(value)
+            def assign_local(frame):
+                v = cv(frame)
+                if slot is None:
+                    raise evalError(f"Name {name} not found")
+                for _ in range(depth):
+                    frame = frame[0]
+                if isinstance(frame[slot], Closure):
+                    raise evalError(f"Cannot assign to function {name}")
+                frame[slot] = v
+                return v
+            return assign_local
+
+        case LetLocal(slot, name, value, body):
+            cv, cb = compile_expr(value), compile_expr(body, tail)
+            def let_local(frame):
+                frame[slot] = cv(frame)
+                return cb(frame)
+            return let_local
+
+        case LetfunLocal(slot, size, name, params, bodyexpr, inexpr):
+            enter, ci = enter_frame(size, compile_expr(bodyexpr, True)), compile_expr(inexpr, tail)
+            def letfun_local(frame):
+                frame[slot] = Closure(params, bodyexpr, frame, enter)
+                return ci(frame)
+            return letfun_local
+
+        case dom_color(image):
+            return unary(dominant_color, compile_expr(image))
+
+        case Image.Image() | LazyImage():
+            return lambda env: e
+
+        case _:
+            # anything without a specialized closure (an unknown node, which
+            # must only fail when it is reached) runs on the tree-walker. A
+            # frame is no environment for it: there it may only run if it
+            # has no variables, which resolve() would have left unaddressed
+            named = unresolved(e)
+            def fallback(env):
+                if type(env) is not list:
+                    return evalInEnv(env, e)
+                if named:
+                    raise evalError(f"{type(e).__name__} cannot use variables on this backend")
+                return evalInEnv(empty_env, e)
+            return fallback
+
+
+def unary(op: Callable[[Value], Value], c: Code) -> Code:
+    return lambda env: op(c(env))
+
+# a Closure's code enters the function: it takes the closure's environment
+# and the argument, and runs the body in a new environment. Bodies are
+# compiled in tail mode, so entering may return a TailCall instead of a value.
+
+class TailCall:
+    __slots__ = ("fun", "arg")
+    def __init__(self, fun: Closure, arg: Value):
+        self.fun = fun
+        self.arg = arg
+
+def call(fun: Closure, a: Value) -> Value:
+    '''Calls fun, then keeps running the tail calls it returns in a loop
+    (a trampoline), so tail recursion does not grow the Python stack'''
+    while True:
+        if fun.code is None:    # made by the tree-walker
+            fun.code = enter_env(fun.params, compile_expr(fun.body, True))
+        r = fun.code(fun.env, a)
+        if type(r) is not TailCall:
+            return r
+        fun, a = r.fun, r.arg
+
+def enter_env(param: str, body: Code):
+    return lambda cenv, a: body(extendEnv(cenv, param, newLoc(a)))
+
+def enter_frame(size: int, body: Code):
+    pad = [None] * (size - 2)
+    return lambda parent, a: body([parent, a, *pad])
+
+def local(depth: int, slot: int | None, name: str) -> Code:
+    if slot is None:
+        def unbound(frame):
+            raise evalError(f"Name {name} not found")
+        return unbound
+    elif depth == 0:
+        return lambda frame: frame[slot]
+    elif depth == 1:
+        return lambda frame: frame[0][slot]
+    def outer(frame):
+        for _ in range(depth):
+            frame = frame[0]
+        return frame[slot]
+    return outer
+
+
+def eval(e: Expr) -> Value:
+    return compile_expr(e)(empty_env)
+
+def eval_frames(e: Expr) -> Value:
+    r, size = resolve(e)
+    return compile_expr(r)([None] * size)
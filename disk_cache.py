@@ -0,0 +1,89 @@
+'''On-disk cache of computed images, by content, shared between processes.
+
+Keys are the digests of imageops.digest (as for result_cache.py), so any
+process that builds an equal graph finds the entry. Each entry is one file:
+a 64-byte text header (magic, mode, width, height) followed by the pixels
+exactly as Image.tobytes() lays them out, uncompressed. A hit maps the file
+into memory and builds the image on the mapping: no decoding, and for the
+modes Pillow keeps in that layout (L, RGBA, I, F...) not even a copy; RGB,
+which Pillow pads to four bytes a pixel, is unpacked in one pass.
+
+Entries are written and evicted with cache_dir.py: a reader in another
+process sees a whole entry or none, and two writers of the same key just
+replace one with the other (both hold the same pixels). An entry mapped by
+one process stays readable after another evicts it. The directory is kept
+under max_bytes by deleting the least recently used entries (by mtime,
+which a hit refreshes).
+
+The evaluator uses it when EXPR_IMAGE_CACHE=1 is set (see from_env), in
+EXPR_CACHE_DIR/images, up to EXPR_IMAGE_CACHE_BYTES.'''
+
+import mmap
+import os
+from pathlib import Path
+from PIL import Image
+import cache_dir
+
+MAGIC = b"EXPRIMG1"
+HEADER = 64
+
+
+class DiskCache:
+    def __init__(self, directory:Path, max_bytes:int = 2 * 2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key:bytes) -> Path:
+        return self.directory / f"{key.hex()}.img"
+
+    def get(self, key:bytes) -> Image.Image | None:
+        '''The image stored under key, mapped from its file, or None on a miss'''
+        p = self.path(key)
+        try:
+            with open(p, "rb") as f:
+                magic, mode, width, height = f.read(HEADER).split()
+                if magic != MAGIC:
+                    raise ValueError(f"not a cache entry: {p}")
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            size = (int(width), int(height))
+            img = Image.frombuffer(mode.decode(), size, memoryview(mapped)[HEADER:], "raw", mode.decode(), 0, 1)
+            os.utime(p)    # mark as recently used
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception:
+            # a corrupt or unreadable entry is just a miss
+            self.misses += 1
+            return None
+        self.hits += 1
+        return img
+
+    def put(self, key:bytes, img:Image.Image) -> None:
+        '''Stores img under key; palette images, whose pixels mean nothing
+        without the palette, are not cached'''
+        if img.mode in ("P", "PA"):
+            return
+        header = b" ".join([MAGIC, img.mode.encode(), b"%d %d" % img.size]).ljust(HEADER - 1) + b"\n"
+        try:
+            cache_dir.write(self.path(key), header, img.tobytes())
+        except OSError:
+            return
+        self.evict()
+
+    def evict(self) -> None:
+        '''Deletes least recently used entries until the cache fits in max_bytes'''
+        cache_dir.evict(self.directory, "*.img", self.max_bytes)
+
+    def clear(self) -> None:
+        for p in self.directory.glob("*.img"):
+            p.unlink(missing_ok=True)
+
+
+def from_env() -> DiskCache | None:
+    '''The cache the environment asks for: EXPR_IMAGE_CACHE=1 turns it on'''
+    if os.environ.get("EXPR_IMAGE_CACHE", "0") != "1":
+        return None
+    directory = Path(os.environ.get("EXPR_CACHE_DIR", ".expr_cache")) / "images"
+    return DiskCache(directory, int(os.environ.get("EXPR_IMAGE_CACHE_BYTES", 2 * 2**30)))
@@ -0,0 +1,104 @@
+'''The dominant color of an image, in memory that does not grow with it.
+
+Image.getcolors counts every distinct color, in a table as big as the number
+of colors (and gives up, returning None, past maxcolors); a photo has
+hundreds of thousands or millions, most seen only a few times, so the most
+frequent exact color says little. dominant_color() counts colors in bins
+instead: each band keeps its top `bits` bits (5 by default, so 32768 bins
+for RGB), which groups the near-identical shades a photo spreads one color
+over. The fullest bin wins, and the color returned is the most frequent
+exact color inside it, so it is always a color of the image. Both counts
+are Pillow passes (a table lookup and getcolors, which can never overflow a
+bounded number of bins) over a strip of rows at a time, so the memory used
+is set by the number of bins and the strip size, not the image.
+
+With error given, the bins are counted over a random sample of pixels
+instead, just enough of them that each bin's share of the image is within
+error of its share of the sample, with a chance of CONFIDENCE (Hoeffding's
+bound); so, unless the count of the bin chosen or of the fullest bin is off
+by more, the bin chosen holds at most 2 * error less of the image than the
+fullest. The sample is seeded, so the answer is repeatable.
+
+L images give a gray level, as getcolors does; images in other modes give an
+(R, G, B) tuple.'''
+
+import math
+import random
+from collections import Counter
+from PIL import Image
+from imageops import STRIP_PIXELS
+
+# the chance that a sampled count is within error of the true share
+CONFIDENCE = 0.999
+
+
+def dominant_color(img: Image.Image, bits: int = 5, error: float | None = None) -> int | tuple[int, ...]:
+    '''The most frequent color of img in its fullest bin of colors alike in their top bits'''
+    if not 1 <= bits <= 8:
+        raise ValueError(f"bits must be from 1 to 8, not {bits}")
+    if img.mode not in ("L", "RGB"):
+        img = img.convert("RGB")
+    if error is not None:
+        img = sample(img, error)
+    if img.mode == "L":
+        return gray(img.histogram(), bits)
+    # a bin is the color of its pixels shifted down to their top bits (not
+    # masked: getcolors hashes colors whose low bits are all zero badly)
+    shift = 8 - bits
+    bins = Counter()
+    for part in strips(img):
+        bins.update(counts(part.point([v >> shift for v in range(256)] * 3), 1 << 3 * bits))
+    fullest = most(bins)
+    # the exact colors in the fullest bin: the pixels outside it are painted
+    # a color outside it, so getcolors counts a bounded number again
+    inside = sum(([255 if v >> shift == c else 0 for v in range(256)] for c in fullest), [])
+    outside = tuple((c << shift) ^ 0x80 for c in fullest)
+    colors = Counter()
+    for part in strips(img):
+        # 255 in all three bands is the only way to 255 in L
+        mask = part.point(inside).convert("L").point([0] * 255 + [255])
+        box = mask.getbbox()
+        if box is None:
+            continue
+        painted = Image.new("RGB", (box[2] - box[0], box[3] - box[1]), outside)
+        painted.paste(part.crop(box), mask=mask.crop(box))
+        colors.update(counts(painted, (1 << 3 * shift) + 1))
+    colors.pop(outside, None)
+    return most(colors)
+
+def counts(img: Image.Image, maxcolors: int) -> dict:
+    return {c: n for n, c in img.getcolors(maxcolors)}
+
+def most(counts: Counter):
+    '''The key with the highest count, the highest key among equals'''
+    return max(counts.items(), key=lambda item: (item[1], item[0]))[0]
+
+def gray(histogram: list[int], bits: int) -> int:
+    '''The most frequent level of the fullest bin of this L histogram'''
+    width = 1 << (8 - bits)
+    base = max(range(0, 256, width), key=lambda b: (sum(histogram[b:b + width]), b))
+    return max(range(base, base + width), key=lambda v: (histogram[v], v))
+
+def sample(img: Image.Image, error: float) -> Image.Image:
+    '''Enough of img's pixels, drawn at random, for each bin's share of them to
+    be within error of its share of img, with CONFIDENCE; as a one-row image'''
+    if not 0 < error < 1:
+        raise ValueError(f"error must be between 0 and 1, not {error}")
+    w, h = img.size
+    n = sample_size(error)
+    if n >= w * h:
+        return img
+    pixels = img.load()
+    picked = Image.new(img.mode, (n, 1))
+    picked.putdata([pixels[i % w, i // w] for i in random.Random(0).choices(range(w * h), k=n)])
+    return picked
+
+def sample_size(error: float) -> int:
+    '''The pixels to sample for each bin's share to be within error, with CONFIDENCE'''
+    return math.ceil(math.log(2 / (1 - CONFIDENCE)) / (2 * error * error))
+
+def strips(img: Image.Image):
+    '''img a band of rows at a time, about STRIP_PIXELS in each'''
+    step = max(1, STRIP_PIXELS // img.size[0])
+    for top in range(0, img.size[1], step):
+        yield img.crop((0, top, img.size[0], min(top + step, img.size[1])))
@@ -0,0 +1,637 @@
+'''Deferred image operations.
+
+The image primitives in interp.py do not compute pixels any more. Each one
+returns a LazyImage: an operation node over its inputs (other LazyImages, or
+decoded Image.Images), whose size and mode are known without computing it.
+Pixels are produced only when something needs them (report/run, Show, Eq,
+or saving) by force(), which first rewrites the graph:
+  - rotations are lossless quarter-turn transposes (a non-square image
+    swaps width and height), kept as orientation metadata: point operations
+    and blur commute with a quarter turn, so the turns accumulate past them
+    and every run of rotations costs at most one transpose, where the
+    orientation finally has to be applied (a combine, or the result);
+  - any run of point operations (invert, lighten, darken) on an L or RGB
+    image becomes one 256-entry lookup table, applied in one Image.point
+    pass, or no pass at all if the table is the identity (invert(invert(x)));
+  - nested combines become one combine of all their sources, side by side,
+    so a strip of n images allocates its canvas once and copies each source
+    into it once, rather than copying the early ones again at every level;
+  - a crop's box is pushed back through point operations, blur (with the
+    two rows and columns of context its kernel reads), rotations and
+    combines, so each node is computed only over the part of it that reaches
+    the result (the union, if it has several consumers), and a file needed
+    only in part is read in part (region()), just those rows, when it is
+    stored uncompressed; any other is decoded whole, once, and kept on its
+    node (the registry's handle), so later crops cut from the kept image;
+  - a resize's target size is pushed back through point operations,
+    rotations and combines to the files the graph starts from, and a file
+    needed at 1/2, 1/4 or 1/8 of its size or less is decoded that much
+    smaller (draft()), by Pillow's JPEG DCT scaling, or for other formats by
+    a box reduce straight after decoding, and the smaller decode is kept on
+    the file node for the next resize; blur is not passed through, since
+    blurring a smaller image blurs more of the picture;
+and then computes each remaining node once, keeping the result, so a graph
+shared by several consumers is not recomputed. Inside a parallel() block the
+nodes are computed on a thread pool instead, each as soon as its inputs are
+ready, so independent branches (the two sides of a combine, say) run at the
+same time; Pillow releases the GIL while it works on pixels. The graph has
+no side effects, so only the interpreter's own order (Show, Read, Assign)
+matters, and that does not change. A large image under blur or a point
+operation is also split into horizontal strips computed side by side, each
+read with the rows of context its kernel needs, so even a single operation
+uses every thread; the stitched result is exactly the single-call one.
+
+Inside a caching() block, force() also looks each node up in a ResultCache
+(result_cache.py) before computing it, from the top of the graph down, so
+a cached result saves computing everything under it too, and stores what it
+does compute there. The key is the node's digest: a hash of its operation
+and argument over the digests of its inputs, which for a decoded image is a
+hash of its pixels and for a file of its path, size and modification time.
+When the environment turns it on, a DiskCache (disk_cache.py) is consulted
+the same way, after any ResultCache, so results outlive the process and are
+shared by every process using the same directory.
+
+A point operation's table is read off the operation itself, applied to a
+0..255 ramp, so a fused chain gives exactly the pixels of running the
+operations one by one, clipping and rounding included.'''
+
+import hashlib
+import os
+import weakref
+from concurrent.futures import Executor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from functools import cache
+from typing import Iterator
+from PIL import Image, ImageEnhance, ImageFilter, ImageOps
+import disk_cache
+
+type Pixels = Image.Image | LazyImage
+# left, top, right and bottom, as Pillow gives boxes
+type Box = tuple[int, int, int, int]
+
+# pixel passes done by force(), for tests and benchmarks
+passes = 0
+
+# the thread pool force() computes on, inside a parallel() block
+pool: Executor | None = None
+
+# the ResultCache force() looks nodes up in and stores them in, inside a caching() block
+results = None
+
+# the DiskCache force() looks nodes up in and stores them in, if the environment asks for one
+disk = disk_cache.from_env()
+
+class LazyImage:
+    __slots__ = ("op", "inputs", "arg", "size", "mode", "image", "digest", "drafted", "__weakref__")
+
+    def __init__(self, op: str, inputs: tuple[Pixels, ...], arg=None,
+                 size: tuple[int, int] | None = None, mode: str | None = None):
+        self.op = op
+        self.inputs = inputs
+        self.arg = arg                  # quarter turns for rotate, factor for brightness, table for point,
+                                        # path for file, (path, scale) for draft, size for resize,
+                                        # box for crop, (path, box) for region, (mode, lefts) for paste
+        self.size = size or inputs[0].size
+        self.mode = mode or inputs[0].mode
+        self.image: Image.Image | None = None   # once forced
+        self.digest: bytes | None = None        # once needed, see digest()
+        self.drafted: dict[int, LazyImage] | None = None    # a file's draft() nodes, by scale
+
+    @property
+    def width(self) -> int:
+        return self.size[0]
+
+    @property
+    def height(self) -> int:
+        return self.size[1]
+
+    def __repr__(self) -> str:
+        return f"LazyImage({self.op}{"" if self.arg is None else f" {self.arg}"}, {self.size}, {self.mode})"
+
+
+def is_image(v) -> bool:
+    return isinstance(v, (Image.Image, LazyImage))
+
+def pending(v) -> bool:
+    '''A LazyImage that has not been computed yet'''
+    return isinstance(v, LazyImage) and v.image is None
+
+# the operations, as the interp.py primitives build them
+
+def file(path: str) -> LazyImage:
+    '''The image in file path, decoded only when computed (see also stream.py)'''
+    with Image.open(path) as img:
+        return LazyImage("file", (), str(path), img.size, img.mode)
+
+def rotate(img: Pixels, turns: int = 1) -> LazyImage:
+    w, h = img.size
+    return LazyImage("rotate", (img,), turns, (h, w) if turns % 2 else (w, h))
+
+def invert(img: Pixels) -> LazyImage:
+    return LazyImage("invert", (img,))
+
+def brightness(img: Pixels, factor: float) -> LazyImage:
+    return LazyImage("brightness", (img,), factor)
+
+def point(img: Pixels, lut: tuple[int, ...]) -> LazyImage:
+    return LazyImage("point", (img,), lut)
+
+def resize(img: Pixels, size: tuple[int, int]) -> LazyImage:
+    return LazyImage("resize", (img,), size, size)
+
+def draft(source: LazyImage, scale: int) -> LazyImage:
+    '''File node source, decoded at 1/scale of its width and height (rounded up).
+    The node is kept on source, so, like a whole decode, each scale of a file
+    is decoded once for as long as its handle lives'''
+    if source.drafted is None:
+        source.drafted = {}
+    if scale not in source.drafted:
+        w, h = source.size
+        source.drafted[scale] = LazyImage("draft", (), (source.arg, scale), (-(-w // scale), -(-h // scale)), source.mode)
+    return source.drafted[scale]
+
+def crop(img: Pixels, box: Box) -> LazyImage:
+    left, top, right, bottom = box
+    return LazyImage("crop", (img,), box, (right - left, bottom - top))
+
+def region(source: LazyImage, box: Box) -> LazyImage:
+    '''The pixels in box of file node source, an uncompressed one (see
+    stream.seekable), reading only the rows of box'''
+    left, top, right, bottom = box
+    return LazyImage("region", (), (source.arg, box), (right - left, bottom - top), source.mode)
+
+def blur(img: Pixels) -> LazyImage:
+    return LazyImage("blur", (img,))
+
+def combine(*imgs: Pixels) -> LazyImage:
+    return LazyImage("combine", imgs, None,
+                     (sum(i.size[0] for i in imgs), max(i.size[1] for i in imgs)),
+                     joint_mode([i.mode for i in imgs]))
+
+def paste(imgs: list[Pixels], lefts: list[int], size: tuple[int, int], mode: str) -> LazyImage:
+    '''imgs side by side on a blank canvas of this size and mode, each at its left, along the top'''
+    return LazyImage("paste", tuple(imgs), (mode, tuple(lefts)), size, mode)
+
+def joint_mode(modes: list[str]) -> str:
+    '''The mode of a combine of images in these modes: their own if they
+    share one, otherwise RGB, or RGBA if any of them has transparency'''
+    if len(set(modes)) == 1 and modes[0] not in ("P", "PA"):    # palettes may differ
+        return modes[0]
+    return "RGBA" if any(m in ("RGBA", "LA", "PA", "La", "RGBa") for m in modes) else "RGB"
+
+
+def postorder(root: Pixels, cached=None) -> Iterator[LazyImage]:
+    '''The pending nodes of the graph under root, each once, inputs first.
+    A node for which cached(x) is true, when first reached, is left out along
+    with anything only it leads to.'''
+    seen = set()
+    stack = [(root, False)]
+    while stack:
+        x, done = stack.pop()
+        if not pending(x):
+            continue
+        if done:
+            yield x
+        elif id(x) not in seen:
+            seen.add(id(x))
+            if cached is not None and cached(x):
+                continue
+            stack.append((x, True))
+            stack.extend((i, False) for i in reversed(x.inputs))
+
+# an image as rewrite sees it: a core graph with no rotation on top, and the
+# quarter turns still to apply to it
+type Form = tuple[Pixels, int]
+
+def rewrite(root: Pixels) -> Pixels:
+    '''root with the fusion rules applied throughout'''
+    root = crops(root)
+    sources = drafts(root)
+    forms: dict[int, Form] = {id(x): (d, 0) for x, d in sources}
+    rotated: dict[tuple[int, int], Pixels] = {}
+
+    def form(x: Pixels) -> Form:
+        return forms.get(id(x), (x, 0))
+
+    def upright(f: Form) -> Pixels:
+        '''The pixels of form f, with its orientation applied'''
+        core, turns = f
+        if turns == 0:
+            return core
+        key = (id(core), turns)     # so a shared rotation is done once
+        if key not in rotated:
+            rotated[key] = rotate(core, turns)
+        return rotated[key]
+
+    for x in postorder(root):
+        if id(x) not in forms:
+            forms[id(x)] = simplify(x, [form(i) for i in x.inputs], upright)
+    return upright(form(root))
+
+def crops(root: Pixels) -> Pixels:
+    '''root with each node computed over only the box of it that some crop
+    above it keeps, or root itself if there are no crops'''
+    import stream
+    nodes = list(postorder(root))
+    if not any(x.op == "crop" for x in nodes):
+        return root
+    need: dict[int, Box] = {id(root): (0, 0) + root.size}
+    for x in reversed(nodes):   # consumers first
+        if id(x) in need:       # not, for a combine source left of and right of every box
+            for i, box in wants(x, need[id(x)]):
+                need[id(i)] = union(need[id(i)], box) if id(i) in need else box
+    new: dict[int, Pixels] = {}
+
+    def part(i: Pixels, box: Box) -> Pixels:
+        '''The pixels in box of input i, from its new node'''
+        have, r = (need[id(i)], new[id(i)]) if id(i) in new else ((0, 0) + i.size, i)
+        if box == have:
+            return r
+        left, top = have[:2]
+        return crop(r, (box[0] - left, box[1] - top, box[2] - left, box[3] - top))
+
+    for x in nodes:
+        if id(x) not in need:
+            continue
+        box = need[id(x)]
+        whole = box == (0, 0) + x.size
+        wanted = wants(x, box)
+        match x.op:
+            case "file":
+                # a compressed file can only be decoded whole: the file node
+                # itself is, so it keeps the pixels for the next crop of it
+                y = x if whole else region(x, box) if stream.seekable(x.arg) else crop(x, box)
+            case "crop":
+                y = part(*wanted[0])
+            case "invert" | "brightness" | "point":
+                y = same(x, [part(*wanted[0])])
+            case "rotate":
+                y = rotate(part(*wanted[0]), x.arg)
+            case "blur":
+                i, around = wanted[0]
+                y = same(x, [part(i, around)])
+                if around != box:
+                    y = crop(y, (box[0] - around[0], box[1] - around[1], box[2] - around[0], box[3] - around[1]))
+            case "combine" if not whole:
+                placed = sources(x, box)
+                y = paste([part(i, b) for i, b, _ in placed], [at + b[0] - box[0] for _, b, at in placed],
+                          (box[2] - box[0], box[3] - box[1]), x.mode)
+            case _:
+                y = same(x, [part(i, b) for i, b in wanted])
+                if not whole:
+                    y = crop(y, box)
+        new[id(x)] = y
+    return new[id(root)]
+
+def wants(x: LazyImage, box: Box) -> list[tuple[Pixels, Box]]:
+    '''The inputs of x that the pixels in box of x are computed from, each
+    with the box of it they need'''
+    left, top, right, bottom = box
+    match x.op:
+        case "crop":
+            dx, dy = x.arg[:2]
+            return [(x.inputs[0], (left + dx, top + dy, right + dx, bottom + dy))]
+        case "invert" | "brightness" | "point":
+            return [(x.inputs[0], box)]
+        case "rotate":
+            return [(x.inputs[0], unturned(box, x.inputs[0].size, x.arg))]
+        case "blur":
+            halo = STRIPWISE["blur"]
+            w, h = x.size
+            return [(x.inputs[0], (max(0, left - halo), max(0, top - halo), min(right + halo, w), min(bottom + halo, h)))]
+        case "combine":
+            return [(i, b) for i, b, _ in sources(x, box)]
+    return [(i, (0, 0) + i.size) for i in x.inputs]
+
+def sources(x: LazyImage, box: Box) -> list[tuple[Pixels, Box, int]]:
+    '''The sources of combine x with pixels in box, each with the box of
+    it that is in box and where it starts in x'''
+    left, top, right, bottom = box
+    found = []
+    for i, at in zip(x.inputs, offsets(x.inputs)):
+        w, h = i.size
+        if left < at + w and at < right and top < h:
+            found.append((i, (max(left, at) - at, top, min(right, at + w) - at, min(bottom, h)), at))
+    return found
+
+def unturned(box: Box, size: tuple[int, int], turns: int) -> Box:
+    '''The box of an image of this size that turns into box when it is
+    rotated by turns quarter turns'''
+    left, top, right, bottom = box
+    w, h = size
+    return [box, (w - bottom, left, w - top, right), (w - right, h - bottom, w - left, h - top),
+            (top, h - right, bottom, h - left)][turns % 4]
+
+def union(a: Box, b: Box) -> Box:
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+def offsets(imgs) -> Iterator[int]:
+    '''Where each of imgs starts, side by side in a combine'''
+    left = 0
+    for i in imgs:
+        yield left
+        left += i.size[0]
+
+# operations whose input is needed at the same scale as their output
+SCALE_FREE = ("invert", "brightness", "point", "rotate", "combine")
+# the sizes decoders can shrink to, and the modes draft() decodes
+DRAFT_SCALES = (8, 4, 2)
+DRAFT_MODES = ("L", "RGB", "RGBA")
+
+def drafts(root: Pixels) -> list[tuple[LazyImage, LazyImage]]:
+    '''The files under root that are only needed smaller, each with a
+    draft() node to use in its place'''
+    nodes = list(postorder(root))
+    need = {id(root): 1.0}      # the fraction of its size each node is needed at
+    for x in reversed(nodes):   # consumers first
+        f = need[id(x)]
+        if x.op == "resize":
+            (w, h), (iw, ih) = x.size, x.inputs[0].size
+            f *= max(w / iw, h / ih)
+        elif x.op not in SCALE_FREE:
+            f = 1.0
+        for i in x.inputs:
+            need[id(i)] = max(need.get(id(i), 0.0), min(f, 1.0))
+    found = []
+    for x in nodes:
+        if x.op == "file" and x.mode in DRAFT_MODES:
+            scale = next((s for s in DRAFT_SCALES if s * need[id(x)] <= 1), 1)
+            if scale > 1:
+                found.append((x, draft(x, scale)))
+    return found
+
+def simplify(x: LazyImage, inputs: list[Form], upright) -> Form:
+    '''The form of x over the forms of its rewritten inputs'''
+    if not inputs:
+        return x, 0
+    core, turns = inputs[0]
+    match x.op:
+        case "rotate":
+            return core, (turns + x.arg) % 4
+        case "invert" | "brightness" | "point" if x.mode in LUT_MODES:
+            lut = table(x)
+            if pending(core) and core.op == "point":
+                lut = tuple(lut[v] for v in core.arg)     # core's table, then x's
+                core = core.inputs[0]
+            return (core if lut == IDENTITY else point(core, lut)), turns
+        case "invert" | "brightness" | "blur":
+            # per-pixel, or a kernel that is symmetric under quarter turns
+            return same(x, [core]), turns
+        case "combine":
+            # mode conversion is per pixel, so converting the sources of an
+            # inner combine gives the pixels of converting its result
+            sources = []
+            for f in inputs:
+                i = upright(f)
+                sources.extend(i.inputs if pending(i) and i.op == "combine" else [i])
+            heights = {i.size[1] for i in sources}
+            if len(heights) > 1 and len({i.size[1] for i in x.inputs}) == 1:
+                # drafts of different files came out a row apart: match them
+                height = min(heights)
+                sources = [i if i.size[1] == height else resize(i, (max(1, round(i.size[0] * height / i.size[1])), height))
+                           for i in sources]
+            return same(x, sources), 0
+        case _:
+            return same(x, [upright(f) for f in inputs]), 0
+
+def same(x: LazyImage, inputs: list[Pixels]) -> LazyImage:
+    '''x over inputs, reusing x itself (and so any result it keeps) if they are its own'''
+    if len(inputs) == len(x.inputs) and all(a is b for a, b in zip(inputs, x.inputs)):
+        return x
+    if x.op == "combine":
+        return combine(*inputs)
+    return LazyImage(x.op, tuple(inputs), x.arg, x.size if x.op in ("resize", "crop", "paste") else inputs[0].size, x.mode)
+
+def force(v):
+    '''v with any LazyImage computed; other values are returned as they are'''
+    if not pending(v):
+        return v.image if isinstance(v, LazyImage) else v
+    r = rewrite(v)
+    nodes = postorder(r) if results is None and disk is None else postorder(r, from_cache)
+    if pool is None:
+        for x in nodes:
+            x.image = compute(x)
+    else:
+        compute_all(pool, list(nodes))
+    v.image = r.image if isinstance(r, LazyImage) else r
+    return v.image
+
+def from_cache(x: LazyImage) -> bool:
+    '''Whether x's result was in a cache; if so x keeps it'''
+    key = digest(x)
+    x.image = results.get(key) if results is not None else None
+    if x.image is None and disk is not None:
+        x.image = disk.get(key)
+        if x.image is not None and results is not None:
+            results.put(key, x.image)
+    return x.image is not None
+
+def to_cache(x: LazyImage) -> None:
+    if results is not None:
+        results.put(digest(x), x.image)
+    if disk is not None:
+        disk.put(digest(x), x.image)
+
+def compute(x: LazyImage) -> Image.Image:
+    global passes
+    passes += 1
+    x.image = apply(*task(x))
+    to_cache(x)
+    return x.image
+
+def task(x: LazyImage) -> tuple:
+    '''The arguments of apply() that compute x, once its inputs are computed'''
+    return x.op, x.arg, [i.image if isinstance(i, LazyImage) else i for i in x.inputs], x.size
+
+def compute_all(pool: Executor, nodes: list[LazyImage]) -> None:
+    '''Computes nodes (in postorder) on pool, each once all of its inputs are'''
+    global passes
+    waiting = {}                        # id -> inputs still to be computed
+    consumers = {id(x): [] for x in nodes}
+    for x in nodes:
+        inputs = {id(i) for i in x.inputs if pending(i)}
+        waiting[id(x)] = len(inputs)
+        for i in inputs:
+            consumers[i].append(x)
+    running = {}                        # future -> its node, and the top row of its strip if it is one
+    parts = {}                          # id -> the canvas of a node computed in strips, and strips left
+
+    def start(x: LazyImage) -> None:
+        op, arg, inputs, size = task(x)
+        if op in STRIPWISE and inputs[0].mode != "P" and size[0] * size[1] > STRIP_PIXELS:
+            rows = strips(size, STRIPWISE[op])
+            parts[id(x)] = [Image.new(x.mode, size), len(rows)]
+            for top, bottom, above, below in rows:
+                running[pool.submit(apply_strip, op, arg, inputs[0], top, bottom, above, below)] = x, top
+        else:
+            running[pool.submit(apply, op, arg, inputs, size)] = x, None
+
+    for x in nodes:
+        if waiting[id(x)] == 0:
+            start(x)
+    try:
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for f in done:
+                x, top = running.pop(f)
+                if top is not None:
+                    part = parts[id(x)]
+                    part[0].paste(f.result(), (0, top))
+                    part[1] -= 1
+                    if part[1]:
+                        continue
+                    x.image = parts.pop(id(x))[0]
+                else:
+                    x.image = f.result()
+                passes += 1
+                to_cache(x)
+                for c in consumers[id(x)]:
+                    waiting[id(c)] -= 1
+                    if waiting[id(c)] == 0:
+                        start(c)
+    finally:
+        for f in running:
+            f.cancel()
+
+@contextmanager
+def caching(c) -> Iterator[None]:
+    '''Looks up and stores whatever is forced in the block in ResultCache c'''
+    global results
+    outer = results
+    results = c
+    try:
+        yield
+    finally:
+        results = outer
+
+@contextmanager
+def parallel(workers: int) -> Iterator[None]:
+    '''Computes whatever is forced in the block on up to `workers` threads'''
+    global pool
+    outer = pool
+    with ThreadPoolExecutor(workers, thread_name_prefix="imageops") as pool:
+        try:
+            yield
+        finally:
+            pool = outer
+
+def apply(op: str, arg, inputs: list[Image.Image], size: tuple[int, int]) -> Image.Image:
+    if op == "file":
+        with Image.open(arg) as img:
+            img.load()
+            return img
+    if op == "draft":
+        path, scale = arg
+        with Image.open(path) as img:
+            img.draft(img.mode, (img.size[0] // scale, img.size[1] // scale))    # a no-op but for JPEG
+            img.load()
+            return img if img.size == size else img.reduce(scale)
+    if op == "region":
+        import stream
+        path, (left, top, right, bottom) = arg
+        return stream.read_rows(path, top, bottom).crop((left, 0, right, bottom - top))
+    img = inputs[0] if inputs else None     # a paste may have nothing to paste
+    match op:
+        case "rotate":
+            return img.transpose(QUARTER_TURNS[arg % 4]) if arg % 4 else img
+        case "invert":
+            return ImageOps.invert(img)
+        case "brightness":
+            return ImageEnhance.Brightness(img).enhance(arg)
+        case "point":
+            return img.point(list(arg) * len(img.getbands()))
+        case "blur":
+            return img.filter(ImageFilter.BLUR)
+        case "resize":
+            return img.resize(arg)
+        case "crop":
+            return img.crop(arg)
+        case "combine" | "paste":
+            mode, lefts = arg if op == "paste" else (joint_mode([i.mode for i in inputs]), offsets(inputs))
+            combined = Image.new(mode, size)
+            for img, left in zip(inputs, lefts):
+                combined.paste(img if img.mode == mode else img.convert(mode), (left, 0))
+            return combined
+    raise ValueError(f"unknown image operation: {op}")
+
+QUARTER_TURNS = {1: Image.Transpose.ROTATE_90, 2: Image.Transpose.ROTATE_180, 3: Image.Transpose.ROTATE_270}
+
+
+# strips
+
+# the operations that can be computed a strip of rows at a time, with the rows
+# of context each strip needs above and below it (blur's kernel is 5x5)
+STRIPWISE = {"invert": 0, "brightness": 0, "point": 0, "blur": 2}
+# the pixels in a strip, when the pool splits an image into strips
+STRIP_PIXELS = 1 << 20
+
+def strips(size: tuple[int, int], halo: int) -> list[tuple[int, int, int, int]]:
+    '''The rows (top, bottom) of each strip of an image of this size, and the
+    rows (above, below) to read for it, halo more on each side where there are any'''
+    width, height = size
+    step = max(1, STRIP_PIXELS // max(1, width))
+    return [(top, min(top + step, height), max(0, top - halo), min(top + step + halo, height))
+            for top in range(0, height, step)]
+
+def apply_strip(op: str, arg, img: Image.Image, top: int, bottom: int, above: int, below: int) -> Image.Image:
+    '''Rows top..bottom of op applied to img, computed from rows above..below only'''
+    out = apply(op, arg, [img.crop((0, above, img.width, below))], (img.width, below - above))
+    return out if (above, below) == (top, bottom) else out.crop((0, top - above, img.width, bottom - above))
+
+
+# point operations
+
+# modes whose point operations treat every band alike, so one table serves all
+LUT_MODES = ("L", "RGB")
+IDENTITY = tuple(range(256))
+
+def table(x: LazyImage) -> tuple[int, ...]:
+    '''The lookup table of point operation x'''
+    return x.arg if x.op == "point" else op_table(x.op, x.arg)
+
+@cache
+def op_table(op: str, arg) -> tuple[int, ...]:
+    ramp = Image.new("L", (256, 1))
+    ramp.frombytes(bytes(IDENTITY))
+    return tuple(apply(op, arg, [ramp], ramp.size).tobytes())
+
+
+# digests
+
+# content digests of decoded images, by id, dropped when the image is
+_pixel_digests: dict[int, bytes] = {}
+
+def digest(v: Pixels) -> bytes:
+    '''A hash of v's pixels, worked out from its graph where it is pending'''
+    if not isinstance(v, LazyImage):
+        return pixel_digest(v)
+    if v.digest is None:
+        if pending(v):
+            for x in postorder(v):      # inputs first, so each needs one step
+                if x.digest is None:
+                    x.digest = node_digest(x)
+        else:
+            v.digest = pixel_digest(v.image)
+    return v.digest
+
+def node_digest(x: LazyImage) -> bytes:
+    arg = x.arg
+    if x.op in ("file", "draft", "region"):
+        path = arg if x.op == "file" else arg[0]
+        st = os.stat(path)
+        arg = (os.path.abspath(path), st.st_size, st.st_mtime_ns, arg)
+    h = hashlib.blake2b(repr((x.op, arg, x.size, x.mode)).encode(), digest_size=20)
+    for i in x.inputs:
+        h.update(digest(i))
+    return h.digest()
+
+def pixel_digest(img: Image.Image) -> bytes:
+    key = id(img)
+    if key not in _pixel_digests:
+        h = hashlib.blake2b(repr((img.size, img.mode)).encode(), digest_size=20)
+        h.update(img.tobytes())
+        if img.palette is not None:
+            h.update(img.palette.tobytes())
+        _pixel_digests[key] = h.digest()
+        weakref.finalize(img, _pixel_digests.pop, key, None)
+    return _pixel_digests[key]
@@ -1,20 +1,149 @@
-from dataclasses import dataclass
-from PIL import Image, ImageEnhance, ImageFilter, ImageOps
+from dataclasses import dataclass, field, fields, MISSING
+import gc
+import sys
+from PIL import Image
+import imageops
+from imageops import LazyImage, is_image, force
+from result_cache import ResultCache
+import registry
+import dominant
 
 #new value with info 
 type Color = image_color | dom_color
-type Literal = Name | Image.Image
+type Literal = Name | Image.Image | LazyImage
 type Expr = Add | Sub | Mul | Div | Lit | Let  | Neg | And | Or | Not | Eq | Lt | If | Letfun | App | Ifnz | Assign | Read | Show | Seq
 
 
-@dataclass
-class dom_color():
+# AST nodes are hash-consed: calling a node class goes through Node.__new__,
+# which hands back the existing node if one with the same fields is alive, so
+# structurally equal subtrees are one shared object. Nodes are frozen and
+# slotted (no per-instance __dict__), and carry a hash computed once, when
+# they are built, from their fields' hashes (a child's stored hash, so
+# hashing is O(arity), not O(subtree)). Equal nodes are almost always
+# identical, so comparing them is an identity check.
+
+# node hash -> the shared node with that hash
+_nodes: dict[int, "Node"] = {}
+_sweep_at = 1 << 16
+
+def sweep() -> None:
+    '''Drops the nodes that nothing but the table refers to any more. A node
+    is added after its children, so going newest first frees a whole dead
+    subtree in one pass.'''
+    global _sweep_at
+    for h in reversed(list(_nodes)):
+        if sys.getrefcount(_nodes[h]) <= 2:    # the table's and getrefcount's own
+            del _nodes[h]
+    _sweep_at = max(1 << 16, 2 * len(_nodes))
+
+def _sweep_after_collection(phase: str, info: dict) -> None:
+    # the table keeps dead nodes, and the images and handles in them, until
+    # a sweep; a full collection (gc.collect(), or the collector's own rare
+    # ones) is as good a time as any, since it walks every object anyway
+    if phase == "stop" and info["generation"] == 2:
+        sweep()
+
+gc.callbacks.append(_sweep_after_collection)
+
+def field_hash(v) -> int:
+    t = type(v)
+    if t is str or t is int:
+        return hash(v)
+    if isinstance(v, Node):
+        return v._hash
+    if t is bool:
+        return hash((bool, v))  # Lit(True) and Lit(1) are different nodes
+    if isinstance(v, list):
+        return hash((list, *map(field_hash, v)))
+    if type(v).__hash__ is None:
+        return id(v)            # images: the node keeps the image alive, so its id is stable
+    return hash(v)
+
+def same(a, b) -> bool:
+    '''Whether field values a and b make the same node'''
+    if a is b:
+        return True
+    if (type(a) is bool) != (type(b) is bool) or type(a).__hash__ is None or type(b).__hash__ is None:
+        return False
+    return a == b
+
+class Node:
+    __slots__ = ("_hash",)
+
+    def __new__(cls, *args, **kwargs):
+        if kwargs or len(args) != len(cls.__match_args__):
+            args = cls.fields_of(*args, **kwargs)
+        h = hash((cls.__name__, *[field_hash(v) for v in args]))
+        n = _nodes.get(h)
+        if type(n) is cls:
+            for f, v in zip(cls.__match_args__, args):
+                w = getattr(n, f)
+                if w is not v and not same(w, v):
+                    break
+            else:
+                return n
+        n = object.__new__(cls)
+        for f, v in zip(cls.__match_args__, args):
+            object.__setattr__(n, f, v)
+        object.__setattr__(n, "_hash", h)
+        # on a hash collision the newer node becomes the shared one; the
+        # other stays valid and still compares equal structurally
+        _nodes[h] = n
+        if len(_nodes) > _sweep_at:
+            sweep()
+        return n
+
+    @classmethod
+    def fields_of(cls, *args, **kwargs) -> tuple:
+        '''The constructor arguments as a tuple of every field, defaults filled in'''
+        fs = fields(cls)
+        if len(args) > len(fs):
+            raise TypeError(f"{cls.__name__}() takes {len(fs)} arguments")
+        values = list(args)
+        for f in fs[len(args):]:
+            if f.name in kwargs:
+                values.append(kwargs.pop(f.name))
+            elif f.default is not MISSING:
+                values.append(f.default)
+            else:
+                raise TypeError(f"{cls.__name__}() missing argument {f.name!r}")
+        if kwargs:
+            raise TypeError(f"{cls.__name__}() got unexpected arguments {", ".join(kwargs)}")
+        return tuple(values)
+
+    def __hash__(self) -> int:
+        return self._hash
+
+    def __eq__(self, other) -> bool:
+        # interned nodes are equal only if identical; the structural check
+        # is for the rare node that lost its place to a hash collision
+        if self is other:
+            return True
+        if type(other) is not type(self) or other._hash != self._hash:
+            return False
+        return all(same(getattr(self, f), getattr(other, f)) for f in self.__match_args__)
+
+    def __reduce__(self):
+        # unpickling goes through the factory too, so it re-interns
+        return (type(self), tuple(getattr(self, f) for f in self.__match_args__))
+
+# the factory is Node.__new__, so dataclass must not generate an __init__
+node = dataclass(frozen=True, slots=True, eq=False, init=False)
+
+def node_count() -> int:
+    '''How many distinct nodes are alive'''
+    sweep()
+    return len(_nodes)
+
+
+@node
+class dom_color(Node):
     image : Image.Image
     def __str__(self):
         return f"Dominant_Color({self.image})"
 
-@dataclass
-class image_color():
+@node
+class image_color(Node):
     image : Image.Image
     def __str__(self) -> str:
         return f"Color({self.image})"
@@ -24,40 +153,62 @@ type Action = Rotate | Combine
 #newly created operators
 type new_Action  = Lighten | Darken | Blur | Invert
 
-@dataclass
-class Blur():
+@node
+class Blur(Node):
     image : Image.Image
     def __str__(self):
         return f"Blur({self.image})"
     
-@dataclass
-class Invert():
+@node
+class Invert(Node):
     image : Image.Image
     def __str__(self):
         return f"Invert({self.image})"
     
-@dataclass
-class Darken():
+@node
+class Darken(Node):
     image : Image.Image
     def __str__(self):
         return f"Darken({self.image})"
 
-@dataclass
-class Lighten():
+@node
+class Lighten(Node):
     image : Expr
     def __str__(self):
         return f"lighte{self.image}"
 
 
-@dataclass
-class Rotate():
+@node
+class Rotate(Node):
     image : Image.Image
     def __str__(self):
         return f"rotate({self.image})"
 
 
-@dataclass
-class Combine():
+@node
+class Resize(Node):
+    image : Expr
+    width : Expr
+    height : Expr
+
+    def __str__(self):
+        return f"resize({self.image}, {self.width}, {self.height})"
+
+
+@node
+class Crop(Node):
+    image : Expr
+    left : Expr
+    top : Expr
+    width : Expr
+    height : Expr
+
+    def __str__(self):
+        return f"crop({self.image}, {self.left}, {self.top}, {self.width}, {self.height})"
+
+
+@node
+class Combine(Node):
     image1 : Image.Image
     image2 : Image.Image
 
@@ -65,30 +216,40 @@ class Combine():
         return f"combine({self.image1}, {self.image2})"
 
 
-@dataclass
-class Show():
+@node
+class Show(Node):
     image : Expr | Image.Image
     def __str__(self):
         return f"Show({self.image})"
 
 
-@dataclass
-class Read():
-    expr : str
+@node
+class Read(Node):
+    expr : str = ""
     def __str__(self):
         return f"Read({self.expr})"    
 
 
-@dataclass
-class Seq():
-    expr1 : Expr
-    expr2 : Expr
+@node
+class Seq(Node):
+    # flat, n-ary: Seq(a, Seq(b, c)) and Seq(Seq(a, b), c) both hold (a, b, c)
+    exprs : tuple[Expr, ...]
+    def __new__(cls, *exprs: Expr):
+        flat = []
+        for e in exprs:
+            if isinstance(e, Seq):
+                flat.extend(e.exprs)
+            else:
+                flat.append(e)
+        return Node.__new__(cls, tuple(flat))
+    def __reduce__(self):
+        return (Seq, self.exprs)
     def __str__(self):
-        return f"Seq({self.expr1}, {self.expr2})"
+        return f"Seq({", ".join(str(e) for e in self.exprs)})"
 
 
-@dataclass
-class If():
+@node
+class If(Node):
     condition : Expr
     then_branch : Expr
     else_branch : Expr
@@ -96,92 +257,92 @@ class If():
         return f"If({self.condition}, {self.then_branch}, {self.else_branch})"
 
 
-@dataclass
-class Lt():
+@node
+class Lt(Node):
     left : Expr
     right : Expr
     def __str__(self):
         return f"lt({self.left}, {self.right})"
 
 
-@dataclass
-class Eq():
+@node
+class Eq(Node):
     left : Expr
     right : Expr
     def __str__(self):
         return f"Eq({self.left}, {self.right})"
 
 
-@dataclass
-class Not():
+@node
+class Not(Node):
     value : Expr
     def __str__(self) -> str:
         return f"Not({self.value})"
 
 
-@dataclass
-class Or():
+@node
+class Or(Node):
     left : Expr
     right : Expr
     def __str__(self) -> str:
         return f"or({self.left}, {self.right})"
 
 
-@dataclass
-class And():
+@node
+class And(Node):
     left : Expr
     right : Expr
     def __str__(self):
         return f"and({self.left}, {self.right})"
 
-@dataclass
-class Neg():
+@node
+class Neg(Node):
     value : Expr
     def __str__(self):
         return f"Neg({self.value})"
 
 
-@dataclass
-class Add():
+@node
+class Add(Node):
     left : Expr
     right : Expr
     def __str__(self):
         return f"Add({self.left}, {self.right})"
 
 
-@dataclass
-class Sub():
+@node
+class Sub(Node):
     left : Expr
     right : Expr
     def __str__(self):
         return f"Sub({self.left}, {self.right})"
 
 
-@dataclass
-class Mul():
+@node
+class Mul(Node):
     left : Expr
     right : Expr
     def __str__(self) -> str:
         return f"Mul({self.left}, {self.right})"
 
 
-@dataclass
-class Div():
+@node
+class Div(Node):
     left : Expr
     right : Expr
     def __str__(self):
         return f"Div({self.left}, {self.right})"
 
 
-@dataclass
-class Lit():
-    value : int | bool | Image.Image
+@node
+class Lit(Node):
+    value : int | bool | Image.Image | LazyImage
     def __str__(self) -> str:
         return f"Literal({self.value})"
 
 
-@dataclass
-class Let():
+@node
+class Let(Node):
     name : str
     value : Expr
     body : Expr
@@ -189,8 +350,8 @@ class Let():
         return f"(let {self.name} = {self.value} in {self.body})"
 
 
-@dataclass
-class Letfun():
+@node
+class Letfun(Node):
     name: str
     params: list[str]
     bodyexpr: Expr
@@ -198,30 +359,30 @@ class Letfun():
     def __str__(self) -> str:
         return f"letfun {self.name} ({",".join(self.params)}) = {self.bodyexpr} in {self.inexpr} end"
     
-@dataclass
-class App():
+@node
+class App(Node):
     fun: Expr
     args: Expr  # Change from list[Expr] to Expr to handle sequences
     def __str__(self) -> str:
         return f"({self.fun} ({self.args}))"
 
-@dataclass
-class Ifnz():
+@node
+class Ifnz(Node):
     cond: Expr
     thenexpr: Expr
     elseexpr: Expr
     def __str__(self) -> str:
         return f"(if {self.cond} != 0 then {self.thenexpr} else {self.elseexpr})"
     
-@dataclass
-class Name():
+@node
+class Name(Node):
     name : str
     def __str__(self):
         return self.name
 
 
-@dataclass
-class Assign():
+@node
+class Assign(Node):
     name: str
     value: Expr
     def __str__(self):
@@ -269,383 +430,481 @@ class Path:
     p: tuple[Action, ...]
 
 
-type Value = Image.Image | Path | Closure
+type Value = Image.Image | LazyImage | Path | Closure
 
 @dataclass
 class Closure:
     params: list[str]
     body: Expr
     env: Env[Value]
+    # compiled body, filled in by alternative backends (see compiler.py)
+    code: Any = field(default=None, compare=False, repr=False)
+
+# The primitive operations on values, shared by every evaluator. Image
+# operations are deferred: they return an imageops.LazyImage, computed only
+# when a Show, an Eq or report needs its pixels (see imageops.py)
+
+def show(img: Value) -> Value:
+    if is_image(img):
+        force(img).show()
+        return img
+    elif isinstance(img, bool):
+        print(img)
+        return img
+    elif isinstance(img, int):
+        print(img)
+        return img
+    else:
+        raise evalError("You must provide an image or a valid literal")
+
+def blur(img: Value) -> Value:
+    if is_image(img):
+        return imageops.blur(img)
+    else:
+        raise evalError("You must provide an image")
+
+def invert(img: Value) -> Value:
+    if is_image(img):
+        return imageops.invert(img)
+    else:
+        raise evalError("You must provide an image")
+
+def rotate(img: Value) -> Value:
+    if is_image(img):
+        return imageops.rotate(img)
+    else:
+        return evalError("You can only rotate Photos")
+
+def combine(img1: Value, img2: Value) -> Value:
+    if is_image(img1) and is_image(img2):
+        if img1.size[1] != img2.size[1]:
+            raise evalError("Images must have the same height")
+        return imageops.combine(img1, img2)
+    else:
+        raise evalError("Both operands must be images")
+
+def resize(img: Value, width: Value, height: Value) -> Value:
+    if not is_image(img):
+        raise evalError("You can only resize Photos")
+    if type(width) != int or type(height) != int or width <= 0 or height <= 0:
+        raise evalError("Resize requires a positive integer width and height")
+    return imageops.resize(img, (width, height))
+
+def crop(img: Value, left: Value, top: Value, width: Value, height: Value) -> Value:
+    if not is_image(img):
+        raise evalError("You can only crop Photos")
+    if any(type(v) != int for v in (left, top, width, height)) or left < 0 or top < 0 \
+            or width <= 0 or height <= 0 or left + width > img.size[0] or top + height > img.size[1]:
+        raise evalError("Crop requires a box of integers inside the Photo")
+    return imageops.crop(img, (left, top, left + width, top + height))
+
+def dominant_color(img: Value) -> Value:
+    if not is_image(img):
+        raise evalError("You must provide an image")
+    # the fullest bin of alike colors (see dominant.py): an (R, G, B) tuple, or a gray level
+    return dominant.dominant_color(force(img))
+
+def darken(img: Value) -> Value:
+    if is_image(img):
+        return imageops.brightness(img, 0.5)
+    else:
+        raise evalError("Darken requires an image")
+
+def lighten(img: Value) -> Value:
+    if is_image(img):
+        return imageops.brightness(img, 1.5)
+    else:
+        raise evalError("Lighten requires an image")
 
 def eval(e: Expr) -> Value:
     return evalInEnv(empty_env, e)
 
 def evalInEnv(env: Env[Value], e: Expr) -> Value:
-    match e:
-        case Seq(e1, e2):
-            evalInEnv(env, e1)
-            return evalInEnv(env, e2)
-
-        case Read(expr):
-            try:
-                return int(input(expr))
-            except ValueError:
-                raise evalError("Invalid input: expected an integer")
-
-        case Show(image):
-            img = evalInEnv(env, image)
-            if isinstance(img, Image.Image):
-                img.show()
-                return img
-            elif isinstance(img, bool):
-                print(img)
-                return img
-            elif isinstance(img, int):
-                print(img)
-                return img
-            else:
-                raise evalError("You must provide an image or a valid literal")
-
-        case Assign(name, value):
-            v = evalInEnv(env, value)
-            loc = lookupEnv(name, env)
-            if loc is None:
-                raise evalError(f"Name {name} not found")
-            if isinstance(getLoc(loc), Closure):
-                raise evalError(f"Cannot assign to function {name}")
-            setLoc(loc, v)
-            return v  # Ensure the correct return type
-
-        case Blur(image):
-            img = evalInEnv(env, image)
-            if isinstance(img, Image.Image):
-                return img.filter(ImageFilter.BLUR)
-            else:
-                raise evalError("You must provide an image")
-        case Invert(image):
-            img = evalInEnv(env, image)
-            if isinstance(img, Image.Image):
-                return ImageOps.invert(img)
-            else:
-                raise evalError("You must provide an image")
-        case dom_color(image):
-            image = eval(env, image)  # Evaluate the image expression
-            if isinstance(image, Image.Image):
-                dominant = image.getcolors(maxcolors=1000000)  # Get colors
-                if dominant:
-                    dominant_color = max(dominant, key=lambda x: x[0])[1]
-                    return dominant_color  # Return the dominant color as an (R, G, B) tuple
+    # Expressions in tail position (the last statement of a Seq, the body of
+    # a Let/Letfun/function call, the chosen If/Ifnz branch) are evaluated
+    # by looping with a new env and e instead of recursing, so tail-recursive
+    # letfun programs run in constant stack depth.
+    while True:
+        match e:
+            case Seq(exprs):
+                # a loop, not recursion, so the stack depth does not grow with the script
+                for i in range(len(exprs) - 1):
+                    evalInEnv(env, exprs[i])
+                e = exprs[-1]
+                continue
+
+            case Read(expr):
+                try:
+                    return int(input(expr))
+                except ValueError:
+                    raise evalError("Invalid input: expected an integer")
+
+            case Show(image):
+                return show(evalInEnv(env, image))
+
+            case Assign(name, value):
+                v = evalInEnv(env, value)
+                loc = lookupEnv(name, env)
+                if loc is None:
+                    raise evalError(f"Name {name} not found")
+                if isinstance(getLoc(loc), Closure):
+                    raise evalError(f"Cannot assign to function {name}")
+                setLoc(loc, v)
+                return v  # Ensure the correct return type
+
+            case Blur(image):
+                return blur(evalInEnv(env, image))
+            case Invert(image):
+                return invert(evalInEnv(env, image))
+            case dom_color(image):
+                return dominant_color(evalInEnv(env, image))
+
+            case image_color(image):
+                image = eval(env,img)
+                if isinstance(image, Image.Image): 
+                           # Convert image to RGB if it's not in that mode
+                    image = image.convert('RGB')
+                    # Get the pixel data
+                    pixels = np.array(image)
+                    # Calculate the average color
+                    avg_color = pixels.mean(axis=(0, 1))  # Mean along the height and width axes
+                    # Return the average color as a tuple (R, G, B)
+                    return tuple(map(int, avg_color)) 
                 else:
-                    raise evalError("No colors found in image")
-            else:
-                raise evalError("You must provide an image")
-
-        case image_color(image):
-            image = eval(env,img)
-            if isinstance(image, Image.Image): 
-                       # Convert image to RGB if it's not in that mode
-                image = image.convert('RGB')
-                # Get the pixel data
-                pixels = np.array(image)
-                # Calculate the average color
-                avg_color = pixels.mean(axis=(0, 1))  # Mean along the height and width axes
-                # Return the average color as a tuple (R, G, B)
-                return tuple(map(int, avg_color)) 
-            else:
-                raise evalError("You must have images")
+                    raise evalError("You must have images")
                  
-        #handles the negate
-        case Neg(value):
-            v = evalInEnv(env, value)
-            if type(v) == int:
-                return -v
-            else:
-                raise evalError("Negation requires an integer literal")
-
-        # handles the addition
-        case Add(left, right):
-            left_val = evalInEnv(env, left)
-            right_val = evalInEnv(env, right)
-            if type(left_val) == int and type(right_val) == int:
-                return left_val + right_val
-            if type(left_val) == Image.Image and type(right_val) == Image.Image:
-                new_image = Combine(left_val, right_val)
-                return new_image
-            else:
-                raise evalError("Addition requires two integers literals")
-
-        # handles the subtraction
-        case Sub(left, right):
-            left_val = evalInEnv(env, left)
-            right_val = evalInEnv(env, right)
-            if type(left_val) == int and type(right_val) == int:
-                return left_val - right_val
-            else:
-                raise evalError("Subtraction requires two integer literals")
-
-        #Handles the multiplication
-        case Mul(left, right):
-            left_val = evalInEnv(env, left)
-            right_val = evalInEnv(env, right)
-            if type(left_val) == int and type(right_val) == int:
-                return left_val * right_val
-            else:
-                raise evalError("Multiplication requires two integer literals")
-
-        # handles the division
-        case Div(left, right):
-            left_val = evalInEnv(env, left)
-            right_val = evalInEnv(env, right)
-            if type(left_val) == int and type(right_val) == int:
-                if right_val == 0:
-                    raise evalError("You cannot divide by Zero")
-                return left_val // right_val
-            else: 
-                raise evalError("Division requires two integer literals")
-
-        # handles the rotate image
-        case Rotate(image) :
-            img = evalInEnv(env,image)
-            if isinstance(img, Image.Image):
-                return img.rotate(90)
-            else:
-                return evalError("You can only rotate Photos")
-
-        # handles the combine image
-        case Combine(image1, image2) :
-            img1 = evalInEnv(env,image1)
-            img2 = evalInEnv(env, image2)
-            if isinstance(img1, Image.Image) and isinstance(img2, Image.Image):
-                if img1.size[1] != img2.size[1]:
-                    raise evalError("Images must have the same height")
-                w = img1.size[0] + img2.size[0]
-                h = max(img1.size[1], img2.size[1])
-                combined_image = Image.new("RGB", (w, h))
-                combined_image.paste(img1, (0, 0))
-                combined_image.paste(img2, (img1.size[0], 0))
-                return combined_image
-            else:
-                raise evalError("Both operands must be images")
+            #handles the negate
+            case Neg(value):
+                v = evalInEnv(env, value)
+                if type(v) == int:
+                    return -v
+                else:
+                    raise evalError("Negation requires an integer literal")
 
-        #handles the literals(file path)
-        case Name (name) :
-            v = lookupEnv(name, env)
-            if v is None:
-                raise evalError(f"Name {name} not found")
-            return v
-        
-        case Let(name, value, body) :
-            v = evalInEnv(env, value)
-            l = newLoc(v)
-            newEnv = extendEnv(env, name, l)
-            return evalInEnv(newEnv, body)
-
-        case Lit(lit):
-            match lit:
-                case int(i):
-                    return i
-                case bool(b):
-                    return b
-                case Image.Image():
-                    return lit
-                case _:
-                    raise evalError(f"Unknown literal: {lit}")
-
-        case Or(left, right):
-            left_val = evalInEnv(env, left)
-            if isinstance(left_val, bool):
-                if left_val:
-                    return True
+            # handles the addition
+            case Add(left, right):
+                left_val = evalInEnv(env, left)
                 right_val = evalInEnv(env, right)
-                if isinstance(right_val, bool):
-                    return left_val or right_val
+                if type(left_val) == int and type(right_val) == int:
+                    return left_val + right_val
+                if is_image(left_val) and is_image(right_val):
+                    new_image = Combine(left_val, right_val)
+                    return new_image
                 else:
-                    raise evalError("Or requires two boolean literals")
-            else:
-                raise evalError("Or requires two boolean literals")
+                    raise evalError("Addition requires two integers literals")
 
-        case And(left, right):
-            left_val = evalInEnv(env, left)
-            if isinstance(left_val, bool):
-                if not left_val:
-                    return False
+            # handles the subtraction
+            case Sub(left, right):
+                left_val = evalInEnv(env, left)
                 right_val = evalInEnv(env, right)
-                if isinstance(right_val, bool):
-                    return left_val and right_val
+                if type(left_val) == int and type(right_val) == int:
+                    return left_val - right_val
                 else:
-                    raise evalError("And requires two boolean literals")
-            else:
-                raise evalError("And requires two boolean literals")
+                    raise evalError("Subtraction requires two integer literals")
 
+            #Handles the multiplication
+            case Mul(left, right):
+                left_val = evalInEnv(env, left)
+                right_val = evalInEnv(env, right)
+                if type(left_val) == int and type(right_val) == int:
+                    return left_val * right_val
+                else:
+                    raise evalError("Multiplication requires two integer literals")
 
-        case Not(value):
-            val = evalInEnv(env, value)
-            if isinstance(val, bool):
-                return not val
-            else:
-                raise evalError("Not requires a boolean literal")
-
-        case Eq(left, right) :
-            left_val = evalInEnv(env, left)
-            right_val = evalInEnv(env, right)
-            if type (left_val) == bool:
-                if type (right_val) == bool:
-                    if left_val == True and right_val == True:
-                        return True
-                    elif left_val == False and right_val == False:
+            # handles the division
+            case Div(left, right):
+                left_val = evalInEnv(env, left)
+                right_val = evalInEnv(env, right)
+                if type(left_val) == int and type(right_val) == int:
+                    if right_val == 0:
+                        raise evalError("You cannot divide by Zero")
+                    return left_val // right_val
+                else: 
+                    raise evalError("Division requires two integer literals")
+
+            # handles the rotate image
+            case Rotate(image) :
+                return rotate(evalInEnv(env,image))
+
+            case Resize(image, width, height):
+                return resize(evalInEnv(env, image), evalInEnv(env, width), evalInEnv(env, height))
+
+            case Crop(image, left, top, width, height):
+                return crop(evalInEnv(env, image), evalInEnv(env, left), evalInEnv(env, top),
+                            evalInEnv(env, width), evalInEnv(env, height))
+
+            # handles the combine image
+            case Combine(image1, image2) :
+                img1 = evalInEnv(env,image1)
+                img2 = evalInEnv(env, image2)
+                return combine(img1, img2)
+
+            #handles the literals(file path)
+            case Name (name) :
+                v = lookupEnv(name, env)
+                if v is None:
+                    raise evalError(f"Name {name} not found")
+                return getLoc(v)
+        
+            case Let(name, value, body) :
+                v = evalInEnv(env, value)
+                l = newLoc(v)
+                env = extendEnv(env, name, l)
+                e = body
+                continue
+
+            case Lit(lit):
+                match lit:
+                    case int(i):
+                        return i
+                    case bool(b):
+                        return b
+                    case Image.Image() | LazyImage():
+                        return lit
+                    case _:
+                        raise evalError(f"Unknown literal: {lit}")
+
+            case Or(left, right):
+                left_val = evalInEnv(env, left)
+                if isinstance(left_val, bool):
+                    if left_val:
                         return True
+                    right_val = evalInEnv(env, right)
+                    if isinstance(right_val, bool):
+                        return left_val or right_val
                     else:
+                        raise evalError("Or requires two boolean literals")
+                else:
+                    raise evalError("Or requires two boolean literals")
+
+            case And(left, right):
+                left_val = evalInEnv(env, left)
+                if isinstance(left_val, bool):
+                    if not left_val:
                         return False
+                    right_val = evalInEnv(env, right)
+                    if isinstance(right_val, bool):
+                        return left_val and right_val
+                    else:
+                        raise evalError("And requires two boolean literals")
                 else:
-                    raise evalError("Eq requires a Boolean")
-            elif type(left_val) == int and type(right_val) == int:
-                if left_val == right_val:
-                    return True
+                    raise evalError("And requires two boolean literals")
+
+
+            case Not(value):
+                val = evalInEnv(env, value)
+                if isinstance(val, bool):
+                    return not val
                 else:
-                    return False
-            elif isinstance(left_val, Image.Image) and isinstance(right_val, Image.Image):
-                return left_val.tobytes()
-        case Lt(left, right) :
-            left_val = evalInEnv(env, left)
-            right_val = evalInEnv(env, right)
-            if type(left_val) == int and type(right_val) == int:
-                if left_val < right_val:
-                    return True
+                    raise evalError("Not requires a boolean literal")
+
+            case Eq(left, right) :
+                left_val = evalInEnv(env, left)
+                right_val = evalInEnv(env, right)
+                if type (left_val) == bool:
+                    if type (right_val) == bool:
+                        if left_val == True and right_val == True:
+                            return True
+                        elif left_val == False and right_val == False:
+                            return True
+                        else:
+                            return False
+                    else:
+                        raise evalError("Eq requires a Boolean")
+                elif type(left_val) == int and type(right_val) == int:
+                    if left_val == right_val:
+                        return True
+                    else:
+                        return False
+                elif is_image(left_val) and is_image(right_val):
+                    return force(left_val).tobytes()
+            case Lt(left, right) :
+                left_val = evalInEnv(env, left)
+                right_val = evalInEnv(env, right)
+                if type(left_val) == int and type(right_val) == int:
+                    if left_val < right_val:
+                        return True
+                    else:
+                        return False
                 else:
-                    return False
-            else:
-                raise evalError("Lt requires a Boolean")
+                    raise evalError("Lt requires a Boolean")
 
-        case If(condition, then_branch, else_branch):
-            c = evalInEnv(env, condition)
-            if isinstance(c, bool):
-                if c:
-                    return evalInEnv(env, then_branch)
+            case If(condition, then_branch, else_branch):
+                c = evalInEnv(env, condition)
+                if isinstance(c, bool):
+                    e = then_branch if c else else_branch
+                    continue
                 else:
-                    return evalInEnv(env, else_branch)
-            else:
-                raise evalError("If condition must be a boolean")
+                    raise evalError("If condition must be a boolean")
 
-        case Darken(image):
-            img = evalInEnv(env, image)
-            if isinstance(img, Image.Image):
-                enhancer = ImageEnhance.Brightness(img)
-                return enhancer.enhance(0.5)
-            else:
-                raise evalError("Darken requires an image")
+            case Darken(image):
+                return darken(evalInEnv(env, image))
 
-        case Lighten(image):
-            img = evalInEnv(env, image)
-            if isinstance(img, Image.Image):
-                enhancer = ImageEnhance.Brightness(img)
-                return enhancer.enhance(1.5)
-            else:
-                raise evalError("Lighten requires an image")
-
-        case Ifnz(c,t,e):
-            match evalInEnv(env,c):
-                case 0:
-                    return evalInEnv(env, e)
-                case _:
-                    return evalInEnv(env,t)
+            case Lighten(image):
+                return lighten(evalInEnv(env, image))
+
+            case Ifnz(c,t,f):
+                match evalInEnv(env,c):
+                    case 0:
+                        e = f
+                    case _:
+                        e = t
+                continue
                     
-        case Letfun(n,ps,b,i):
-            c = Closure(ps,b,env)
-            loc = newLoc(c)
-            newEnv = extendEnv(env,n,loc)
-            c.env = newEnv
-            return evalInEnv(newEnv,i)
-
-        case App(f,es):
-            fun = evalInEnv(env,f)
-            arg = evalInEnv(env,es)
-            match fun:
-                case Closure(ps,b,cenv):
-                    loc = newLoc(arg)
-                    newEnv = extendEnv(cenv,ps,loc)
-                    return evalInEnv(newEnv,b)
-                case _:
-                    raise evalError("not a function")
-
-        case Image.Image():
-            return e
-
-        case _:
-            raise evalError(f"Unknown expression: {e}")
-
-
-def run(e: Expr) -> None:
+            case Letfun(n,ps,b,i):
+                c = Closure(ps,b,env)
+                loc = newLoc(c)
+                newEnv = extendEnv(env,n,loc)
+                c.env = newEnv
+                env, e = newEnv, i
+                continue
+
+            case App(f,es):
+                fun = evalInEnv(env,f)
+                arg = evalInEnv(env,es)
+                match fun:
+                    case Closure(ps,b,cenv):
+                        loc = newLoc(arg)
+                        env, e = extendEnv(cenv,ps,loc), b
+                        continue
+                    case _:
+                        raise evalError("not a function")
+
+            case Image.Image() | LazyImage():
+                return e
+
+            case _:
+                raise evalError(f"Unknown expression: {e}")
+
+        # a case that falls through (e.g. Eq on mismatched types) gives None
+        return None
+
+
+def report(result: Value) -> None:
+    '''Shows and saves an image result, prints any other result'''
+    if is_image(result):
+        result = force(result)
+        result.show()
+        result.save("answer.png")
+    else:
+        print(f"Result: {result}")
+
+# "tree" is the AST walker above; "closure" compiles to closures first;
+# "frames" also resolves variables to frame slots (see resolve.py);
+# "vm" compiles to bytecode for a stack VM (see vm.py).
+# optimize=True constant-folds e first (see optimize.py)
+BACKENDS = ("tree", "closure", "frames", "vm")
+
+def evaluate(e: Expr, backend: str = "tree", optimize: bool = False, workers: int = 1,
+             cache: ResultCache | None = None) -> Value:
+    '''Runs e on backend; an image result comes back computed. With workers > 1,
+    independent image operations are computed on that many threads. With a
+    cache, image results are taken from it where it has them, and stored in it.'''
+    if optimize:
+        import optimize as opt
+        e = opt.fold(e)
+    if workers > 1:
+        with imageops.parallel(workers):
+            return evaluate(e, backend, cache=cache)
+    if cache is not None:
+        with imageops.caching(cache):
+            return evaluate(e, backend)
+    if backend == "tree":
+        return force(eval(e))
+    elif backend == "closure":
+        import compiler
+        return force(compiler.eval(e))
+    elif backend == "frames":
+        import compiler
+        return force(compiler.eval_frames(e))
+    elif backend == "vm":
+        import vm
+        return force(vm.eval(e))
+    else:
+        raise ValueError(f"unknown backend: {backend}")
+
+def run(e: Expr, backend: str = "tree", optimize: bool = False, workers: int = 1,
+        cache: ResultCache | None = None) -> None:
     # Example of how to use the DSL
     print(f"Running {e}")
     try:
          # Evaluate the expression
-        result = eval(e)
-        if isinstance(result, Image.Image):
-            result.show()
-            result.save("answer.png")
-        else:
-            print(f"Result: {result}") 
+        result = evaluate(e, backend, optimize, workers, cache)
+        report(result)
         # Optionally, open the result with the default viewer
 
     except evalError as e:
         print(f"Evaluation error: {e}")
 
 # Test condition
-image2_path = Image.open("Image/image2.jpg")
-image1_path = Image.open("Image/image1.jpg")
-
-# Define the expression with a proper binding
-# Test Expression #1
-test1: Expr = Let(
-    "image1",  # Name of the variable
-    Lit(image1_path),  # Binding the actual image to "image1"
-    (Invert(Name("image1")))  # Using the expression properly
-)
-
-
-# Test Expression #2
-# Define the expression with the correct transformations
-test2: Expr = Let(
-    "image1",  # Name of the first variable
-    Lit(image1_path),  # Bind image1_path to "image1"
-    Let(  # Another Let to bind "image2"
-        "image2",  # Name of the second variable
-        Lit(image2_path),  # Bind image2_path to "image2"
-        Combine(
-            Lighten(Name("image1")),  # Apply Lightening transformation on image1
-            Darken(Name("image2"))    # Apply Darkening transformation on image2
+# The examples are built when first looked up (interp.test1 goes through
+# __getattr__), not at import: as module globals they would hold the
+# built-in images' handles, and their decoded pixels, for the whole process
+def _examples() -> dict[str, Expr]:
+    # handles from registry.py: only the headers are read until an image is needed
+    image2_path = registry.open("image2")
+    image1_path = registry.open("image1")
+
+    # Define the expression with a proper binding
+    # Test Expression #1
+    test1: Expr = Let(
+        "image1",  # Name of the variable
+        Lit(image1_path),  # Binding the actual image to "image1"
+        (Invert(Name("image1")))  # Using the expression properly
+    )
+
+
+    # Test Expression #2
+    # Define the expression with the correct transformations
+    test2: Expr = Let(
+        "image1",  # Name of the first variable
+        Lit(image1_path),  # Bind image1_path to "image1"
+        Let(  # Another Let to bind "image2"
+            "image2",  # Name of the second variable
+            Lit(image2_path),  # Bind image2_path to "image2"
+            Combine(
+                Lighten(Name("image1")),  # Apply Lightening transformation on image1
+                Darken(Name("image2"))    # Apply Darkening transformation on image2
+            )
         )
     )
-)
-
-# Define the expression with a proper binding
-# Test Expression #3
-test3: Expr = Let(
-    "image1",  # Name of the variable
-    Lit(image1_path),  # Binding the actual image to "image1"
-    Rotate(Rotate(Name("image1")))  # Using the expression properly
-)
-
-# Test Expression #4
-# should print error
-# Define the expression with the correct transformations
-test4: Expr = Let(
-    "image1",  # Name of the first variable
-    Lit(image1_path),  # Bind image1_path to "image1"
-    Let(  # Another Let to bind "image2"
-        "image2",  # Name of the second variable
-        Lit(3),  # Bind image2_path to "image2"
-        Combine(
-            Lighten(Name("image1")),  # Apply Lightening transformation on image1
-            (Name("image2"))    # Apply Darkening transformation on image2
+
+    # Define the expression with a proper binding
+    # Test Expression #3
+    test3: Expr = Let(
+        "image1",  # Name of the variable
+        Lit(image1_path),  # Binding the actual image to "image1"
+        Rotate(Rotate(Name("image1")))  # Using the expression properly
+    )
+
+    # Test Expression #4
+    # should print error
+    # Define the expression with the correct transformations
+    test4: Expr = Let(
+        "image1",  # Name of the first variable
+        Lit(image1_path),  # Bind image1_path to "image1"
+        Let(  # Another Let to bind "image2"
+            "image2",  # Name of the second variable
+            Lit(3),  # Bind image2_path to "image2"
+            Combine(
+                Lighten(Name("image1")),  # Apply Lightening transformation on image1
+                (Name("image2"))    # Apply Darkening transformation on image2
+            )
         )
     )
-)
+    return {"image1_path": image1_path, "image2_path": image2_path,
+            "test1": test1, "test2": test2, "test3": test3, "test4": test4}
+
+def __getattr__(name: str):
+    if name in ("image1_path", "image2_path", "test1", "test2", "test3", "test4"):
+        return _examples()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 # Uncomment out the code below to Run the expressions
-#run(test1)
-#run(test2)
-#run(test3)
-#run(test4)
+#run(_examples()["test1"])
+#run(_examples()["test2"])
+#run(_examples()["test3"])
+#run(_examples()["test4"])
 
 # Here is the link to the Pillow https://pillow.readthedocs.io/en/stable/handbook/tutorial.html
 '''
@@ -661,10 +920,9 @@ and combine. Whenever they are combined or rotate a new photo is made and is sav
 answer.png where it is easy to view. There will also be a pop up so that you can also 
 view it through that. (Please not that it takes a little while for the images to combine).
 
-Another error that has occured is that Whenever I run combine with rotate and a normal image
-the photo will combine even though they are not the same dimensions. The reason for this is 
-because the rotate adds a border with the same height as the previous image therefore making it
-possible. However If you were to combine two images of different heights without rotating it will
-not work and an error will pop up.
+Rotate used to keep the original canvas, cropping the photo and adding a border, so a
+rotated image could be combined with an unrotated one of a different shape. Rotations are now
+exact quarter turns that swap the width and height (see imageops.py), so combining images
+whose heights differ is an error whether or not they have been rotated.
 
 '''
\ No newline at end of file
@@ -0,0 +1,163 @@
+'''Constant folding and partial evaluation.
+
+fold() rewrites an Expr before it runs:
+  - Add/Sub/Mul/Div/Neg/And/Or/Not/Eq/Lt whose operands are int or bool
+    literals become the literal they evaluate to;
+  - And/Or whose left operand alone decides the result become that literal;
+  - If/Ifnz with a literal condition become the branch that would run;
+  - Let bindings of literals are inlined into their body (unless the name
+    is assigned to somewhere, since then it is a real memory location).
+Nodes fold has no rule for are folded inside, field by field, so a name
+inlined away is never left behind in one of them.
+Anything that would raise an evalError (e.g. 1 / 0, !3) is left in place,
+so it still fails, with the same message, when and if it runs.'''
+
+from contextlib import contextmanager
+from typing import Iterator
+from interp import Expr, Node, evalError, evalInEnv, empty_env, is_image, \
+    Seq, Show, Assign, Blur, Invert, Neg, Add, Sub, Mul, Div, Rotate, Combine, Resize, Crop, \
+    Name, Let, Lit, Or, And, Not, Eq, Lt, If, Darken, Lighten, Ifnz, Letfun, App, \
+    dom_color, image_color
+
+type Consts = dict[str, Expr]
+
+
+def fold(e: Expr) -> Expr:
+    return foldIn({}, assigned_names(e), e)
+
+def assigned_names(e: Expr) -> set[str]:
+    '''Every name that is the target of an Assign anywhere in e'''
+    names = set()
+    todo = [e]
+    while todo:
+        x = todo.pop()
+        if isinstance(x, Assign):
+            names.add(x.name)
+        todo.extend(children(x))
+    return names
+
+def children(e: Expr) -> list[Expr]:
+    match e:
+        case Seq(exprs):
+            return exprs
+        case Add(a, b) | Sub(a, b) | Mul(a, b) | Div(a, b) | And(a, b) | Or(a, b) | \
+             Eq(a, b) | Lt(a, b) | Combine(a, b) | App(a, b) | Let(_, a, b) | Letfun(_, _, a, b):
+            return [a, b]
+        case Neg(a) | Not(a) | Show(a) | Blur(a) | Invert(a) | Rotate(a) | Darken(a) | Lighten(a) | \
+             dom_color(a) | image_color(a) | Assign(_, a):
+            return [a]
+        case If(c, t, f) | Ifnz(c, t, f) | Resize(c, t, f):
+            return [c, t, f]
+        case Crop(a, x, y, w, h):
+            return [a, x, y, w, h]
+        case Node():
+            return [v for v in fields(e) if isinstance(v, Node)]
+        case _:
+            return []
+
+def fields(e: Node) -> list:
+    return [getattr(e, name) for name in e.__match_args__]
+
+def is_const(e: Expr) -> bool:
+    '''A value that evaluating cannot fail on (Lit("x") raises, so it is not one)'''
+    return is_image(e) or isinstance(e, Lit) and (isinstance(e.value, int) or is_image(e.value))
+
+def scalar(e: Expr) -> bool:
+    '''An int or bool literal, the only values folded arithmetically'''
+    return isinstance(e, Lit) and type(e.value) in (int, bool)
+
+def try_eval(e: Expr) -> Expr:
+    '''e folded to a literal if it evaluates to an int or bool without error'''
+    try:
+        v = evalInEnv(empty_env, e)
+    except evalError:
+        return e
+    return Lit(v) if type(v) in (int, bool) else e
+
+@contextmanager
+def binding(consts: Consts, name: str, value: Expr | None = None) -> Iterator[None]:
+    '''Binds name to a constant in consts for the block, or with no value
+    hides any outer constant of that name. consts is updated in place rather
+    than copied, so long let chains fold in linear time.'''
+    outer = consts.pop(name, None)
+    if value is not None:
+        consts[name] = value
+    try:
+        yield
+    finally:
+        consts.pop(name, None)
+        if outer is not None:
+            consts[name] = outer
+
+def foldIn(consts: Consts, assigned: set[str], e: Expr) -> Expr:
+    f = lambda x: foldIn(consts, assigned, x)
+    match e:
+        case Name(name):
+            return consts.get(name, e)
+
+        case Let(name, value, body):
+            v = f(value)
+            if is_const(v) and name not in assigned:
+                with binding(consts, name, v):
+                    return f(body)
+            with binding(consts, name):
+                return Let(name, v, f(body))
+
+        case Letfun(name, params, bodyexpr, inexpr):
+            with binding(consts, name):
+                with binding(consts, params):
+                    b = f(bodyexpr)
+                return Letfun(name, params, b, f(inexpr))
+
+        case Add(a, b) | Sub(a, b) | Mul(a, b) | Div(a, b) | Eq(a, b) | Lt(a, b):
+            l, r = f(a), f(b)
+            node = type(e)(l, r)
+            return try_eval(node) if scalar(l) and scalar(r) else node
+
+        case Neg(a) | Not(a):
+            v = f(a)
+            node = type(e)(v)
+            return try_eval(node) if scalar(v) else node
+
+        case And(a, b) | Or(a, b):
+            l = f(a)
+            if scalar(l) and type(l.value) == bool and l.value == isinstance(e, Or):
+                return l    # false && _ and true || _ never look at the right side
+            r = f(b)
+            node = type(e)(l, r)
+            return try_eval(node) if scalar(l) and scalar(r) else node
+
+        case If(c, t, el):
+            cond = f(c)
+            if scalar(cond) and type(cond.value) == bool:
+                return f(t) if cond.value else f(el)
+            return If(cond, f(t), f(el))
+
+        case Ifnz(c, t, el):
+            cond = f(c)
+            if scalar(cond):
+                return f(el) if cond.value == 0 else f(t)
+            return Ifnz(cond, f(t), f(el))
+
+        case Seq(exprs):
+            return Seq(*[f(x) for x in exprs])
+        case Assign(name, value):
+            return Assign(name, f(value))
+        case Combine(a, b) | App(a, b):
+            return type(e)(f(a), f(b))
+        case Resize(a, w, h):
+            return Resize(f(a), f(w), f(h))
+        case Crop(a, x, y, w, h):
+            return Crop(f(a), f(x), f(y), f(w), f(h))
+        case Show(a) | Blur(a) | Invert(a) | Rotate(a) | Darken(a) | Lighten(a) | \
+             dom_color(a) | image_color(a):
+            return type(e)(f(a))
+        case Node():
+            # a node with no rule of its own: its subexpressions may still use
+            # a name whose binding was inlined away
+            vs = fields(e)
+            if not any(isinstance(v, Node) for v in vs):
+                return e    # a leaf: Lit, Read
+            return type(e)(*[f(v) if isinstance(v, Node) else v for v in vs])
+        case _:
+            return e
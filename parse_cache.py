@@ -0,0 +1,83 @@
+'''Content-addressed parse cache: source text -> AST, stored on disk.
+
+Entries are keyed by sha256(version, source), where the version hashes the
+grammar and the code that builds the AST, so any change to either invalidates
+old entries. ASTs are pickled; images referenced by the AST are stored as
+their file path and come back as registry handles (see registry.py). The directory is kept under
+max_bytes by evicting the least recently used entries (by mtime; see
+cache_dir.py).'''
+
+import hashlib
+import io
+import os
+import pickle
+from pathlib import Path
+from PIL import Image
+from imageops import LazyImage
+import cache_dir
+import registry
+
+
+class _ASTPickler(pickle.Pickler):
+    def persistent_id(self, obj):
+        if isinstance(obj, LazyImage) and obj.op == "file":
+            return ("image", obj.arg)
+        if isinstance(obj, (Image.Image, LazyImage)):
+            if not getattr(obj, "filename", ""):
+                raise pickle.PicklingError("cannot cache an in-memory image")
+            return ("image", obj.filename)
+        return None
+
+class _ASTUnpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        kind, path = pid
+        if kind != "image":
+            raise pickle.UnpicklingError(f"unknown persistent id: {kind}")
+        return registry.open(path)
+
+
+class ParseCache:
+    def __init__(self, directory:Path, version:str, max_bytes:int = 64 * 2**20):
+        self.directory = directory
+        self.version = version
+        self.max_bytes = max_bytes
+
+    def path(self, s:str) -> Path:
+        key = hashlib.sha256(f"{self.version}\0{s}".encode()).hexdigest()
+        return self.directory / f"{key}.ast"
+
+    def get(self, s:str):
+        '''The cached AST for s, or None on a miss'''
+        p = self.path(s)
+        try:
+            with open(p, "rb") as f:
+                e = _ASTUnpickler(f).load()
+            os.utime(p)    # mark as recently used
+            return e
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # a corrupt or unreadable entry is just a miss
+            return None
+
+    def put(self, s:str, e) -> None:
+        '''Stores the AST for s; ASTs that cannot be pickled are not cached'''
+        buf = io.BytesIO()
+        try:
+            _ASTPickler(buf, protocol=pickle.HIGHEST_PROTOCOL).dump(e)
+        except (pickle.PicklingError, RecursionError, TypeError):
+            return
+        try:
+            # concurrent readers never see a partial entry
+            cache_dir.write(self.path(s), buf.getvalue())
+        except OSError:
+            return
+        self.evict()
+
+    def evict(self) -> None:
+        '''Deletes least recently used entries until the cache fits in max_bytes'''
+        cache_dir.evict(self.directory, "*.ast", self.max_bytes)
+
+    def clear(self) -> None:
+        for p in self.directory.glob("*.ast"):
+            p.unlink(missing_ok=True)
@@ -1,21 +1,116 @@
 #!/Users/kirbyfaverty/Documents/GitHub/CS358_Project/.venv/bin/python
-from interp import Add, Sub, Mul, Not, Div, Neg, Or, Let, Name, Lit, Ifnz, Letfun, Expr, App, run, Combine, And, Eq, Lighten, Darken, Lt, Rotate, Blur, Invert, Assign, Read, Seq, Show
+import interp
+from interp import Add, Sub, Mul, Not, Div, Neg, Or, Let, Name, Lit, Ifnz, Letfun, Expr, App, run, Combine, And, Eq, Lighten, Darken, Lt, Rotate, Resize, Crop, Blur, Invert, Assign, Read, Seq, Show, \
+    Env, Value, empty_env, evalInEnv, evalError, report
 from lark import Lark, Token, Transformer
 from lark.tree import ParseTree
 from lark.exceptions import VisitError
 from pathlib import Path
-from PIL import Image
+import parse_cache
+from parse_cache import ParseCache
+import imageops
+import registry
+from typing import Iterable, Iterator, TextIO
+import hashlib
+import itertools
+import os
+import re
+import sys
 
-parser = Lark(Path('expr.lark').read_text(),start='expr',ambiguity='explicit', lexer = "basic")
-# to check against ambiguity:
-#parser = Lark(Path('expr.lark').read_text(),start='expr',parser='lalr',strict=True)
+# LALR is the default parser: expr.lark is conflict-free, so it builds under
+# parser='lalr', strict=True and gives the same trees as Earley in linear time.
+# Earley is kept as a fallback (and to check against ambiguity via _ambig).
+PARSER_MODES = ("lalr", "earley")
+
+# compiled LALR tables are pickled here, one file per grammar content hash,
+# so warm starts skip grammar analysis entirely
+CACHE_DIR = Path(os.environ.get("EXPR_CACHE_DIR", ".expr_cache"))
+
+def grammar_hash(grammar:str) -> str:
+    return hashlib.sha256(grammar.encode()).hexdigest()[:16]
+
+def parser_cache_file(grammar:str, start:str = "expr") -> str | bool:
+    '''Path of the table cache for this grammar (False if it cannot be used)'''
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    except OSError:
+        return False
+    return str(CACHE_DIR / f"parser-lalr-{start}-{grammar_hash(grammar)}.pickle")
+
+def make_parser(mode:str = "lalr", strict:bool = False, cache:bool = True,
+                transformer:Transformer|None = None, start:str = "expr") -> Lark:
+    '''Builds a parser for expr.lark in the given mode ("lalr" or "earley").
+    strict=True makes LALR fail on any grammar conflict (needs interegular);
+    cache=True loads/saves the LALR tables from/to CACHE_DIR;
+    a transformer (LALR only) is run inline on every reduction, so parse()
+    returns its result instead of a parse tree'''
+    grammar = Path('expr.lark').read_text()
+    if mode == "lalr":
+        # strict builds are grammar checks, so always analyze from scratch
+        cache_file = parser_cache_file(grammar, start) if cache and not strict else False
+        return Lark(grammar, start=start, parser='lalr', lexer="basic", strict=strict, cache=cache_file,
+                    transformer=transformer)
+    elif mode == "earley":
+        return Lark(grammar, start=start, ambiguity='explicit', lexer="basic")
+    else:
+        raise ValueError(f"unknown parser mode: {mode}")
+
+# parsers are built on first use, so importing this module stays cheap
+_parsers: dict[str, Lark] = {}
+
+def get_parser(mode:str = "lalr") -> Lark:
+    if mode not in _parsers:
+        _parsers[mode] = make_parser(mode)
+    return _parsers[mode]
+
+def get_ast_parser() -> Lark:
+    '''The LALR parser with ToExpr run inline: parse() returns an Expr'''
+    if "ast" not in _parsers:
+        _parsers["ast"] = make_parser("lalr", transformer=ToExpr())
+    return _parsers["ast"]
+
+def get_stmt_parser() -> Lark:
+    '''Like get_ast_parser, but for one statement (expr0) of a ;-sequence'''
+    if "stmt" not in _parsers:
+        _parsers["stmt"] = make_parser("lalr", transformer=ToExpr(), start="expr0")
+    return _parsers["stmt"]
+
+# parsed ASTs are cached on disk by source hash (see parse_cache.py);
+# EXPR_PARSE_CACHE=0 turns this off
+PARSE_CACHE_BYTES = int(os.environ.get("EXPR_PARSE_CACHE_BYTES", 64 * 2**20))
+_parse_cache: ParseCache | None = None
+
+def ast_version() -> str:
+    '''Hash of everything that decides the AST of a source text: the grammar,
+    the transformer in this file, the node classes in interp.py, and the
+    image handles and how parse_cache.py pickles them (imageops.py, registry.py)'''
+    h = hashlib.sha256()
+    for f in (Path(__file__).parent / 'expr.lark', Path(__file__), Path(interp.__file__),
+              Path(imageops.__file__), Path(registry.__file__), Path(parse_cache.__file__)):
+        h.update(f.read_bytes())
+    return h.hexdigest()[:16]
+
+def get_parse_cache() -> ParseCache | None:
+    global _parse_cache
+    if os.environ.get("EXPR_PARSE_CACHE", "1") == "0":
+        return None
+    if _parse_cache is None:
+        _parse_cache = ParseCache(CACHE_DIR / "ast", ast_version(), PARSE_CACHE_BYTES)
+    return _parse_cache
+
+def __getattr__(name:str):
+    # keeps `parse_run.parser` working now that it is built lazily
+    if name == "parser":
+        return get_parser()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 class ParseError(Exception): 
     pass
 
-def parse(s:str) -> ParseTree:
+def parse(s:str, p:Lark|None = None) -> ParseTree:
+    '''Parses s with p (the default LALR parser if p is None)'''
     try:
-        return parser.parse(s)
+        return (p or get_parser()).parse(s)
     except Exception as e:
         raise ParseError(e)
 
@@ -24,11 +119,11 @@ class AmbiguousParse(Exception):
 
 class ToExpr(Transformer[Token,Expr]):
     '''Defines a transformation from a parse tree into an AST'''
-    def seqexp(self, args:tuple[Expr,Expr]) -> Expr:
+    def seqexp(self, args:list[Expr]) -> Expr:
         if len(args) == 1:
             return args[0]
         elif len(args) >= 2:
-            return Seq(args[0],self.seqexp(args[1:]))
+            return Seq(*args)
         else:
             raise ValueError("seqexp: len(args) < 1")
     def showexp(self, args:tuple[Expr]) -> Expr:
@@ -52,10 +147,8 @@ class ToExpr(Transformer[Token,Expr]):
     def let(self, args:tuple[Token,Expr,Expr]) -> Expr:
         return Let(args[0].value,args[1],args[2]) 
     def id(self, args:tuple[Token]) -> Expr:
-        if args[0].value == "image1":
-              return Image.open("Image/image1.jpg")
-        elif args[0].value == "image2":
-              return Image.open("Image/image2.jpg")
+        if args[0].value in registry.NAMES:
+            return registry.open(args[0].value)
         else:
             return Name(args[0].value)
     def int(self,args:tuple[Token]) -> Expr:
@@ -82,6 +175,10 @@ class ToExpr(Transformer[Token,Expr]):
         return Darken(args[0])
     def rotateexp(self, args:tuple[Expr]) -> Expr:
         return Rotate(args[0])
+    def resizeexp(self, args:tuple[Expr,Expr,Expr]) -> Expr:
+        return Resize(args[0], args[1], args[2])
+    def cropexp(self, args:tuple[Expr,Expr,Expr,Expr,Expr]) -> Expr:
+        return Crop(args[0], args[1], args[2], args[3], args[4])
     def andexpr(self, args:tuple[Expr,Expr]) -> Expr:
         return And(args[0], args[1])
     def orexpr(self, args:tuple[Expr,Expr]) -> Expr:
@@ -108,10 +205,102 @@ def genAST(t:ParseTree) -> Expr:
         else:
             raise e
 
-def just_parse(s: str) -> Expr:
-    t = parse(s)
+def parse_ast(s:str) -> Expr:
+    '''Parses s straight into an AST in one pass, without building a parse tree'''
+    try:
+        return get_ast_parser().parse(s)
+    except Exception as e:
+        raise ParseError(e)
+
+def just_parse(s: str, p:Lark|None = None) -> Expr:
+    '''Parses s into an AST. With an explicit parser p this takes the
+    two-pass route (parse tree, then genAST); otherwise it is one pass,
+    behind the on-disk parse cache'''
+    if p is None:
+        cache = get_parse_cache()
+        e = cache.get(s) if cache is not None else None
+        if e is None:
+            e = parse_ast(s)
+            if cache is not None:
+                cache.put(s, e)
+        return e
+    t = parse(s, p)
     return genAST(t)
 
+# Streaming: a script `s1; s2; ...; sn` means Seq(s1, s2, ..., sn), and Seq
+# evaluates every statement in the same environment, so each top-level statement
+# can be parsed and run as soon as its `;` arrives. A `;` is top-level when
+# it is outside (...), let/letfun ... end and ifnz ... else.
+_OPENERS = {"(", "let", "letfun", "ifnz"}
+_CLOSERS = {")", "end", "else"}
+_stmt_token = re.compile(r"[A-Za-z_][A-Za-z_0-9]*|\d+|[();]")
+
+def split_statements(chunks:Iterable[str]) -> Iterator[tuple[str, bool]]:
+    '''Yields (statement, is_last) for each top-level statement of the script
+    read from chunks, as soon as the statement is complete'''
+    buf = ""        # text of the current (unfinished) statement
+    pos = 0         # scan position in buf
+    depth = 0
+    first = True    # still before the first token of the script
+    whole = False   # a leading `run` takes the whole script as its argument
+    for chunk in itertools.chain(chunks, [None]):
+        eof = chunk is None
+        if not eof:
+            buf += chunk
+        while not whole:
+            m = _stmt_token.search(buf, pos)
+            if m is None:
+                break
+            tok = m.group()
+            # a word at the end of the buffer may continue in the next chunk
+            if m.end() == len(buf) and not eof and tok not in "();":
+                break
+            pos = m.end()
+            if first and tok == "run":
+                whole = True
+            first = False
+            if tok in _OPENERS:
+                depth += 1
+            elif tok in _CLOSERS:
+                depth -= 1
+            elif tok == ";" and depth == 0:
+                yield buf[:m.start()], False
+                buf, pos = buf[pos:], 0
+    yield buf, True
+
+def parse_statement(s:str, whole:bool) -> Expr:
+    '''Parses one statement; only a statement that is the whole script may be
+    a full expr (e.g. `run ...` or `blur(...)`): in a Seq every statement,
+    the last one too, is an expr0'''
+    try:
+        return (get_ast_parser() if whole else get_stmt_parser()).parse(s)
+    except Exception as e:
+        raise ParseError(e)
+
+def stream_eval(chunks:Iterable[str], env:Env[Value] = empty_env) -> Iterator[tuple[Expr, Value]]:
+    '''Parses and evaluates a script statement by statement, yielding each
+    statement with its value as soon as it has run'''
+    for i, (s, last) in enumerate(split_statements(chunks)):
+        e = parse_statement(s, last and i == 0)
+        yield e, evalInEnv(env, e)
+
+def read_chunks(f:TextIO, size:int = 1 << 16) -> Iterator[str]:
+    while chunk := f.read(size):
+        yield chunk
+
+def stream_run(f:TextIO):
+    '''Streams the script in f, then reports the value of its last statement'''
+    try:
+        result = None
+        for _, result in stream_eval(read_chunks(f)):
+            pass
+        report(result)
+    except ParseError as e:
+        print("parse error:")
+        print(e)
+    except evalError as e:
+        print(f"Evaluation error: {e}")
+
 def driver(s:str):
     try:
         #s = input('expr: ')
@@ -135,7 +324,15 @@ def test():
     driver(test1)
 
 if __name__ == "__main__":
-    test()
+    # python parse_run.py script.txt   (or - for stdin) streams a script
+    if len(sys.argv) > 1:
+        if sys.argv[1] == "-":
+            stream_run(sys.stdin)
+        else:
+            with open(sys.argv[1]) as f:
+                stream_run(f)
+    else:
+        test()
 
 
 ''' In this project milestone we have added 2 new
@@ -0,0 +1,43 @@
+'''Images on disk, by name or path, as shared handles.
+
+open() resolves a name the language knows (image1, image2) or a file path
+to a handle: an imageops.file() node, whose size and mode come from the
+file's header and whose pixels are decoded the first time an operation
+needs them, then kept on the handle, as are the smaller decodes a resize
+asks for (imageops.draft) and the whole decode a crop of a compressed file
+needs. Every reference to the same file gets the same handle, so however
+many times a script (or several scripts run in one process) mentions
+image1, it is decoded once at each size it is needed at. The registry holds its
+handles weakly: a handle lives as long as something (an AST, a value, a
+cache) refers to it, and when the last reference goes the decoded pixels go
+with it, and the next open() starts afresh. An AST node is held by
+interp's table of nodes after the AST is dropped, until the table is swept:
+interp.sweep() does it, and so does every full garbage collection (such as
+gc.collect()), so a handle an AST used is released by then.'''
+
+import os
+import weakref
+from pathlib import Path
+import imageops
+from imageops import LazyImage
+
+IMAGE_DIR = Path(__file__).parent / "Image"
+
+# the image names the language has built in
+NAMES = {"image1": IMAGE_DIR / "image1.jpg", "image2": IMAGE_DIR / "image2.jpg"}
+
+_handles: weakref.WeakValueDictionary[str, LazyImage] = weakref.WeakValueDictionary()
+
+
+def open(name: str | Path) -> LazyImage:
+    '''The handle of the image called name, or in file name'''
+    path = os.path.abspath(NAMES.get(name, name))
+    handle = _handles.get(path)
+    if handle is None:
+        handle = imageops.file(path)
+        _handles[path] = handle
+    return handle
+
+def handle_count() -> int:
+    '''How many handles are alive, for tests and benchmarks'''
+    return len(_handles)
@@ -0,0 +1,139 @@
+'''Lexical addressing.
+
+resolve() rewrites an Expr so that every variable is a (depth, slot) address
+into an array-backed frame instead of a name looked up in a tuple
+environment. Each function body (and the top level) gets one fixed-size
+frame: slot 0 links to the frame the function was defined in, slot 1 holds
+the parameter, and every let/letfun in the body gets its own slot. Without
+loops, a binder runs at most once per activation of its frame, so a slot
+doubles as the variable's memory location. depth counts how many frame
+links to follow, so binding and lookup cost O(1) no matter how many
+variables are in scope.'''
+
+from interp import Node, node, Expr, Seq, Show, Assign, Blur, Invert, Neg, Add, Sub, Mul, Div, \
+    Rotate, Combine, Resize, Crop, Name, Let, Or, And, Not, Eq, Lt, If, Darken, Lighten, Ifnz, \
+    Letfun, App, dom_color
+
+
+@node
+class Local(Node):
+    # a resolved Name; slot is None if the name is unbound
+    depth : int
+    slot : int | None
+    name : str
+    def __str__(self):
+        return self.name
+
+@node
+class AssignLocal(Node):
+    depth : int
+    slot : int | None
+    name : str
+    value : Expr
+    def __str__(self):
+        return f"{self.name} := {self.value}"
+
+@node
+class LetLocal(Node):
+    slot : int
+    name : str
+    value : Expr
+    body : Expr
+    def __str__(self):
+        return f"(let {self.name} = {self.value} in {self.body})"
+
+@node
+class LetfunLocal(Node):
+    slot : int          # slot of the function in the enclosing frame
+    size : int          # frame size of the body, including the link and parameter
+    name : str
+    params : str
+    bodyexpr : Expr
+    inexpr : Expr
+    def __str__(self) -> str:
+        return f"letfun {self.name} ({self.params}) = {self.bodyexpr} in {self.inexpr} end"
+
+
+class Scope:
+    '''The bindings of one frame, plus the frame it is nested in'''
+    def __init__(self, parent: "Scope | None"):
+        self.parent = parent
+        self.blocks: list[dict[str, int]] = [{}]
+        self.size = 1       # slot 0 is the link to the parent frame
+
+    def bind(self, name: str) -> int:
+        slot = self.size
+        self.size += 1
+        self.blocks[-1][name] = slot
+        return slot
+
+    def lookup(self, name: str) -> tuple[int, int | None]:
+        depth = 0
+        scope = self
+        while scope is not None:
+            for block in reversed(scope.blocks):
+                if name in block:
+                    return depth, block[name]
+            scope = scope.parent
+            depth += 1
+        return 0, None
+
+
+def resolve(e: Expr) -> tuple[Expr, int]:
+    '''Returns e with every variable addressed, and the top-level frame size'''
+    top = Scope(None)
+    return resolveIn(top, e), top.size
+
+def resolveIn(scope: Scope, e: Expr) -> Expr:
+    r = lambda x: resolveIn(scope, x)
+    match e:
+        case Name(name):
+            return Local(*scope.lookup(name), name)
+        case Assign(name, value):
+            return AssignLocal(*scope.lookup(name), name, r(value))
+        case Let(name, value, body):
+            v = r(value)
+            scope.blocks.append({})
+            slot = scope.bind(name)
+            b = r(body)
+            scope.blocks.pop()
+            return LetLocal(slot, name, v, b)
+        case Letfun(name, params, bodyexpr, inexpr):
+            scope.blocks.append({})
+            slot = scope.bind(name)
+            inner = Scope(scope)
+            inner.bind(params)
+            b = resolveIn(inner, bodyexpr)
+            i = r(inexpr)
+            scope.blocks.pop()
+            return LetfunLocal(slot, inner.size, name, params, b, i)
+        case Seq(exprs):
+            return Seq(*[r(x) for x in exprs])
+        case Add(a, b) | Sub(a, b) | Mul(a, b) | Div(a, b) | And(a, b) | Or(a, b) | \
+             Eq(a, b) | Lt(a, b) | Combine(a, b) | App(a, b):
+            return type(e)(r(a), r(b))
+        case Neg(a) | Not(a) | Show(a) | Blur(a) | Invert(a) | Rotate(a) | Darken(a) | Lighten(a) | \
+             dom_color(a):
+            return type(e)(r(a))
+        case If(c, t, f) | Ifnz(c, t, f) | Resize(c, t, f):
+            return type(e)(r(c), r(t), r(f))
+        case Crop(a, x, y, w, h):
+            return Crop(r(a), r(x), r(y), r(w), r(h))
+        case _:
+            # Lit, Read, images and anything without variables inside, or
+            # a node not known here (see unresolved)
+            return e
+
+def unresolved(e: Expr) -> bool:
+    '''Whether e still names a variable: resolveIn leaves the inside of a node
+    it does not know as it is, so such a node cannot run on a frame'''
+    todo = [e]
+    while todo:
+        x = todo.pop()
+        if isinstance(x, (Name, Assign)):
+            return True
+        if isinstance(x, Node):
+            todo.extend(getattr(x, f) for f in x.__match_args__)
+        elif isinstance(x, tuple):      # the statements of a Seq
+            todo.extend(x)
+    return False
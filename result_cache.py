@@ -0,0 +1,72 @@
+'''In-memory cache of computed images, by content.
+
+A key is the digest imageops gives a node of an image graph: a hash of its
+operation and the digests of its inputs, down to the pixels of the images
+it starts from (see imageops.digest). Equal keys mean equal pixels however
+the graph was built, so one ResultCache can serve every run() in a process
+and several equal subexpressions within one. Entries are kept under
+max_bytes by evicting the least recently used; hits, misses and evictions
+are counted. All methods take a lock, so force() may use it from a pool.'''
+
+import threading
+from collections import OrderedDict
+from PIL import Image
+
+
+# bytes per pixel of the modes whose bands are not one byte each
+WIDE_MODES = {"I": 4, "F": 4, "I;16": 2, "I;16B": 2, "I;16L": 2}
+
+def nbytes(img: Image.Image) -> int:
+    '''The size of img's pixels in memory'''
+    return img.size[0] * img.size[1] * WIDE_MODES.get(img.mode, len(img.getbands()))
+
+
+class ResultCache:
+    def __init__(self, max_bytes:int = 512 * 2**20):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[bytes, Image.Image] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key:bytes) -> Image.Image | None:
+        '''The image stored under key, or None on a miss'''
+        with self._lock:
+            img = self._entries.get(key)
+            if img is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)    # mark as recently used
+            self.hits += 1
+            return img
+
+    def put(self, key:bytes, img:Image.Image) -> None:
+        '''Stores img under key; an image bigger than the whole budget is not cached'''
+        size = nbytes(img)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= nbytes(old)
+            self._entries[key] = img
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= nbytes(evicted)
+                self.evictions += 1
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.bytes,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
@@ -0,0 +1,115 @@
+'''Out-of-core evaluation, a strip of rows at a time.
+
+stream() writes an image graph (see imageops.py) to a binary PGM/PPM file
+without ever holding the whole image: it computes rows 0..n of the result,
+writes them, and moves on to the next n rows. Each node is computed for a
+strip only, from the rows of its inputs it needs: the same rows for point
+operations, two more on either side for blur (the radius of its 5x5 kernel),
+the rows under it for a crop, and the matching rows of every source for a
+combine. Files made with
+imageops.file() are read a strip at a time as well, when they are stored
+uncompressed (PGM, PPM, uncompressed TIFF), so peak memory is set by the
+strip height and the width of the image, not by its size. A compressed file
+(a JPEG, say) cannot be decoded in parts by Pillow, so it is decoded whole,
+once, and its strips taken from that.
+
+The graph is rewritten (imageops.rewrite) first, so a chain of point
+operations is still one table per strip. A rotation needs every row of its
+input for any row of its output, so it cannot be streamed. Images already in
+memory (literals, or nodes computed earlier) give their rows by cropping.'''
+
+import os
+from pathlib import Path
+from PIL import Image
+import imageops
+from imageops import LazyImage, Pixels, apply, pending
+
+# the rows of context blur needs on either side of a strip
+BLUR_HALO = imageops.STRIPWISE["blur"]
+
+# netpbm magic numbers of the modes stream() can write
+MAGIC = {"L": b"P5", "RGB": b"P6"}
+
+
+def run(e, path: str | Path, rows: int = 256) -> tuple[int, int]:
+    '''Evaluates the image expression e, streaming the result to path'''
+    import interp
+    return stream(interp.eval(e), path, rows)
+
+def stream(v: Pixels, path: str | Path, rows: int = 256) -> tuple[int, int]:
+    '''Writes v to path as a PGM/PPM, rows at a time; returns its size'''
+    if v.mode not in MAGIC:
+        raise ValueError(f"cannot stream a {v.mode} image, only L or RGB")
+    r = imageops.rewrite(v) if pending(v) else v
+    for x in imageops.postorder(r):
+        if x.op == "file" and not seekable(x.arg):
+            imageops.force(x)
+    width, height = r.size
+    tmp = Path(f"{path}.tmp{os.getpid()}")
+    try:
+        with open(tmp, "wb") as out:
+            out.write(MAGIC[r.mode] + f"\n{width} {height}\n255\n".encode())
+            for top in range(0, height, rows):
+                out.write(strip(r, top, min(top + rows, height)).tobytes())
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return width, height
+
+def strip(x: Pixels, top: int, bottom: int) -> Image.Image:
+    '''Rows top..bottom of x, computed from the rows of its inputs they need'''
+    width = x.size[0]
+    if not pending(x):
+        img = x.image if isinstance(x, LazyImage) else x
+        return img.crop((0, top, width, bottom))
+    match x.op:
+        case "file":
+            return read_rows(x.arg, top, bottom)
+        case "region":
+            path, (left, above, right, _) = x.arg
+            return read_rows(path, above + top, above + bottom).crop((left, 0, right, bottom - top))
+        case "crop":
+            left, above = x.arg[:2]
+            return strip(x.inputs[0], above + top, above + bottom).crop((left, 0, left + width, bottom - top))
+        case "invert" | "brightness" | "point":
+            return apply(x.op, x.arg, [strip(x.inputs[0], top, bottom)], (width, bottom - top))
+        case "blur":
+            above, below = max(0, top - BLUR_HALO), min(bottom + BLUR_HALO, x.size[1])
+            out = apply("blur", None, [strip(x.inputs[0], above, below)], (width, below - above))
+            return out.crop((0, top - above, width, bottom - above))
+        case "combine" | "paste":
+            combined = Image.new(x.mode, (width, bottom - top))
+            lefts = x.arg[1] if x.op == "paste" else imageops.offsets(x.inputs)
+            for i, left in zip(x.inputs, lefts):
+                if top < i.size[1]:
+                    part = strip(i, top, min(bottom, i.size[1]))
+                    combined.paste(part if part.mode == x.mode else part.convert(x.mode), (left, 0))
+            return combined
+    raise ValueError(f"cannot stream {x.op}: it needs the whole image")
+
+def seekable(path: str) -> bool:
+    with Image.open(path) as img:
+        return raw_layout(img) is not None
+
+def read_rows(path: str, top: int, bottom: int) -> Image.Image:
+    '''Rows top..bottom of the uncompressed image in file path, reading no others'''
+    with Image.open(path) as img:
+        offset, stride = raw_layout(img)
+        img.fp.seek(offset + top * stride)
+        data = img.fp.read((bottom - top) * stride)
+        return Image.frombuffer(img.mode, (img.size[0], bottom - top), data, "raw", img.mode, stride, 1)
+
+def raw_layout(img: Image.Image) -> tuple[int, int] | None:
+    '''The offset of the first row and the bytes per row of img, if it is one
+    uncompressed, top-down block of rows in its own mode'''
+    if len(img.tile) != 1 or img.mode not in MAGIC:
+        return None
+    decoder, extents, offset, args = img.tile[0]
+    args = (args,) if isinstance(args, str) else tuple(args)
+    rawmode = args[0]
+    stride = args[1] if len(args) > 1 else 0
+    orientation = args[2] if len(args) > 2 else 1
+    if decoder != "raw" or rawmode != img.mode or orientation != 1 or extents != (0, 0) + img.size:
+        return None
+    return offset, stride or img.size[0] * len(img.getbands())
@@ -2,18 +2,38 @@
 
 import unittest
 import interp
+import compiler
+import vm
+import optimize
+import imageops
+import stream
+from result_cache import ResultCache, nbytes
+from disk_cache import DiskCache
+import registry
+import dominant
+import subprocess
+import sys
+from resolve import resolve, Local, LetLocal, LetfunLocal
 from interp  import Expr, Lit, Add, Sub, Mul, Div, Neg, And, Or, Not, \
                   Let, Name, Eq, Lt, If, Letfun, App, \
-                  Read, Show, Assign, Seq
+                  Read, Show, Assign, Seq, Blur, Invert, Rotate, Combine, Lighten, Darken, Resize, Crop, Ifnz, dom_color, image_color
 
 
 from io import StringIO
+import os
 import re
+import threading
+import tempfile
+from pathlib import Path
+from unittest import mock
 
 import contextlib
+from PIL import Image, ImageOps, ImageFilter, ImageEnhance, ImageChops, ImageStat
 from contextlib import redirect_stdout, redirect_stderr
 with redirect_stdout(None), redirect_stderr(None):
-    from parse_run import just_parse
+    import parse_run
+    from parse_run import just_parse, make_parser, ParseError, split_statements, stream_eval
+    from parse_cache import ParseCache
 
 class TestParsing(unittest.TestCase):
     def parse(self, concrete:str, expected:Expr|None):
@@ -1065,6 +1085,1218 @@ class TestEval(unittest.TestCase):
             inputs=["1"],
         )
 
+    def test_dom_color_bound(self):
+        # let x = <a (5, 6, 7) image> in dom_color(invert(x)) end
+        #
+        # => (250, 249, 248)
+        img = Image.new("RGB", (8, 8), (5, 6, 7))
+        self.eval_equal(
+            Let("x", Lit(img), dom_color(Invert(Name("x")))),
+            (250, 249, 248),
+        )
+        self.eval_except(Let("x", Lit(3), dom_color(Name("x"))))
+
+
+class TestParserModes(unittest.TestCase):
+    sources = [
+        "x", "123 + 456 * 7", "x && y || ! z", "x == y + z", "-x / -y",
+        "let x = a;b in c;d end", "letfun f(x) = a;b in c;d end",
+        "x := show y", "show x := y", "ifnz x then y else z := 3",
+        "(a;b);c", "f(g)(x)", "x; y := z; show w",
+        "run rotate(x)", "combine(lighten(x), darken(y))",
+    ]
+
+    def test_lalr_strict(self):
+        try:
+            import interegular
+        except ImportError:
+            self.skipTest("strict mode needs interegular")
+        make_parser("lalr", strict=True)
+
+    def test_same_ast(self):
+        lalr, earley = make_parser("lalr"), make_parser("earley")
+        for s in self.sources:
+            self.assertEqual(just_parse(s, lalr), just_parse(s, earley), s)
+
+    def test_table_cache(self):
+        with tempfile.TemporaryDirectory() as d, mock.patch.object(parse_run, "CACHE_DIR", Path(d)):
+            cold = make_parser("lalr")
+            self.assertEqual(len(list(Path(d).iterdir())), 1)
+            warm = make_parser("lalr")
+            for s in self.sources:
+                self.assertEqual(just_parse(s, warm), just_parse(s, cold), s)
+
+    def test_one_pass_ast(self):
+        lalr = make_parser("lalr")
+        for s in self.sources:
+            self.assertEqual(just_parse(s), just_parse(s, lalr), s)
+
+    def test_same_errors(self):
+        lalr, earley = make_parser("lalr"), make_parser("earley")
+        for s in ["x == y == z", "x < !y", "let x = in y end", "x +"]:
+            with self.assertRaises(ParseError):
+                just_parse(s, lalr)
+            with self.assertRaises(ParseError):
+                just_parse(s, earley)
+            with self.assertRaises(ParseError):
+                just_parse(s)
+
+
+class TestParseCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.cache = ParseCache(Path(self.dir.name), "v1")
+
+    def test_roundtrip(self):
+        s = "let x = 1 in x + 2; show x end"
+        self.assertIsNone(self.cache.get(s))
+        self.cache.put(s, just_parse(s))
+        self.assertEqual(self.cache.get(s), just_parse(s))
+
+    def test_images_by_path(self):
+        s = "combine(image1, image2)"
+        self.cache.put(s, just_parse(s))
+        got = self.cache.get(s)
+        self.assertIs(got.image1, registry.open("image1"))
+        self.assertLess(sum(p.stat().st_size for p in Path(self.dir.name).iterdir()), 1000)
+
+    def test_version_invalidates(self):
+        self.cache.put("x", Name("x"))
+        self.assertIsNone(ParseCache(Path(self.dir.name), "v2").get("x"))
+
+    def test_lru_eviction(self):
+        self.cache.put("a", Name("a"))
+        size = self.cache.path("a").stat().st_size
+        self.cache.max_bytes = 2 * size
+        self.cache.put("b", Name("b"))
+        os.utime(self.cache.path("a"), (0, 0))    # make "a" the least recently used
+        self.cache.put("c", Name("c"))
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.get("b"), Name("b"))
+        self.assertEqual(self.cache.get("c"), Name("c"))
+
+    def test_failed_write_leaves_nothing(self):
+        with mock.patch("os.replace", side_effect=OSError("disk full")):
+            self.cache.put("x", Name("x"))
+        self.assertEqual(list(Path(self.dir.name).iterdir()), [])
+
+    def test_version_covers_image_handles(self):
+        v = parse_run.ast_version()
+        read_bytes = Path.read_bytes
+        def edited(p):
+            return read_bytes(p) + (b"#" if p.name == "registry.py" else b"")
+        with mock.patch.object(Path, "read_bytes", edited):
+            self.assertNotEqual(parse_run.ast_version(), v)
+
+
+class TestStreaming(unittest.TestCase):
+    script = "let x = 1 in x; y end; f(a;b);\nifnz c then d; e else g; letfun h(z) = z in h end; w"
+
+    def chunked(self, s, n):
+        return [s[i:i+n] for i in range(0, len(s), n)]
+
+    def test_split(self):
+        self.assertEqual(
+            [s.strip() for s, _ in split_statements([self.script])],
+            ["let x = 1 in x; y end", "f(a;b)", "ifnz c then d; e else g",
+             "letfun h(z) = z in h end", "w"])
+
+    def test_split_any_chunking(self):
+        whole = list(split_statements([self.script]))
+        for n in (1, 2, 3, 5, 8):
+            self.assertEqual(list(split_statements(self.chunked(self.script, n))), whole)
+
+    def test_same_statements(self):
+        # the streamed statements are exactly the statements of the Seq
+        stmts = [parse_run.parse_statement(s, False)
+                 for s, _ in split_statements(self.chunked(self.script, 4))]
+        self.assertEqual(just_parse(self.script).exprs, tuple(stmts))
+
+    def test_run_takes_rest(self):
+        self.assertEqual(list(split_statements(["run x;", " y"])), [("run x; y", True)])
+
+    def test_only_whole_script_may_be_expr(self):
+        parse_run.parse_statement("run 1", True)
+        with self.assertRaises(ParseError):
+            parse_run.parse_statement("run 1", False)
+        with self.assertRaises(ParseError):
+            list(stream_eval(["1; run 2; 3"]))
+
+    def test_same_language(self):
+        # streaming accepts exactly the scripts just_parse does
+        for script in ["1; blur(2)", "x; run y", "1; 2; run 3", "blur(2)", "run x; y", "1; 2", "show 1; x := 2"]:
+            try:
+                just_parse(script)
+                whole = True
+            except ParseError:
+                whole = False
+            try:
+                with mock.patch.object(parse_run, "evalInEnv"):     # parsing is what is compared
+                    list(stream_eval([script]))
+                streamed = True
+            except ParseError:
+                streamed = False
+            self.assertEqual(streamed, whole, script)
+
+    def test_stream_eval(self):
+        out = StringIO()
+        with redirect_stdout(out):
+            values = [v for _, v in stream_eval(self.chunked("show 1; show 2 + 3; 4 < 5", 3))]
+        self.assertEqual(values, [1, 5, True])
+        self.assertEqual(out.getvalue(), "1\n5\n")
+
+
+class TestFlatSeq(unittest.TestCase):
+    def test_flat(self):
+        self.assertEqual(just_parse("x;y;z").exprs, (Name("x"), Name("y"), Name("z")))
+        self.assertEqual(Seq(Seq(Name("a"), Name("b")), Name("c")).exprs,
+                         (Name("a"), Name("b"), Name("c")))
+
+    def test_long_script(self):
+        n = 5000
+        e = just_parse("; ".join(f"{i} + 1" for i in range(n)))
+        self.assertEqual(len(e.exprs), n)
+        self.assertEqual(interp.eval(e), n)
+
+    def test_constant_stack(self):
+        e = Seq(*[Add(Lit(i), Lit(1)) for i in range(100000)])
+        self.assertEqual(interp.eval(e), 100000)
+
+
+class TestEvalClosure(TestEval):
+    # every TestEval case again, on the closure-compiled backend
+    def eval_with(self, expr, inputs):
+        with redirect_stdin(StringIO("\n".join(inputs) + "\n")):
+            return compiler.eval(expr)
+
+    def test_fib(self):
+        e = just_parse("letfun fib(n) = ifnz n < 2 then n else fib(n - 1) + fib(n - 2) in fib(15) end")
+        self.assertEqual(compiler.eval(e), 610)
+        self.assertEqual(interp.eval(e), 610)
+
+
+class TestEvalFrames(TestEval):
+    # every TestEval case again, with variables resolved to frame slots
+    def eval_with(self, expr, inputs):
+        with redirect_stdin(StringIO("\n".join(inputs) + "\n")):
+            return compiler.eval_frames(expr)
+
+    def test_addresses(self):
+        e, size = resolve(just_parse("let x = 1 in letfun f(y) = x + y in f(2) end end"))
+        self.assertEqual(size, 3)
+        self.assertEqual(e.value, Lit(1))
+        self.assertIsInstance(e, LetLocal)
+        self.assertIsInstance(e.body, LetfunLocal)
+        self.assertEqual(e.body.bodyexpr, Add(Local(1, 1, "x"), Local(0, 1, "y")))
+        self.assertEqual(e.body.inexpr.fun, Local(0, 2, "f"))
+
+    def test_deep_lets(self):
+        n = 300
+        s = "".join(f"let x{i} = {i} in " for i in range(n)) + "x0 + x299" + " end" * n
+        self.assertEqual(compiler.eval_frames(just_parse(s)), 299)
+
+    def test_dom_color(self):
+        img = Image.new("RGB", (4, 4), (10, 20, 30))
+        e = Let("x", Lit(img), dom_color(Name("x")))
+        self.assertEqual(resolve(e)[0].body, dom_color(Local(0, 1, "x")))
+        self.assertEqual(compiler.eval_frames(e), (10, 20, 30))
+
+    def test_unknown_node_refused(self):
+        # a node resolve() does not know keeps its names, which have no
+        # address in a frame: it fails cleanly, and only when it runs
+        img = Image.new("RGB", (4, 4))
+        e = Let("x", Lit(img), image_color(Name("x")))
+        with self.assertRaises(interp.evalError):
+            compiler.eval_frames(e)
+        self.assertEqual(compiler.eval_frames(Ifnz(Lit(0), e, Lit(3))), 3)
+
+
+class TestTailCalls(unittest.TestCase):
+    # loop(n) recurses only through tail positions: a Let body, the last
+    # statement of a Seq, an ifnz branch and a function body
+    loop = "letfun loop(n) = let m = n - 1 in ifnz m then (0; loop(m)) else 7 end in loop({}) end"
+
+    def test_tree(self):
+        self.assertEqual(interp.eval(just_parse(self.loop.format(20000))), 7)
+
+    def test_compiled(self):
+        e = just_parse(self.loop.format(100000))
+        self.assertEqual(compiler.eval(e), 7)
+        self.assertEqual(compiler.eval_frames(e), 7)
+
+    def test_non_tail_still_works(self):
+        e = just_parse("letfun sum(n) = ifnz n then n + sum(n - 1) else 0 in sum(100) end")
+        for backend in interp.BACKENDS:
+            self.assertEqual(interp.evaluate(e, backend), 5050)
+
+
+class TestEvalVM(TestEval):
+    # every TestEval case again, on the bytecode VM
+    def eval_with(self, expr, inputs):
+        with redirect_stdin(StringIO("\n".join(inputs) + "\n")):
+            return vm.eval(expr)
+
+    def test_jumps(self):
+        f = vm.compile_program(just_parse("ifnz x && y then 1 else 2"))
+        self.assertEqual([vm.OPNAMES[op] for op in f.ops],
+                         ["FAIL", "AND_JUMP", "FAIL", "CHECK_BOOL", "JUMP_IF_ZERO",
+                          "CONST", "JUMP", "CONST", "RETURN"])
+        self.assertEqual(f.args[1], 4)    # past the right operand
+        self.assertEqual(f.args[4], 7)    # to the else branch
+        self.assertEqual(f.args[6], 8)    # past the else branch
+
+    def test_deep_recursion(self):
+        # non-tail calls use the VM's own call stack, not Python's
+        e = just_parse("letfun sum(n) = ifnz n then n + sum(n - 1) else 0 in sum(50000) end")
+        self.assertEqual(vm.eval(e), 50000 * 50001 // 2)
+
+    def test_dom_color(self):
+        img = Image.new("RGB", (4, 4), (10, 20, 30))
+        e = Let("x", Lit(img), dom_color(Name("x")))
+        self.assertIn(vm.DOM_COLOR, vm.compile_program(e).ops)
+        self.assertEqual(vm.eval(e), (10, 20, 30))
+
+    def test_unknown_node_refused(self):
+        img = Image.new("RGB", (4, 4))
+        e = Let("x", Lit(img), image_color(Name("x")))
+        with self.assertRaises(interp.evalError):
+            vm.eval(e)
+        self.assertEqual(vm.eval(Ifnz(Lit(0), e, Lit(3))), 3)
+
+
+class TestEvalFolded(TestEval):
+    # every TestEval case again, constant-folded first
+    def eval_with(self, expr, inputs):
+        with redirect_stdin(StringIO("\n".join(inputs) + "\n")):
+            return interp.eval(optimize.fold(expr))
+
+    def test_folds(self):
+        self.assertEqual(optimize.fold(just_parse("1 + 2 * 3 - -4")), Lit(11))
+        self.assertEqual(optimize.fold(just_parse("1 < 2 && !(3 == 4)")), Lit(True))
+        self.assertEqual(optimize.fold(just_parse("let x = 2 in let y = x * x in y + x end end")), Lit(6))
+
+    def test_inlined_into_every_node(self):
+        # a constant binding inlined away must be substituted wherever the
+        # body uses it, inside dom_color and nodes with no rule of their own
+        img = Image.new("RGB", (4, 4), (10, 20, 30))
+        e = optimize.fold(Let("x", Lit(img), dom_color(Name("x"))))
+        self.assertEqual(e, dom_color(Lit(img)))
+        self.assertEqual(interp.eval(e), (10, 20, 30))
+        e = optimize.fold(Let("x", Lit(img), image_color(Invert(Name("x")))))
+        self.assertEqual(e, image_color(Invert(Lit(img))))
+        self.assertEqual(optimize.fold(just_parse("ifnz 2 - 2 then x else y")), Name("y"))
+        self.assertEqual(optimize.fold(If(Lit(True), Name("a"), Name("b"))), Name("a"))
+        self.assertEqual(optimize.fold(And(Lit(False), Name("x"))), Lit(False))
+        self.assertEqual(optimize.fold(Or(Lit(True), Name("x"))), Lit(True))
+
+    def test_partial(self):
+        e = optimize.fold(just_parse("letfun f(n) = n + (2 * 3) in f(1 + 1) end"))
+        self.assertEqual(e, Letfun("f", "n", Add(Name("n"), Lit(6)), App(Name("f"), Lit(2))))
+
+    def test_errors_stay(self):
+        for s in ["1 / 0", "!3", "1 + (2 < 3)", "let x = 0 in 5 / x end", "true && 1"]:
+            e = optimize.fold(just_parse(s))
+            self.assertNotIsInstance(e, Lit, s)
+            with self.assertRaises(interp.evalError):
+                interp.eval(e)
+        # an error that would never run is dropped with its branch
+        self.assertEqual(optimize.fold(just_parse("ifnz 1 then 2 else 1 / 0")), Lit(2))
+
+    def test_scoping(self):
+        # assigned names are locations, not constants
+        e = just_parse("let x = 1 in (x := 5; x) end")
+        self.assertEqual(optimize.fold(e), e)
+        # inner binders shadow an inlined constant
+        e = optimize.fold(just_parse("let x = 1 in letfun f(x) = x + 1 in f(x) end end"))
+        self.assertEqual(e, Letfun("f", "x", Add(Name("x"), Lit(1)), App(Name("f"), Lit(1))))
+        e = optimize.fold(just_parse("let x = 1 in let x = y in x end end"))
+        self.assertEqual(e, Let("x", Name("y"), Name("x")))
+
+    def test_backends(self):
+        e = just_parse("letfun fib(n) = ifnz n < 1 + 1 then n else fib(n - 1) + fib(n - (3 - 1)) in fib(12) end")
+        for backend in interp.BACKENDS:
+            self.assertEqual(interp.evaluate(e, backend, optimize=True), 144)
+
+
+class TestInterning(unittest.TestCase):
+    def test_shared(self):
+        self.assertIs(Add(Lit(1), Name("x")), Add(Lit(1), Name("x")))
+        e = just_parse("(x + 1) * (x + 1)")
+        self.assertIs(e.left, e.right)
+        self.assertIs(just_parse("let y = 2 in y end"), Let("y", Lit(2), Name("y")))
+        self.assertIs(Read(), Read(""))
+        self.assertIs(Seq(Name("a"), Seq(Name("b"), Name("c"))), Seq(Seq(Name("a"), Name("b")), Name("c")))
+
+    def test_distinct(self):
+        self.assertIsNot(Lit(True), Lit(1))
+        self.assertIsNot(Lit(False), Lit(0))
+        self.assertNotEqual(Add(Lit(1), Lit(2)), Add(Lit(2), Lit(1)))
+        self.assertNotEqual(Add(Lit(1), Lit(2)), Sub(Lit(1), Lit(2)))
+
+    def test_collision(self):
+        # hash(-1) == hash(-2), so these two nodes share a hash
+        a, b = Lit(-1), Lit(-2)
+        self.assertEqual(hash(a), hash(b))
+        self.assertNotEqual(a, b)
+        self.assertEqual(Lit(-1), a)
+        self.assertEqual(Lit(-2).value, -2)
+
+    def test_frozen(self):
+        e = Add(Lit(1), Lit(2))
+        self.assertFalse(hasattr(e, "__dict__"))
+        with self.assertRaises(AttributeError):
+            e.left = Lit(3)
+
+    def test_hash(self):
+        e = just_parse("letfun f(n) = n * 2 in f(3) end")
+        self.assertEqual(hash(e), hash(Letfun("f", "n", Mul(Name("n"), Lit(2)), App(Name("f"), Lit(3)))))
+        self.assertEqual(len({Lit(1), Lit(1), Lit(True)}), 2)
+
+    def test_pickle(self):
+        import pickle
+        e = just_parse("let x = 1 in x + 2; x end")
+        self.assertIs(pickle.loads(pickle.dumps(e)), e)
+
+    def test_sweep(self):
+        import gc
+        gc.collect()    # closures from other tests may hold nodes in cycles
+        before = interp.node_count()
+        e = Seq(*[Add(Name(f"swept{i}"), Lit(10**6 + i)) for i in range(1000)])
+        self.assertEqual(interp.node_count(), before + 3001)
+        del e
+        self.assertEqual(interp.node_count(), before)
+
+
+def gradient(w, h, mode="RGB"):
+    # a small image with every pixel different enough to catch a wrong op
+    img = Image.new(mode, (w, h))
+    img.putdata([((x * 37 + y * 11) % 256, (x * 5 + y * 53) % 256, (x * y) % 256)[:len(mode)]
+                 if len(mode) > 1 else (x * 37 + y * 11) % 256
+                 for y in range(h) for x in range(w)])
+    return img
+
+class TestLazyImages(unittest.TestCase):
+    def setUp(self):
+        self.square = gradient(16, 16)
+        self.tall = gradient(12, 20)
+
+    def run_lazily(self, e):
+        before = imageops.passes
+        v = interp.eval(e)
+        self.assertEqual(imageops.passes, before)   # nothing computed yet
+        self.assertIsInstance(v, imageops.LazyImage)
+        return imageops.force(v), imageops.passes - before
+
+    def test_rotations_merge(self):
+        img, passes = self.run_lazily(Rotate(Rotate(Rotate(Lit(self.square)))))
+        self.assertEqual(passes, 1)
+        self.assertEqual(img.tobytes(), self.square.rotate(90).rotate(90).rotate(90).tobytes())
+        img, passes = self.run_lazily(Rotate(Rotate(Rotate(Rotate(Lit(self.square))))))
+        self.assertEqual(passes, 0)
+        self.assertIs(img, self.square)
+
+    def test_non_square_rotations(self):
+        img, passes = self.run_lazily(Rotate(Rotate(Lit(self.tall))))
+        self.assertEqual(passes, 1)
+        self.assertEqual(img.tobytes(), self.tall.transpose(Image.Transpose.ROTATE_180).tobytes())
+
+    def test_inverts_cancel(self):
+        img, passes = self.run_lazily(Invert(Invert(Blur(Lit(self.tall)))))
+        self.assertEqual(passes, 1)
+        self.assertEqual(img.tobytes(), ImageOps.invert(ImageOps.invert(self.tall.filter(ImageFilter.BLUR))).tobytes())
+
+    def test_brightness_merges(self):
+        img, passes = self.run_lazily(Lighten(Darken(Lit(self.tall))))
+        self.assertEqual(passes, 1)
+        eager = ImageEnhance.Brightness(ImageEnhance.Brightness(self.tall).enhance(0.5)).enhance(1.5)
+        self.assertEqual(img.tobytes(), eager.tobytes())
+
+    def test_shared_once(self):
+        e = Let("x", Lighten(Lit(self.square)), Combine(Name("x"), Invert(Name("x"))))
+        img, passes = self.run_lazily(e)
+        self.assertEqual(passes, 3)
+        self.assertEqual(img.size, (32, 16))
+
+    def test_forced_by_eq_and_show(self):
+        e = Eq(Invert(Lit(self.square)), Lit(self.square))
+        self.assertEqual(interp.eval(e), ImageOps.invert(self.square).tobytes())
+        with mock.patch.object(Image.Image, "show") as shown:
+            v = interp.eval(Show(Blur(Lit(self.square))))
+        shown.assert_called_once()
+        self.assertIsNotNone(v.image)
+
+    def test_errors_stay_eager(self):
+        with self.assertRaises(interp.evalError):
+            interp.eval(Combine(Lit(self.square), Lit(self.tall)))
+
+    def test_backends(self):
+        e = Combine(Rotate(Rotate(Lit(self.square))), Lighten(Darken(Lit(self.square))))
+        results = {b: interp.evaluate(e, b).tobytes() for b in interp.BACKENDS}
+        self.assertEqual(len(set(results.values())), 1)
+
+    def test_deep_chain(self):
+        # forcing walks the graph without recursion; 5001 inverts leave one
+        v = self.square
+        for _ in range(5001):
+            v = imageops.invert(v)
+        before = imageops.passes
+        self.assertEqual(imageops.force(v).tobytes(), ImageOps.invert(self.square).tobytes())
+        self.assertEqual(imageops.passes - before, 1)
+
+
+class TestPointOps(unittest.TestCase):
+    eager = {
+        "invert": ImageOps.invert,
+        "lighten": lambda i: ImageEnhance.Brightness(i).enhance(1.5),
+        "darken": lambda i: ImageEnhance.Brightness(i).enhance(0.5),
+    }
+    lazy = {"invert": interp.invert, "lighten": interp.lighten, "darken": interp.darken}
+
+    def check(self, img, chain):
+        want = img
+        got = img
+        for op in chain:
+            want = self.eager[op](want)
+            got = self.lazy[op](got)
+        before = imageops.passes
+        self.assertEqual(imageops.force(got).tobytes(), want.tobytes(), chain)
+        return imageops.passes - before
+
+    def test_chains_exact(self):
+        import random
+        rng = random.Random(7)
+        img = gradient(23, 17)
+        for n in range(1, 8):
+            chain = [rng.choice(list(self.eager)) for _ in range(n)]
+            self.assertLessEqual(self.check(img, chain), 1)
+
+    def test_clipping_order(self):
+        img = gradient(9, 9)
+        self.assertEqual(self.check(img, ["lighten", "darken"]), 1)
+        self.assertEqual(self.check(img, ["lighten", "lighten", "invert", "darken"]), 1)
+
+    def test_identity_free(self):
+        img = gradient(9, 9, "L")
+        self.assertEqual(self.check(img, ["invert", "invert"]), 0)
+        self.assertIs(imageops.force(interp.invert(interp.invert(img))), img)
+
+    def test_one_table(self):
+        v = imageops.rewrite(interp.invert(interp.lighten(interp.darken(gradient(4, 4)))))
+        self.assertEqual(v.op, "point")
+        self.assertNotIsInstance(v.inputs[0], imageops.LazyImage)
+        self.assertEqual(v.arg[:4], (255, 255, 254, 254))
+
+    def test_other_modes_op_by_op(self):
+        img = Image.new("RGBA", (5, 5), (10, 200, 30, 40))
+        got = imageops.force(interp.lighten(interp.darken(img)))
+        self.assertEqual(got.getpixel((0, 0)), (7, 150, 22, 40))
+
+
+class TestRotate(unittest.TestCase):
+    def setUp(self):
+        self.tall = gradient(12, 20)
+
+    def test_lossless(self):
+        v = interp.rotate(self.tall)
+        self.assertEqual(v.size, (20, 12))
+        img = imageops.force(v)
+        self.assertEqual(img.tobytes(), self.tall.transpose(Image.Transpose.ROTATE_90).tobytes())
+        four = imageops.force(interp.rotate(interp.rotate(interp.rotate(v))))
+        self.assertEqual(four.tobytes(), self.tall.tobytes())
+
+    def test_turns_pass_point_ops_and_blur(self):
+        v = interp.rotate(interp.blur(interp.invert(interp.rotate(interp.lighten(interp.rotate(self.tall))))))
+        want = self.tall.transpose(Image.Transpose.ROTATE_90)
+        want = ImageEnhance.Brightness(want).enhance(1.5).transpose(Image.Transpose.ROTATE_90)
+        want = ImageOps.invert(want).filter(ImageFilter.BLUR).transpose(Image.Transpose.ROTATE_90)
+        before = imageops.passes
+        self.assertEqual(imageops.force(v).tobytes(), want.tobytes())
+        self.assertEqual(imageops.passes - before, 3)    # one table, one blur, one transpose
+
+    def test_combine_sees_rotated_size(self):
+        # rotate no longer pads to the old canvas, so heights must really match
+        with self.assertRaises(interp.evalError):
+            interp.combine(interp.rotate(self.tall), self.tall)
+        v = interp.combine(interp.rotate(self.tall), interp.rotate(self.tall))
+        self.assertEqual(imageops.force(v).size, (40, 12))
+
+    def test_shared_rotation_once(self):
+        r = interp.rotate(interp.rotate(interp.rotate(self.tall)))
+        before = imageops.passes
+        img = imageops.force(interp.combine(r, r))
+        self.assertEqual(imageops.passes - before, 2)    # one transpose, then the combine
+        self.assertEqual(img.size, (40, 12))
+
+
+class TestCombine(unittest.TestCase):
+    def pairwise(self, imgs):
+        # the old binary combine: a new canvas and both sources at every level
+        strip = imgs[0]
+        for img in imgs[1:]:
+            out = Image.new("RGB", (strip.width + img.width, img.height))
+            out.paste(strip, (0, 0))
+            out.paste(img, (strip.width, 0))
+            strip = out
+        return strip
+
+    def test_strip_one_pass(self):
+        imgs = [gradient(3 + i, 10) for i in range(6)]
+        v = imgs[0]
+        for img in imgs[1:]:
+            v = interp.combine(v, img)
+        before = imageops.passes
+        self.assertEqual(imageops.force(v).tobytes(), self.pairwise(imgs).tobytes())
+        self.assertEqual(imageops.passes - before, 1)
+
+    def test_flattens_either_side(self):
+        a, b, c, d = (gradient(4, 6) for _ in range(4))
+        r = imageops.rewrite(interp.combine(interp.combine(a, b), interp.combine(c, interp.invert(d))))
+        self.assertEqual(r.op, "combine")
+        self.assertEqual(len(r.inputs), 4)
+        self.assertEqual(r.inputs[:3], (a, b, c))
+
+    def test_computed_inner_kept(self):
+        a, b = gradient(4, 6), gradient(5, 6)
+        inner = interp.combine(a, b)
+        imageops.force(inner)
+        r = imageops.rewrite(interp.combine(inner, a))
+        self.assertIs(r.inputs[0], inner)
+
+    def test_modes_preserved(self):
+        grey, rgb = gradient(4, 6, "L"), gradient(5, 6)
+        rgba = Image.new("RGBA", (3, 6), (1, 2, 3, 4))
+        self.assertEqual(imageops.force(interp.combine(grey, grey)).mode, "L")
+        self.assertEqual(imageops.force(interp.combine(rgba, rgba)).getpixel((0, 0)), (1, 2, 3, 4))
+        mixed = imageops.force(interp.combine(interp.combine(grey, rgb), rgba))
+        self.assertEqual(mixed.mode, "RGBA")
+        self.assertEqual(mixed.getpixel((1, 0)), grey.convert("RGBA").getpixel((1, 0)))
+        self.assertEqual(interp.combine(grey, rgb).mode, "RGB")
+
+    def test_backends(self):
+        a, b = gradient(4, 6, "L"), gradient(5, 6, "L")
+        e = Combine(Combine(Lit(a), Invert(Lit(b))), Combine(Lit(b), Lit(a)))
+        results = {b: interp.evaluate(e, b) for b in interp.BACKENDS}
+        self.assertEqual({r.mode for r in results.values()}, {"L"})
+        self.assertEqual(len({r.tobytes() for r in results.values()}), 1)
+
+
+class TestParallel(unittest.TestCase):
+    def setUp(self):
+        self.a, self.b = gradient(16, 12), gradient(9, 12)
+
+    def test_same_result(self):
+        e = Let("x", Blur(Lit(self.a)),
+                Combine(Combine(Name("x"), Rotate(Rotate(Invert(Lit(self.a))))), Lighten(Blur(Lit(self.b)))))
+        for backend in interp.BACKENDS:
+            before = imageops.passes
+            want = interp.evaluate(e, backend)
+            sequential = imageops.passes - before
+            got = interp.evaluate(e, backend, workers=4)
+            self.assertEqual(imageops.passes - before, 2 * sequential)
+            self.assertEqual(got.tobytes(), want.tobytes(), backend)
+
+    def test_branches_overlap(self):
+        # both blurs must be running at once to get past the barrier
+        barrier = threading.Barrier(2, timeout=5)
+        apply = imageops.apply
+        def meeting(op, *args):
+            if op == "blur":
+                barrier.wait()
+            return apply(op, *args)
+        with mock.patch.object(imageops, "apply", meeting):
+            img = interp.evaluate(Combine(Blur(Lit(self.a)), Blur(Lit(self.b))), workers=2)
+        self.assertEqual(img.size, (25, 12))
+
+    def test_show_order_kept(self):
+        shown = []
+        with mock.patch.object(Image.Image, "show", lambda img: shown.append(img.size)):
+            interp.evaluate(Seq(Show(Blur(Lit(self.a))), Show(Invert(Lit(self.b))), Show(Lit(self.a))), workers=4)
+        self.assertEqual(shown, [(16, 12), (9, 12), (16, 12)])
+
+    def test_error_propagates(self):
+        def broken(op, *args):
+            raise OSError("decoder failed")
+        with mock.patch.object(imageops, "apply", broken):
+            with self.assertRaises(OSError):
+                interp.evaluate(Combine(Blur(Lit(self.a)), Blur(Lit(self.b))), workers=2)
+        self.assertIsNone(imageops.pool)
+
+
+class TestStrips(unittest.TestCase):
+    def setUp(self):
+        self.noise = Image.frombytes("RGB", (13, 29), os.urandom(13 * 29 * 3))
+
+    def check(self, make, eager, pixels):
+        with mock.patch.object(imageops, "STRIP_PIXELS", pixels), imageops.parallel(3):
+            before = imageops.passes
+            got = imageops.force(make(self.noise))
+        self.assertEqual(imageops.passes - before, 1)
+        self.assertEqual(got.tobytes(), eager(self.noise).tobytes(), pixels)
+
+    def test_blur_exact(self):
+        # strips of 1, 2, 3, 7 and 15 rows: thinner and thicker than the halo
+        for pixels in (13, 26, 39, 91, 195):
+            self.check(interp.blur, lambda i: i.filter(ImageFilter.BLUR), pixels)
+
+    def test_point_ops_exact(self):
+        make = lambda i: interp.invert(interp.lighten(i))
+        eager = lambda i: ImageOps.invert(ImageEnhance.Brightness(i).enhance(1.5))
+        for pixels in (13, 50, 200):
+            self.check(make, eager, pixels)
+        rgba = self.noise.convert("RGBA")
+        with mock.patch.object(imageops, "STRIP_PIXELS", 30), imageops.parallel(2):
+            got = imageops.force(interp.darken(rgba))
+        self.assertEqual(got.tobytes(), ImageEnhance.Brightness(rgba).enhance(0.5).tobytes())
+
+    def test_strips_cover_rows(self):
+        with mock.patch.object(imageops, "STRIP_PIXELS", 100):
+            self.assertEqual(imageops.strips((10, 25), 2), [(0, 10, 0, 12), (10, 20, 8, 22), (20, 25, 18, 25)])
+
+    def test_small_images_whole(self):
+        with mock.patch.object(imageops, "apply_strip") as strip, imageops.parallel(2):
+            imageops.force(interp.blur(self.noise))
+        strip.assert_not_called()
+
+
+class TestStream(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.a = Image.frombytes("RGB", (11, 23), os.urandom(11 * 23 * 3))
+        self.b = Image.frombytes("L", (7, 23), os.urandom(7 * 23))
+        self.paths = [self.path("a.ppm"), self.path("b.pgm")]
+        self.a.save(self.paths[0])
+        self.b.save(self.paths[1])
+
+    def path(self, name):
+        return os.path.join(self.dir.name, name)
+
+    def graph(self):
+        a, b = (imageops.file(p) for p in self.paths)
+        return interp.invert(interp.lighten(interp.blur(interp.combine(a, interp.blur(interp.blur(b))))))
+
+    def test_exact(self):
+        want = imageops.force(self.graph())
+        for rows in (1, 2, 5, 23, 100):
+            out = self.path(f"out{rows}.ppm")
+            self.assertEqual(stream.stream(self.graph(), out, rows), want.size)
+            with Image.open(out) as got:
+                self.assertEqual(got.tobytes(), want.tobytes(), rows)
+
+    def test_reads_strips_only(self):
+        spans = []
+        read_rows = stream.read_rows
+        def spy(path, top, bottom):
+            spans.append(bottom - top)
+            return read_rows(path, top, bottom)
+        with mock.patch.object(stream, "read_rows", spy):
+            stream.stream(self.graph(), self.path("out.ppm"), 4)
+        self.assertLessEqual(max(spans), 4 + 2 * 3 * stream.BLUR_HALO)     # three blurs deep
+        self.assertTrue(os.path.exists(self.path("out.ppm")))
+
+    def test_compressed_decoded_once(self):
+        jpeg = self.path("a.jpg")
+        self.a.save(jpeg)
+        with mock.patch.object(stream, "read_rows") as read_rows:
+            stream.stream(interp.darken(imageops.file(jpeg)), self.path("out.ppm"), 5)
+        read_rows.assert_not_called()
+        with Image.open(jpeg) as img, Image.open(self.path("out.ppm")) as got:
+            self.assertEqual(got.tobytes(), ImageEnhance.Brightness(img).enhance(0.5).tobytes())
+
+    def test_expression(self):
+        e = Combine(Invert(Lit(self.a)), Blur(Lit(self.a)))
+        stream.run(e, self.path("out.ppm"), 6)
+        with Image.open(self.path("out.ppm")) as got:
+            self.assertEqual(got.tobytes(), interp.evaluate(e).tobytes())
+
+    def test_unstreamable(self):
+        with self.assertRaises(ValueError):
+            stream.stream(interp.rotate(imageops.file(self.paths[0])), self.path("out.ppm"))
+        with self.assertRaises(ValueError):
+            stream.stream(self.a.convert("RGBA"), self.path("out.ppm"))
+        self.assertEqual(sorted(os.listdir(self.dir.name)), ["a.ppm", "b.pgm"])    # nothing half-written
+
+    def test_file_is_lazy(self):
+        v = imageops.file(self.paths[0])
+        self.assertEqual((v.size, v.mode), ((11, 23), "RGB"))
+        self.assertIsNone(v.image)
+        self.assertEqual(imageops.force(interp.invert(v)).tobytes(), ImageOps.invert(self.a).tobytes())
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.a = gradient(20, 10)
+        self.cache = ResultCache()
+
+    def evaluate(self, e, **kwargs):
+        before = imageops.passes
+        img = interp.evaluate(e, cache=self.cache, **kwargs)
+        return img, imageops.passes - before
+
+    def test_across_runs(self):
+        e = Blur(Lighten(Lit(self.a)))
+        first, passes = self.evaluate(e)
+        self.assertEqual(passes, 2)
+        again, passes = self.evaluate(Blur(Lighten(Lit(self.a.copy()))))     # equal pixels, new objects
+        self.assertEqual(passes, 0)
+        self.assertEqual(again.tobytes(), first.tobytes())
+        # the result was found at the top, so nothing under it was looked up
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+    def test_within_one_program(self):
+        img, passes = self.evaluate(Combine(Lighten(Lit(self.a)), Lighten(Lit(self.a))))
+        self.assertEqual(passes, 2)     # one table, then the combine
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(img.tobytes(), interp.evaluate(Combine(Lighten(Lit(self.a)), Lighten(Lit(self.a)))).tobytes())
+
+    def test_partial_hit(self):
+        self.evaluate(Lighten(Lit(self.a)))
+        _, passes = self.evaluate(Blur(Lighten(Lit(self.a))))
+        self.assertEqual(passes, 1)
+
+    def test_lru_eviction(self):
+        cache = ResultCache(max_bytes=2 * nbytes(self.a))
+        imgs = [gradient(20, 10) for _ in range(3)]
+        for i, key in enumerate([b"x", b"y"]):
+            cache.put(key, imgs[i])
+        cache.get(b"x")
+        cache.put(b"z", imgs[2])
+        self.assertIsNone(cache.get(b"y"))
+        self.assertIs(cache.get(b"x"), imgs[0])
+        self.assertEqual(cache.stats(), {"entries": 2, "bytes": 2 * nbytes(self.a),
+                                         "hits": 2, "misses": 1, "evictions": 1})
+        cache.put(b"big", gradient(40, 40))
+        self.assertEqual(len(cache), 2)
+
+    def test_digests(self):
+        self.assertEqual(imageops.digest(self.a), imageops.digest(self.a.copy()))
+        self.assertNotEqual(imageops.digest(self.a), imageops.digest(self.a.convert("L")))
+        self.assertNotEqual(imageops.digest(interp.lighten(self.a)), imageops.digest(interp.darken(self.a)))
+        self.assertEqual(imageops.digest(interp.invert(interp.invert(self.a))),
+                         imageops.digest(interp.invert(interp.invert(self.a))))
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "a.png")
+            self.a.save(path)
+            before = imageops.digest(imageops.file(path))
+            os.utime(path, ns=(0, 0))
+            self.assertNotEqual(imageops.digest(imageops.file(path)), before)
+
+    def test_parallel(self):
+        e = Combine(Blur(Lit(self.a)), Invert(Lit(self.a)))
+        want, _ = self.evaluate(e, workers=2)
+        got, passes = self.evaluate(e, workers=2)
+        self.assertEqual(passes, 0)
+        self.assertEqual(got.tobytes(), want.tobytes())
+        self.assertIsNone(imageops.results)
+
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.cache = DiskCache(Path(self.dir.name))
+        self.a = gradient(20, 10)
+
+    def test_round_trip(self):
+        for mode in ("L", "RGB", "RGBA", "I", "F", "1", "LA"):
+            img = self.a.convert(mode)
+            self.cache.put(mode.encode(), img)
+            got = self.cache.get(mode.encode())
+            self.assertEqual((got.mode, got.size, got.tobytes()), (mode, img.size, img.tobytes()), mode)
+        self.assertTrue(self.cache.get(b"L").readonly)     # mapped, not copied
+        self.assertEqual(self.cache.hits, 8)
+
+    def test_misses(self):
+        self.assertIsNone(self.cache.get(b"absent"))
+        self.cache.path(b"bad").write_bytes(b"not an entry")
+        self.assertIsNone(self.cache.get(b"bad"))
+        self.assertEqual(self.cache.misses, 2)
+        self.cache.put(b"p", self.a.convert("P"))
+        self.assertIsNone(self.cache.get(b"p"))
+
+    def test_eviction(self):
+        one = 64 + len(self.a.tobytes())
+        self.cache.max_bytes = 2 * one
+        for i, key in enumerate([b"x", b"y"]):
+            self.cache.put(key, self.a)
+            os.utime(self.cache.path(key), (i, i))
+        self.cache.get(b"x")    # now the most recently used
+        self.cache.put(b"z", self.a)
+        self.assertEqual(sorted(p.name for p in Path(self.dir.name).iterdir()),
+                         sorted(self.cache.path(k).name for k in (b"x", b"z")))
+
+    def test_concurrent_writers(self):
+        imgs = [gradient(300, 200) for _ in range(4)]
+        seen = []
+        def write(img):
+            for _ in range(5):
+                self.cache.put(b"same", img)
+                got = self.cache.get(b"same")
+                seen.append(got is None or got.tobytes() == imgs[0].tobytes())
+        threads = [threading.Thread(target=write, args=(img,)) for img in imgs]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertTrue(all(seen))
+        self.assertEqual([p.suffix for p in Path(self.dir.name).iterdir()], [".img"])
+
+    def test_evaluator_consults_it(self):
+        e = Invert(Blur(Lit(self.a)))
+        with mock.patch.object(imageops, "disk", self.cache):
+            want = interp.evaluate(e)
+            before = imageops.passes
+            got = interp.evaluate(Invert(Blur(Lit(self.a.copy()))))
+        self.assertEqual(imageops.passes - before, 0)
+        self.assertEqual(got.tobytes(), want.tobytes())
+
+    def test_across_processes(self):
+        path = os.path.join(self.dir.name, "a.png")
+        self.a.save(path)
+        script = ("import imageops, interp\n"
+                  f"v = interp.blur(interp.lighten(imageops.file({path!r})))\n"
+                  "img = imageops.force(v)\n"
+                  "print(imageops.passes, imageops.disk.hits, img.tobytes().hex()[:40])")
+        env = dict(os.environ, EXPR_IMAGE_CACHE="1", EXPR_CACHE_DIR=self.dir.name)
+        run = lambda: subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(os.path.abspath(interp.__file__)), env=env,
+                                     capture_output=True, text=True, check=True).stdout.split()
+        first, second = run(), run()
+        self.assertEqual(first[:2], ["3", "0"])     # decode, table, blur
+        self.assertEqual(second[:2], ["0", "1"])
+        self.assertEqual(first[2], second[2])
+
+
+class TestRegistry(unittest.TestCase):
+    def test_one_handle_per_file(self):
+        h = registry.open("image1")
+        self.assertIs(registry.open(os.path.join(os.path.dirname(interp.__file__), "Image", "image1.jpg")), h)
+        self.assertIs(interp.image1_path, h)     # built on demand, from the registry
+        e = just_parse("combine(image1, image1)")
+        self.assertIs(e.image1, h)
+        self.assertIs(e.image2, h)
+        self.assertIsNot(registry.open("image2"), h)
+
+    def test_lazy(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "a.png")
+            gradient(30, 20).save(path)
+            h = registry.open(path)
+            self.assertEqual((h.size, h.mode), ((30, 20), "RGB"))
+            self.assertIsNone(h.image)
+            interp.rotate(interp.combine(h, h))     # no pixels needed yet
+            self.assertIsNone(h.image)
+
+    def test_decoded_once(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "a.png")
+            gradient(30, 20).save(path)
+            decodes = []
+            apply = imageops.apply
+            def counting(op, *args):
+                decodes.append(op == "file")
+                return apply(op, *args)
+            with mock.patch.object(imageops, "apply", counting):
+                for _ in range(3):
+                    h = registry.open(path)
+                    interp.evaluate(Combine(Invert(h), Blur(h)))
+            self.assertEqual(sum(decodes), 1)
+
+    def test_decoded_once_across_operations(self):
+        # crops, resizes and plain uses of one name, in separate statements,
+        # all take their pixels from the handle
+        photo = registry.open("image1")
+        def fresh():
+            photo.image, photo.drafted = None, None
+        self.addCleanup(fresh)
+        decodes = []
+        apply = imageops.apply
+        def counting(op, *args):
+            decodes.append(op)
+            return apply(op, *args)
+        scripts = [
+            (["crop(image1, 0, 0, 10, 10)", "crop(image1, 100, 100, 10, 10)", "invert(image1)",
+              "resize(image1, 40, 30)"], ["file"]),
+            (["resize(image1, 40, 30)", "resize(invert(image1), 30, 40)"], ["draft"]),
+        ]
+        for statements, want in scripts:
+            with self.subTest(statements=statements):
+                fresh()
+                decodes.clear()
+                with mock.patch.object(imageops, "apply", counting):
+                    for src in statements:
+                        interp.evaluate(just_parse(src))
+                self.assertEqual([op for op in decodes if op in ("file", "draft", "region")], want)
+
+    def test_released_with_last_reference(self):
+        import gc
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "a.png")
+            gradient(30, 20).save(path)
+            h = registry.open(path)
+            count = registry.handle_count()
+            imageops.force(h)
+            del h
+            gc.collect()
+            self.assertEqual(registry.handle_count(), count - 1)
+            self.assertIsNone(registry.open(path).image)
+
+    def test_released_after_evaluate(self):
+        # the table of nodes holds the AST after it is dropped; a full
+        # collection sweeps it, and the handle goes with the last node
+        import gc
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "a.png")
+            gradient(30, 20).save(path)
+            gc.collect()
+            count = registry.handle_count()
+            e = Invert(Lit(registry.open(path)))
+            v = interp.evaluate(e)
+            self.assertEqual(registry.handle_count(), count + 1)
+            del e, v
+            gc.collect()
+            self.assertEqual(registry.handle_count(), count)
+            self.assertIsNone(registry.open(path).image)
+
+    def test_builtins_not_pinned(self):
+        # the example expressions in interp are built on demand, so nothing
+        # holds image1 but what the caller keeps
+        import gc
+        self.assertIs(interp.test1.value.value, registry.open("image1"))
+        gc.collect()
+        self.assertNotIn(os.path.abspath(registry.NAMES["image1"]), registry._handles)
+
+
+class TestResize(unittest.TestCase):
+    def setUp(self):
+        self.photo = registry.open("image1")
+        for h in (self.photo, registry.open("image2")):     # decodes the handles keep
+            h.image, h.drafted = None, None
+
+    def drafts(self, v):
+        return [x for x in imageops.postorder(imageops.rewrite(v)) if x.op == "draft"]
+
+    def test_language(self):
+        e = just_parse("resize(invert(image1), 30, 40)")
+        self.assertEqual(e, Resize(Invert(self.photo), Lit(30), Lit(40)))
+        results = {b: interp.evaluate(e, b) for b in interp.BACKENDS}
+        self.assertEqual({r.size for r in results.values()}, {(30, 40)})
+        self.assertEqual(len({r.tobytes() for r in results.values()}), 1)
+        for bad in ("resize(3, 1, 1)", "resize(image1, 0, 5)", "resize(image1, true, 5)"):
+            with self.assertRaises(interp.evalError):
+                interp.evaluate(just_parse(bad))
+
+    def test_demand_reaches_decoder(self):
+        v = interp.resize(interp.lighten(interp.rotate(self.photo)), 400, 300)
+        [d] = self.drafts(v)
+        self.assertEqual(d.arg[1], 8)
+        self.assertEqual(d.size, (378, 504))
+        before = imageops.passes
+        img = imageops.force(v)
+        self.assertEqual(imageops.passes - before, 4)     # decode, table, transpose, resize
+        with Image.open(self.photo.arg) as full:
+            want = ImageEnhance.Brightness(full.transpose(Image.Transpose.ROTATE_90)).enhance(1.5).resize((400, 300))
+        self.assertLess(sum(ImageStat.Stat(ImageChops.difference(img, want)).mean) / 3, 4)     # of 255
+
+    def test_combine_sides(self):
+        v = interp.resize(interp.combine(self.photo, interp.invert(registry.open("image2"))), 300, 200)
+        self.assertEqual([d.arg[1] for d in self.drafts(v)], [8, 8])
+        self.assertEqual(imageops.force(v).size, (300, 200))
+
+    def test_scale_chosen(self):
+        self.assertEqual([d.arg[1] for d in self.drafts(interp.resize(self.photo, 1512, 2016))], [2])
+        self.assertEqual([d.arg[1] for d in self.drafts(interp.resize(self.photo, 1000, 2100))], [])
+        self.assertEqual(self.drafts(interp.resize(self.photo, 5000, 5000)), [])
+
+    def test_blocked(self):
+        self.assertEqual(self.drafts(interp.resize(interp.blur(self.photo), 300, 400)), [])
+        # needed whole by another consumer
+        v = imageops.combine(interp.resize(self.photo, 30, 40), self.photo)
+        self.assertEqual(self.drafts(v), [])
+
+    def test_other_formats_reduced(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "a.png")
+            gradient(64, 50).save(path)
+            v = interp.resize(imageops.file(path), 8, 6)
+            [draft] = self.drafts(v)
+            self.assertEqual(draft.size, (8, 7))
+            self.assertEqual(imageops.force(v).size, (8, 6))
+
+
+class TestCrop(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.a = os.path.join(self.dir.name, "a.ppm")
+        self.b = os.path.join(self.dir.name, "b.pgm")
+        gradient(40, 30).save(self.a)
+        gradient(24, 20, "L").save(self.b)
+
+    def graph(self, v):
+        return list(imageops.postorder(imageops.rewrite(v)))
+
+    def test_language(self):
+        photo = registry.open("image1")
+        e = just_parse("crop(invert(image1), 10, 20, 30, 40)")
+        self.assertEqual(e, Crop(Invert(photo), Lit(10), Lit(20), Lit(30), Lit(40)))
+        results = {b: interp.evaluate(e, b) for b in interp.BACKENDS}
+        with Image.open(photo.arg) as full:
+            want = ImageOps.invert(full.crop((10, 20, 40, 60)))
+        for r in results.values():
+            self.assertEqual(r.tobytes(), want.tobytes())
+        for bad in ("crop(3, 0, 0, 1, 1)", "crop(image1, 0, 0, 0, 5)", "crop(image1, -1, 0, 5, 5)",
+                    "crop(image1, 3000, 0, 100, 5)", "crop(image1, 0, true, 5, 5)"):
+            with self.assertRaises(interp.evalError):
+                interp.evaluate(just_parse(bad))
+
+    def test_exact(self):
+        # graphs are built afresh for each force, which keeps what it computes
+        a, b = lambda: imageops.file(self.a), lambda: imageops.file(self.b)
+        cases = [lambda: imageops.invert(a()), lambda: imageops.brightness(imageops.invert(b()), 1.5),
+                 lambda: imageops.blur(a()), lambda: imageops.blur(imageops.blur(b())),
+                 lambda: imageops.combine(imageops.invert(b()), imageops.blur(a()))]
+        cases += [lambda t=t: imageops.rotate(imageops.combine(a(), b()), t) for t in (1, 2, 3)]
+        for v in cases:
+            w, h = v().size
+            for box in [(0, 0, w, h), (1, 2, 7, 5), (w - 3, h - 4, w, h), (w // 3, 0, w - 1, h // 2), (0, h - 1, w, h)]:
+                with self.subTest(v=v(), box=box):
+                    whole = imageops.force(v()).crop(box)
+                    got = imageops.force(imageops.crop(v(), box))
+                    self.assertEqual((got.mode, got.size), (whole.mode, whole.size))
+                    self.assertEqual(got.tobytes(), whole.tobytes())
+
+    def test_only_the_region(self):
+        v = imageops.crop(imageops.invert(imageops.file(self.a)), (5, 10, 15, 14))
+        graph = self.graph(v)
+        self.assertEqual([x.op for x in graph], ["region", "point"])
+        self.assertEqual(graph[0].size, (10, 4))
+        with mock.patch.object(stream, "read_rows", wraps=stream.read_rows) as read_rows:
+            imageops.force(v)
+        read_rows.assert_called_once_with(self.a, 10, 14)
+
+    def test_blur_margin(self):
+        v = imageops.crop(imageops.blur(imageops.file(self.a)), (10, 10, 20, 12))
+        region, blur, cut = self.graph(v)
+        self.assertEqual(region.arg[1], (8, 8, 22, 14))
+        self.assertEqual(cut.arg, (2, 2, 12, 4))
+
+    def test_combine_sources_dropped(self):
+        a, b = imageops.file(self.a), imageops.file(self.b)
+        graph = self.graph(imageops.crop(imageops.combine(a, imageops.invert(b)), (45, 2, 50, 6)))
+        self.assertEqual([x.op for x in graph], ["region", "point", "paste"])
+        self.assertEqual(graph[0].arg, (self.b, (5, 2, 10, 6)))
+        # below the shorter source: nothing of it is read, the canvas is blank there
+        graph = self.graph(imageops.crop(imageops.combine(a, b), (30, 25, 50, 30)))
+        self.assertEqual([x.arg[0] for x in graph if x.op == "region"], [self.a])
+        self.assertEqual(imageops.force(imageops.crop(imageops.combine(a, b), (40, 25, 64, 30))).getextrema(),
+                         ((0, 0), (0, 0), (0, 0)))
+
+    def test_shared_needs_union(self):
+        x = imageops.invert(imageops.file(self.a))
+        v = imageops.combine(imageops.crop(x, (0, 0, 4, 4)), imageops.crop(x, (10, 6, 12, 8)))
+        [region] = [n for n in self.graph(v) if n.op == "region"]
+        self.assertEqual(region.arg[1], (0, 0, 12, 8))
+        whole = imageops.force(imageops.invert(imageops.file(self.a)))
+        want = imageops.force(imageops.combine(whole.crop((0, 0, 4, 4)), whole.crop((10, 6, 12, 8))))
+        self.assertEqual(imageops.force(v).tobytes(), want.tobytes())
+
+    def test_compressed_decoded_once(self):
+        # a JPEG cannot be read in part: the first crop decodes it through its
+        # handle, which keeps it, and the next crop, a statement later, cuts
+        # from the kept image
+        photo = registry.open("image1")
+        photo.image = None
+        self.addCleanup(setattr, photo, "image", None)
+        decodes = []
+        apply = imageops.apply
+        def counting(op, *args):
+            decodes.append(op)
+            return apply(op, *args)
+        e = just_parse("show (crop(image1, 0, 0, 10, 10)); show (crop(image1, 100, 100, 10, 10)); 0")
+        with mock.patch.object(imageops, "apply", counting), mock.patch.object(Image.Image, "show"):
+            interp.evaluate(e)
+        self.assertEqual(decodes.count("file"), 1)
+        self.assertNotIn("region", decodes)
+        self.assertIsNotNone(photo.image)
+
+    def test_stream_and_parallel(self):
+        v = lambda: imageops.crop(imageops.combine(imageops.blur(imageops.file(self.a)), imageops.file(self.b)),
+                                  (20, 3, 60, 27))
+        want = imageops.force(v())
+        out = os.path.join(self.dir.name, "out.ppm")
+        stream.stream(v(), out, rows=5)
+        with Image.open(out) as img:
+            self.assertEqual(img.tobytes(), want.tobytes())
+        with imageops.parallel(4):
+            self.assertEqual(imageops.force(v()).tobytes(), want.tobytes())
+
+
+def many_colors(w=2048, h=1024):
+    # every pixel a different color: R and G count x and y, B which 256 block
+    rows = [bytes(range(256)) * (w // 256)]
+    red = Image.frombytes("L", (w, h), rows[0] * h)
+    green = Image.frombytes("L", (w, h), b"".join(bytes([y % 256]) * w for y in range(h)))
+    blue = Image.frombytes("L", (w, h), b"".join(b"".join(bytes([x + 8 * (y // 256)]) * 256 for x in range(w // 256))
+                                                 for y in range(h)))
+    return Image.merge("RGB", (red, green, blue))
+
+class TestDominantColor(unittest.TestCase):
+    def test_few_colors_as_getcolors(self):
+        img = Image.new("RGB", (60, 40), (250, 10, 10))
+        img.paste((10, 200, 10), (0, 0, 30, 20))
+        img.paste((10, 10, 200), (30, 0, 60, 10))
+        want = max(img.getcolors())[1]
+        self.assertEqual(dominant.dominant_color(img), want)
+        self.assertEqual(dominant.dominant_color(img.convert("L")), max(img.convert("L").getcolors())[1])
+
+    def test_more_colors_than_getcolors_takes(self):
+        img = many_colors()
+        img.paste((10, 20, 30), (100, 100, 164, 164))
+        self.assertIsNone(img.getcolors(maxcolors=1000000))
+        self.assertEqual(dominant.dominant_color(img), (10, 20, 30))
+
+    def test_alike_colors_binned(self):
+        # most of the image is one green in shades that differ in their low
+        # bits, each rarer than a single red, which getcolors would pick
+        img = Image.new("RGB", (64, 10), (200, 0, 0))
+        img.putdata([(0, 160 + x % 8, 40 + x // 8 % 8) for x in range(64)] * 7 + [(200, 0, 0)] * 192)
+        self.assertEqual(max(img.getcolors())[1], (200, 0, 0))
+        r, g, b = dominant.dominant_color(img)
+        self.assertEqual((r, g >> 3, b >> 3), (0, 20, 5))
+        self.assertEqual(dominant.dominant_color(img, bits=8), (200, 0, 0))
+
+    def test_sampled(self):
+        with Image.open(registry.open("image1").arg) as img:
+            img.load()
+            full = dominant.dominant_color(img)
+            sampled = dominant.dominant_color(img, error=0.01)
+            self.assertEqual(dominant.dominant_color(img, error=0.01), sampled)    # seeded
+        self.assertEqual([v >> 3 for v in sampled], [v >> 3 for v in full])
+        self.assertEqual(dominant.sample(gradient(10, 10), 0.01).size, (10, 10))   # smaller than the sample
+        self.assertGreater(dominant.sample_size(0.01), dominant.sample_size(0.02))
+        with self.assertRaises(ValueError):
+            dominant.dominant_color(img, error=0)
+        with self.assertRaises(ValueError):
+            dominant.dominant_color(img, bits=9)
+
+    def test_interp(self):
+        img = Image.new("RGB", (8, 8), (5, 6, 7))
+        self.assertEqual(interp.eval(dom_color(interp.invert(img))), (250, 249, 248))
+        with self.assertRaises(interp.evalError):
+            interp.eval(dom_color(Lit(3)))
+
+    def test_backends(self):
+        # the image bound to a variable, so every backend has to look it up
+        img = Image.new("RGB", (8, 8), (5, 6, 7))
+        e = Let("x", Lit(img), Let("y", Invert(Name("x")), dom_color(Name("y"))))
+        for backend in interp.BACKENDS:
+            for optimize in (False, True):
+                with self.subTest(backend=backend, optimize=optimize):
+                    self.assertEqual(interp.evaluate(e, backend, optimize=optimize), (250, 249, 248))
+                    with self.assertRaises(interp.evalError):
+                        interp.evaluate(Let("x", Lit(3), dom_color(Name("x"))), backend, optimize=optimize)
+
 
 if __name__ == "__main__":
     unittest.main()
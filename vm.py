@@ -0,0 +1,322 @@
+'''Bytecode compiler and stack VM.
+
+compile_program turns an Expr into Functions: flat, parallel arrays of
+opcodes and integer arguments plus a constant pool, with absolute jump
+targets for If, Ifnz, And and Or. Variables are resolved to frame slots
+first (see resolve.py), so frames are the same fixed-size lists the frames
+backend uses. run_function is one dispatch loop: calls push a return record
+on an explicit call stack instead of recursing, so neither tail nor non-tail
+recursion grows the Python stack. Results and errors are those of
+interp.evalInEnv.'''
+
+from PIL import Image
+from interp import Expr, Value, Closure, evalError, empty_env, evalInEnv, \
+    Seq, Read, Show, Blur, Invert, Neg, Add, Sub, Mul, Div, Rotate, Combine, Resize, Crop, \
+    Lit, Or, And, Not, Eq, Lt, If, Darken, Lighten, Ifnz, App, dom_color, \
+    show, blur, invert, rotate, combine, resize, crop, darken, lighten, dominant_color, is_image, force, LazyImage
+from resolve import resolve, unresolved, Local, AssignLocal, LetLocal, LetfunLocal
+
+# opcodes, roughly in order of how often they run
+OPNAMES = [
+    "LOAD0", "LOAD1", "CONST", "ADD", "SUB", "LT", "EQ", "JUMP_IF_ZERO", "JUMP_IF_FALSE",
+    "JUMP", "CALL", "TAIL_CALL", "RETURN", "STORE", "POP", "MUL", "DIV", "NEG", "NOT",
+    "AND_JUMP", "OR_JUMP", "CHECK_BOOL", "LOADN", "ASSIGN", "CLOSURE", "READ", "SHOW",
+    "BLUR", "INVERT", "ROTATE", "DARKEN", "LIGHTEN", "COMBINE", "RESIZE", "CROP", "DOM_COLOR", "FAIL", "FALLBACK",
+]
+(LOAD0, LOAD1, CONST, ADD, SUB, LT, EQ, JUMP_IF_ZERO, JUMP_IF_FALSE,
+ JUMP, CALL, TAIL_CALL, RETURN, STORE, POP, MUL, DIV, NEG, NOT,
+ AND_JUMP, OR_JUMP, CHECK_BOOL, LOADN, ASSIGN, CLOSURE, READ, SHOW,
+ BLUR, INVERT, ROTATE, DARKEN, LIGHTEN, COMBINE, RESIZE, CROP, DOM_COLOR, FAIL, FALLBACK) = range(len(OPNAMES))
+
+IMAGE_OPS = {SHOW: show, BLUR: blur, INVERT: invert, ROTATE: rotate, DARKEN: darken, LIGHTEN: lighten,
+             DOM_COLOR: dominant_color}
+
+
+class Function:
+    '''Bytecode for one function body (or the whole program)'''
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size            # frame size, see resolve.py
+        self.ops: list[int] = []
+        self.args: list[int] = []
+        self.consts: list = []
+
+    def emit(self, op: int, arg: int = 0) -> int:
+        self.ops.append(op)
+        self.args.append(arg)
+        return len(self.ops) - 1
+
+    def const(self, v) -> int:
+        self.consts.append(v)
+        return len(self.consts) - 1
+
+    def patch(self, at: int) -> None:
+        '''Points the jump at `at` to the next instruction'''
+        self.args[at] = len(self.ops)
+
+    def __str__(self) -> str:
+        return "\n".join(f"{i:4} {OPNAMES[op]:<14}{arg}" for i, (op, arg) in enumerate(zip(self.ops, self.args)))
+
+
+def compile_program(e: Expr) -> Function:
+    r, size = resolve(e)
+    main = Function("<main>", size)
+    compile_into(main, r, False)
+    main.emit(RETURN)
+    return main
+
+def compile_into(f: Function, e: Expr, tail: bool) -> None:
+    match e:
+        case Seq(exprs):
+            for x in exprs[:-1]:
+                compile_into(f, x, False)
+                f.emit(POP)
+            compile_into(f, exprs[-1], tail)
+
+        case Lit(lit):
+            if isinstance(lit, int) or is_image(lit):    # bool is an int
+                f.emit(CONST, f.const(lit))
+            else:
+                f.emit(FAIL, f.const(f"Unknown literal: {lit}"))
+
+        case Local(depth, slot, name):
+            if slot is None:
+                f.emit(FAIL, f.const(f"Name {name} not found"))
+            elif depth == 0:
+                f.emit(LOAD0, slot)
+            elif depth == 1:
+                f.emit(LOAD1, slot)
+            else:
+                f.emit(LOADN, f.const((depth, slot)))
+
+        case AssignLocal(depth, slot, name, value):
+            compile_into(f, value, False)
+            if slot is None:
+                f.emit(FAIL, f.const(f"Name {name} not found"))
+            else:
+                f.emit(ASSIGN, f.const((depth, slot, name)))
+
+        case LetLocal(slot, name, value, body):
+            compile_into(f, value, False)
+            f.emit(STORE, slot)
+            compile_into(f, body, tail)
+
+        case LetfunLocal(slot, size, name, params, bodyexpr, inexpr):
+            g = Function(name, size)
+            compile_into(g, bodyexpr, True)
+            g.emit(RETURN)
+            f.emit(CLOSURE, f.const((g, params, bodyexpr)))
+            f.emit(STORE, slot)
+            compile_into(f, inexpr, tail)
+
+        case App(fun, arg):
+            compile_into(f, fun, False)
+            compile_into(f, arg, False)
+            f.emit(TAIL_CALL if tail else CALL)
+
+        case Add(l, r) | Sub(l, r) | Mul(l, r) | Div(l, r) | Eq(l, r) | Lt(l, r) | Combine(l, r):
+            compile_into(f, l, False)
+            compile_into(f, r, False)
+            f.emit({Add: ADD, Sub: SUB, Mul: MUL, Div: DIV, Eq: EQ, Lt: LT, Combine: COMBINE}[type(e)])
+
+        case Neg(v) | Not(v) | Show(v) | Blur(v) | Invert(v) | Rotate(v) | Darken(v) | Lighten(v) \
+                | dom_color(v):
+            compile_into(f, v, False)
+            f.emit({Neg: NEG, Not: NOT, Show: SHOW, Blur: BLUR, Invert: INVERT, Rotate: ROTATE,
+                    Darken: DARKEN, Lighten: LIGHTEN, dom_color: DOM_COLOR}[type(e)])
+
+        case Resize(image, width, height):
+            compile_into(f, image, False)
+            compile_into(f, width, False)
+            compile_into(f, height, False)
+            f.emit(RESIZE)
+
+        case Crop(image, left, top, width, height):
+            for x in (image, left, top, width, height):
+                compile_into(f, x, False)
+            f.emit(CROP)
+
+        case And(l, r) | Or(l, r):
+            msg = f"{type(e).__name__} requires two boolean literals"
+            compile_into(f, l, False)
+            j = f.emit(AND_JUMP if isinstance(e, And) else OR_JUMP, 0)
+            compile_into(f, r, False)
+            f.emit(CHECK_BOOL, f.const(msg))
+            f.patch(j)
+
+        case If(c, t, el) | Ifnz(c, t, el):
+            compile_into(f, c, False)
+            j = f.emit(JUMP_IF_FALSE if isinstance(e, If) else JUMP_IF_ZERO, 0)
+            compile_into(f, t, tail)
+            k = f.emit(JUMP, 0)
+            f.patch(j)
+            compile_into(f, el, tail)
+            f.patch(k)
+
+        case Read(prompt):
+            f.emit(READ, f.const(prompt))
+
+        case Image.Image() | LazyImage():
+            f.emit(CONST, f.const(e))
+
+        case _:
+            # nodes with no opcode (unknown ones) run on the tree-walker, and
+            # fail only when reached. The tree-walker has no view of the
+            # frame, so one with variables (left unresolved) cannot run
+            if unresolved(e):
+                f.emit(FAIL, f.const(f"{type(e).__name__} cannot use variables on this backend"))
+            else:
+                f.emit(FALLBACK, f.const(e))
+
+
+def run_function(main: Function) -> Value:
+    ops, args, consts = main.ops, main.args, main.consts
+    frame: list = [None] * main.size
+    pc = 0
+    stack: list = []
+    calls: list = []    # (ops, args, consts, pc, frame) of each waiting caller
+    push, pop = stack.append, stack.pop
+    while True:
+        op = ops[pc]
+        arg = args[pc]
+        pc += 1
+        if op == LOAD0:
+            push(frame[arg])
+        elif op == LOAD1:
+            push(frame[0][arg])
+        elif op == CONST:
+            push(consts[arg])
+        elif op <= EQ:      # ADD, SUB, LT, EQ
+            r = pop()
+            l = pop()
+            if op == EQ:
+                if type(l) == bool:
+                    if type(r) != bool:
+                        raise evalError("Eq requires a Boolean")
+                    push(l == r)
+                elif type(l) == int and type(r) == int:
+                    push(l == r)
+                elif is_image(l) and is_image(r):
+                    push(force(l).tobytes())
+                else:
+                    push(None)
+            elif type(l) == int and type(r) == int:
+                push(l + r if op == ADD else l - r if op == SUB else l < r)
+            elif op == ADD and is_image(l) and is_image(r):
+                push(Combine(l, r))
+            else:
+                raise evalError({ADD: "Addition requires two integers literals",
+                                 SUB: "Subtraction requires two integer literals",
+                                 LT: "Lt requires a Boolean"}[op])
+        elif op == JUMP_IF_ZERO:
+            if pop() == 0:
+                pc = arg
+        elif op == JUMP_IF_FALSE:
+            c = pop()
+            if not isinstance(c, bool):
+                raise evalError("If condition must be a boolean")
+            if not c:
+                pc = arg
+        elif op == JUMP:
+            pc = arg
+        elif op == CALL or op == TAIL_CALL:
+            a = pop()
+            fun = pop()
+            if not isinstance(fun, Closure):
+                raise evalError("not a function")
+            if op == CALL:
+                calls.append((ops, args, consts, pc, frame))
+            g = fun.code
+            ops, args, consts, pc = g.ops, g.args, g.consts, 0
+            frame = [fun.env, a]
+            frame.extend([None] * (g.size - 2))
+        elif op == RETURN:
+            if not calls:
+                return pop()
+            ops, args, consts, pc, frame = calls.pop()
+        elif op == STORE:
+            frame[arg] = pop()
+        elif op == POP:
+            pop()
+        elif op == MUL or op == DIV:
+            r = pop()
+            l = pop()
+            if type(l) == int and type(r) == int:
+                if op == MUL:
+                    push(l * r)
+                elif r == 0:
+                    raise evalError("You cannot divide by Zero")
+                else:
+                    push(l // r)
+            else:
+                raise evalError("Multiplication requires two integer literals" if op == MUL
+                                else "Division requires two integer literals")
+        elif op == NEG:
+            v = pop()
+            if type(v) != int:
+                raise evalError("Negation requires an integer literal")
+            push(-v)
+        elif op == NOT:
+            v = pop()
+            if not isinstance(v, bool):
+                raise evalError("Not requires a boolean literal")
+            push(not v)
+        elif op == AND_JUMP or op == OR_JUMP:
+            l = stack[-1]
+            if not isinstance(l, bool):
+                raise evalError("And requires two boolean literals" if op == AND_JUMP
+                                else "Or requires two boolean literals")
+            if l == (op == OR_JUMP):    # the left operand decides
+                pc = arg
+            else:
+                pop()
+        elif op == CHECK_BOOL:
+            if not isinstance(stack[-1], bool):
+                raise evalError(consts[arg])
+        elif op == LOADN:
+            depth, slot = consts[arg]
+            f = frame
+            for _ in range(depth):
+                f = f[0]
+            push(f[slot])
+        elif op == ASSIGN:
+            depth, slot, name = consts[arg]
+            f = frame
+            for _ in range(depth):
+                f = f[0]
+            if isinstance(f[slot], Closure):
+                raise evalError(f"Cannot assign to function {name}")
+            f[slot] = stack[-1]
+        elif op == CLOSURE:
+            g, params, body = consts[arg]
+            push(Closure(params, body, frame, g))
+        elif op == READ:
+            try:
+                push(int(input(consts[arg])))
+            except ValueError:
+                raise evalError("Invalid input: expected an integer")
+        elif op in IMAGE_OPS:
+            push(IMAGE_OPS[op](pop()))
+        elif op == COMBINE:
+            r = pop()
+            push(combine(pop(), r))
+        elif op == RESIZE:
+            h = pop()
+            w = pop()
+            push(resize(pop(), w, h))
+        elif op == CROP:
+            h = pop()
+            w = pop()
+            t = pop()
+            l = pop()
+            push(crop(pop(), l, t, w, h))
+        elif op == FAIL:
+            raise evalError(consts[arg])
+        elif op == FALLBACK:
+            push(evalInEnv(empty_env, consts[arg]))
+        else:
+            raise evalError(f"bad opcode {op}")
+
+
+def eval(e: Expr) -> Value:
+    return run_function(compile_program(e))